@@ -5,7 +5,10 @@ import gradio as gr
 import os.path as osp
 import platform
 from src.utils.helper import load_description
-from src.gradio_pipeline import GradioPipeline, GradioPipelineAnimal
+from src.utils.rprint import rlog as log
+from src.gradio_pipeline import GradioPipeline, GradioPipelineAnimal, a2v_user_args
+from src.job_queue import JobQueue, JobQueueFull
+from src.utils.registry import ModelRegistry
 from src.config.crop_config import CropConfig
 from src.config.argument_config import ArgumentConfig
 from src.config.inference_config import InferenceConfig
@@ -47,22 +50,59 @@ if args.gradio_temp_dir not in (None, ''):
     os.environ["GRADIO_TEMP_DIR"] = args.gradio_temp_dir
     os.makedirs(args.gradio_temp_dir, exist_ok=True)
 
-gradio_pipeline_human = GradioPipeline(
-    inference_cfg=inference_cfg,
-    crop_cfg=crop_cfg,
-    args=args
-)
-gradio_pipeline_animal = GradioPipelineAnimal(
-    inference_cfg=inference_cfg,
-    crop_cfg=crop_cfg,
-    args=args
-)
-def gpu_wrapped_execute_a2v(*args, **kwargs):
+gradio_pipeline_human = gradio_pipeline_animal = job_queue = None
+
+
+def build_backend():
+    global gradio_pipeline_human, gradio_pipeline_animal, job_queue
+    if args.gradio_num_workers > 0:
+        # every worker process loads its own model set, the gradio process only queues the requests
+        job_queue = JobQueue(inference_cfg, crop_cfg, args, num_workers=args.gradio_num_workers, max_queued_jobs=args.gradio_max_queued_jobs)
+        return
+
+    # the motion generator, S and the face detectors are loaded once for both pipelines
+    model_registry = ModelRegistry()
+    gradio_pipeline_human = GradioPipeline(
+        inference_cfg=inference_cfg,
+        crop_cfg=crop_cfg,
+        args=args,
+        registry=model_registry
+    )
+    gradio_pipeline_animal = GradioPipelineAnimal(
+        inference_cfg=inference_cfg,
+        crop_cfg=crop_cfg,
+        args=args,
+        registry=model_registry
+    )
+
+
+def gpu_wrapped_execute_a2v(*args, progress=gr.Progress(), **kwargs):
     # print("args: ", args, args[5])
-    if args[5] == "animal":
-        return gradio_pipeline_animal.execute_a2v(*args, **kwargs)
-    else:
-        return gradio_pipeline_human.execute_a2v(*args, **kwargs)
+    if job_queue is None:
+        if args[5] == "animal":
+            return gradio_pipeline_animal.execute_a2v(*args, **kwargs)
+        else:
+            return gradio_pipeline_human.execute_a2v(*args, **kwargs)
+
+    args_user = a2v_user_args(*args, **kwargs)
+    if args_user['reference'] is None or args_user['audio'] is None:
+        raise gr.Error("Please upload the source portrait or source video, and driving video 🤗🤗🤗", duration=5)
+    try:
+        job_id = job_queue.submit(args_user)
+    except JobQueueFull:
+        raise gr.Error("The server is busy, please try again in a few minutes.", duration=5)
+    progress(0., desc="Waiting for a worker")
+    for kind, payload in job_queue.events(job_id):
+        if kind == 'started':
+            progress(0., desc=f"Running on worker {payload}")
+        elif kind == 'progress':
+            progress(payload[0], desc=payload[1])
+        elif kind == 'done':
+            gr.Info("Run successfully!", duration=2)
+            return payload
+        elif kind == 'failed':
+            log(f"Job {job_id} failed:\n{payload}")
+            raise gr.Error("Generation failed, see the server log for details.", duration=5)
 
 
 ################# GUI ################
@@ -180,11 +220,16 @@ with gr.Blocks(theme=gr.themes.Soft(font=[gr.themes.GoogleFont("Plus Jakarta San
         outputs=[
             output_video,
         ],
-        show_progress=True
+        show_progress=True,
+        # requests beyond the workers wait in the job queue, which rejects them once it is full
+        concurrency_limit=args.gradio_num_workers + args.gradio_max_queued_jobs if args.gradio_num_workers > 0 else 1,
     )
 
-demo.launch(
-    server_port=args.server_port,
-    share=args.share,
-    server_name=args.server_name
-)
\ No newline at end of file
+# the job workers are spawned processes that import this module again, only the main process serves
+if __name__ == "__main__":
+    build_backend()
+    demo.launch(
+        server_port=args.server_port,
+        share=args.share,
+        server_name=args.server_name
+    )
\ No newline at end of file
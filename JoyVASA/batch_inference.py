@@ -0,0 +1,194 @@
+# coding: utf-8
+
+"""
+Batch inference over a manifest of reference/audio pairs, the models are loaded once for all the jobs.
+
+The manifest is a .csv file with a header or a .jsonl file with one object per line. Every job has a `reference` and
+an `audio`, any other column/key overrides the argument of the same name for this job only, e.g.
+
+    reference,audio,animation_mode,cfg_scale
+    assets/examples/imgs/joyvasa_001.png,assets/examples/audios/joyvasa_001.wav,animal,2.0
+    assets/examples/imgs/joyvasa_003.png,assets/examples/audios/joyvasa_003.wav,human,4.0
+
+The other arguments are the defaults of every job. The motion of the next job is generated while the current one is
+rendered, jobs of the same reference image reuse its prepared source, and the time of every stage of every job is
+written to a csv summary.
+
+python batch_inference.py --manifest jobs.csv --output_dir animations/batch
+"""
+
+import os
+import os.path as osp
+import csv
+import json
+import time
+import dataclasses
+from dataclasses import dataclass
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+
+import tyro
+import torch
+
+from inference import partial_fields, fast_check_ffmpeg, fast_check_args
+from src.config.argument_config import ArgumentConfig
+from src.config.inference_config import InferenceConfig
+from src.config.crop_config import CropConfig
+from src.utils.registry import ModelRegistry
+from src.utils.motion import MotionSequence
+from src.utils.helper import mkdir
+from src.utils.rprint import rlog as log
+
+
+@dataclass(repr=False)
+class BatchArgumentConfig(ArgumentConfig):
+    manifest: str = ''  # .csv or .jsonl file of the jobs, with the columns/keys reference, audio and optional per job overrides
+    timing_summary: Optional[str] = None  # csv file of the time of every job, <output_dir>/timing_summary.csv by default
+    flag_prefetch_motion: bool = True  # generate the motion of the next job while the current one is rendered
+
+
+def load_manifest(manifest_path):
+    if manifest_path.endswith('.jsonl'):
+        with open(manifest_path, 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    with open(manifest_path, 'r', newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def parse_value(default, value):
+    """a csv cell as the type of the default value of the argument, values from jsonl are already typed"""
+    if not isinstance(value, str):
+        return value
+    if isinstance(default, bool):
+        return value.strip().lower() in ('1', 'true', 'yes')
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    if default is None and value == '':
+        return None
+    return value
+
+
+def make_job_args(args: ArgumentConfig, job: dict) -> ArgumentConfig:
+    fields = {}
+    for k, v in job.items():
+        if k not in ArgumentConfig.__dataclass_fields__:
+            log(f'Ignore unknown column {k} of the manifest.')
+            continue
+        fields[k] = parse_value(getattr(args, k), v)
+    return dataclasses.replace(args, **fields)
+
+
+class BatchRunner(object):
+    """the pipeline of every animation mode, built on first use, with one model registry so that the motion generator,
+    S and the face detectors are loaded once"""
+
+    def __init__(self, args: BatchArgumentConfig):
+        # jobs of the same reference image reuse its prepared source
+        self.inference_cfg = partial_fields(InferenceConfig, {**args.__dict__, 'flag_source_cache': True})
+        self.crop_cfg = partial_fields(CropConfig, args.__dict__)
+        self.registry = ModelRegistry()
+        self.pipelines = {}
+
+    def get_pipeline(self, animation_mode):
+        if animation_mode not in self.pipelines:
+            start_time = time.time()
+            if animation_mode == "animal":
+                from src.live_portrait_wmg_pipeline_animal import LivePortraitPipelineAnimal
+                self.pipelines[animation_mode] = LivePortraitPipelineAnimal(self.inference_cfg, self.crop_cfg, registry=self.registry)
+            elif animation_mode == "human":
+                from src.live_portrait_wmg_pipeline import LivePortraitPipeline
+                self.pipelines[animation_mode] = LivePortraitPipeline(self.inference_cfg, self.crop_cfg, registry=self.registry)
+            else:
+                raise RuntimeError(f"error args.animation_mode: {animation_mode}")
+            log(f'Build the {animation_mode} pipeline in {time.time() - start_time:.3f}s')
+        return self.pipelines[animation_mode]
+
+    def get_wrapper(self, animation_mode):
+        pipeline = self.get_pipeline(animation_mode)
+        return getattr(pipeline, 'live_portrait_wrapper_animal', None) or pipeline.live_portrait_wrapper
+
+    @torch.no_grad()
+    def gen_motion(self, args: ArgumentConfig):
+        start_time = time.time()
+        if args.driving_motion is not None:
+            motion_seq = MotionSequence.load(args.driving_motion)
+        else:
+            motion_seq = self.get_wrapper(args.animation_mode).gen_motion_sequence(args)
+        return motion_seq, time.time() - start_time
+
+    @torch.no_grad()
+    def render(self, args: ArgumentConfig, motion_seq):
+        # every argument of the job is applied, nothing of the previous job leaks into this one
+        self.get_wrapper(args.animation_mode).update_config(args.__dict__)
+        pipeline = self.get_pipeline(args.animation_mode)
+        pipeline.cropper.update_config(args.__dict__)
+        return pipeline.execute(args, motion_seq=motion_seq)
+
+
+def main():
+    tyro.extras.set_accent_color("bright_cyan")
+    args = tyro.cli(BatchArgumentConfig)
+
+    ffmpeg_dir = os.path.join(os.getcwd(), "ffmpeg")
+    if osp.exists(ffmpeg_dir):
+        os.environ["PATH"] += (os.pathsep + ffmpeg_dir)
+    if not fast_check_ffmpeg():
+        raise ImportError(
+            "FFmpeg is not installed. Please install FFmpeg (including ffmpeg and ffprobe) before running this script. https://ffmpeg.org/download.html"
+        )
+
+    jobs = [make_job_args(args, job) for job in load_manifest(args.manifest)]
+    log(f'Load {len(jobs)} jobs from {args.manifest}')
+    runner = BatchRunner(args)
+    # the pipelines of all the modes of the manifest are loaded before the first job
+    for animation_mode in dict.fromkeys(job.animation_mode for job in jobs):
+        runner.get_pipeline(animation_mode)
+
+    def gen_motion(job_args):
+        fast_check_args(job_args)
+        return runner.gen_motion(job_args)
+
+    prefetcher = ThreadPoolExecutor(max_workers=1) if args.flag_prefetch_motion else None
+    next_motion = prefetcher.submit(gen_motion, jobs[0]) if prefetcher is not None and jobs else None
+    summary = []
+    for i, job_args in enumerate(jobs):
+        record = {'job': i, 'reference': job_args.reference, 'audio': job_args.audio, 'animation_mode': job_args.animation_mode,
+                  'status': 'done', 'output': '', 'n_frames': 0, 'motion_s': 0., 'wait_s': 0., 'render_s': 0., 'total_s': 0.}
+        start_time = time.time()
+        try:
+            if prefetcher is not None:
+                motion = next_motion
+                if i + 1 < len(jobs):
+                    next_motion = prefetcher.submit(gen_motion, jobs[i + 1])
+                motion_seq, record['motion_s'] = motion.result()
+                record['wait_s'] = time.time() - start_time  # motion generation time not hidden behind the previous job
+            else:
+                motion_seq, record['motion_s'] = gen_motion(job_args)
+            record['n_frames'] = motion_seq.n_frames
+            render_start = time.time()
+            record['output'] = runner.render(job_args, motion_seq)
+            record['render_s'] = time.time() - render_start
+        except Exception as e:
+            record['status'] = f'failed: {e}'
+            log(f'Job {i} ({job_args.reference}, {job_args.audio}) failed: {e}')
+        record['total_s'] = time.time() - start_time
+        summary.append(record)
+        log(f"Job {i + 1}/{len(jobs)} {record['status']} in {record['total_s']:.2f}s: {record['output']}")
+    if prefetcher is not None:
+        prefetcher.shutdown()
+
+    timing_summary = args.timing_summary or osp.join(args.output_dir, 'timing_summary.csv')
+    mkdir(osp.dirname(osp.abspath(timing_summary)))
+    with open(timing_summary, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(summary[0].keys()) if summary else ['job'])
+        writer.writeheader()
+        for record in summary:
+            writer.writerow({k: f'{v:.3f}' if isinstance(v, float) else v for k, v in record.items()})
+    n_done = sum(record['status'] == 'done' for record in summary)
+    log(f'{n_done}/{len(summary)} jobs done in {sum(record["total_s"] for record in summary):.2f}s, timing summary: {timing_summary}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# coding: utf-8
+
+"""
+Latency of the vectorized smoothing filters of src/utils/filter.py against the per-frame filters and pykalman,
+on a random walk of T frames.
+
+python scripts/bench_filter.py --n_frames 250 1000 5000
+"""
+
+import os.path as osp
+import sys
+import time
+import argparse
+
+import numpy as np
+import torch
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.realpath(__file__))))
+from src.utils import filter as F  # noqa: E402
+
+
+def timeit(fn, repeat):
+    out = fn()  # warm up
+    tic = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    return out, (time.perf_counter() - tic) * 1000 / repeat
+
+
+def per_frame(filter_obj, x):
+    return np.array([filter_obj.update(value) for value in x])
+
+
+def report(name, t_ref, t_new, out_ref, out_new):
+    diff = np.abs(np.asarray(out_ref, dtype=np.float64) - np.asarray(out_new, dtype=np.float64)).max()
+    print(f'{name:<20s} per frame {t_ref:10.2f} ms | vectorized {t_new:8.2f} ms | x{t_ref / t_new:7.1f} | max abs diff {diff:.2e}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_frames', type=int, nargs='+', default=[250, 1000, 5000])
+    parser.add_argument('--kalman_dim', type=int, default=63, help='dimension of the state of the Kalman smoother, 63 for the keypoints')
+    parser.add_argument('--repeat', type=int, default=3)
+    opt = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for n_frames in opt.n_frames:
+        print(f'--- {n_frames} frames')
+        x = np.cumsum(rng.standard_normal((n_frames, 7)), axis=0).astype(np.float32)  # scale, t, pitch, yaw, roll
+
+        out_ref, t_ref = timeit(lambda: per_frame(F.ExponentialMovingAverageFilter(alpha=0.01), x), opt.repeat)
+        out_new, t_new = timeit(lambda: F.ema_filter(x, alpha=0.01), opt.repeat)
+        report('ema', t_ref, t_new, out_ref, out_new)
+
+        out_ref, t_ref = timeit(lambda: per_frame(F.MedianFilter(3), x), opt.repeat)
+        out_new, t_new = timeit(lambda: F.median_filter(x, 3), opt.repeat)
+        report('median, 3 frames', t_ref, t_new, out_ref, out_new)
+
+        out_ref, t_ref = timeit(lambda: per_frame(F.MovingAverageFilter(10), x), opt.repeat)
+        out_new, t_new = timeit(lambda: F.moving_average_filter(x, 10), opt.repeat)
+        report('mean, 10 frames', t_ref, t_new, out_ref, out_new)
+
+        angles = torch.from_numpy(x[:, 4:7].copy())
+        out_ref, t_ref = timeit(lambda: np.concatenate([F.get_rotation_matrix(a[0:1], a[1:2], a[2:3]).numpy() for a in angles]), opt.repeat)
+        out_new, t_new = timeit(lambda: F.get_rotation_matrix(angles[:, 0], angles[:, 1], angles[:, 2]).numpy(), opt.repeat)
+        report('rotation rebuild', t_ref, t_new, out_ref, out_new)
+
+        try:
+            from pykalman import KalmanFilter
+        except ImportError:
+            continue
+        x_kp = np.cumsum(rng.standard_normal((n_frames, opt.kalman_dim)) * 1e-3, axis=0)
+        kf = KalmanFilter(initial_state_mean=x_kp[0], n_dim_obs=opt.kalman_dim,
+                          transition_covariance=1e-5 * np.eye(opt.kalman_dim), observation_covariance=3e-7 * np.eye(opt.kalman_dim))
+        out_ref, t_ref = timeit(lambda: kf.smooth(x_kp)[0], 1)
+        out_new, t_new = timeit(lambda: F.kalman_smooth(x_kp, 3e-7, 1e-5), opt.repeat)
+        report(f'kalman, {opt.kalman_dim} dims', t_ref, t_new, out_ref, out_new)
+
+
+if __name__ == '__main__':
+    main()
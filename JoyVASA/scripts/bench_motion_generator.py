@@ -0,0 +1,93 @@
+# coding: utf-8
+
+"""
+Benchmark of the motion generator backends, eager torch against onnxruntime.
+Export the graphs first with scripts/export_onnx.py.
+
+python scripts/bench_motion_generator.py --num_threads 8 --sample_steps 50
+"""
+
+import os.path as osp
+import sys
+import time
+import argparse
+
+import yaml
+import torch
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.realpath(__file__))))
+from src.config.inference_config import InferenceConfig  # noqa: E402
+from src.utils.helper import load_model  # noqa: E402
+from src.utils.onnx_backend import load_onnx_module  # noqa: E402
+
+
+@torch.no_grad()
+def timeit(fn, repeat):
+    out = fn()  # warm up
+    tic = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    return out, (time.perf_counter() - tic) * 1000 / repeat
+
+
+def report(name, t_torch, t_onnx, out_torch, out_onnx):
+    diff = (out_torch - out_onnx).abs().max().item()
+    print(f'{name:<24s} torch {t_torch:9.2f} ms | onnxruntime {t_onnx:9.2f} ms | x{t_torch / t_onnx:.2f} | max abs diff {diff:.2e}')
+
+
+def main():
+    inference_cfg = InferenceConfig()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--onnx_dir', type=str, default=inference_cfg.onnx_dir)
+    parser.add_argument('--num_threads', type=int, default=inference_cfg.onnx_num_threads)
+    parser.add_argument('--sample_steps', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    opt = parser.parse_args()
+
+    device = 'cpu'
+    torch.set_num_threads(opt.num_threads)  # same thread budget for both backends
+    model_config = yaml.load(open(inference_cfg.models_config, 'r'), Loader=yaml.SafeLoader)
+    motion_generator, model_args = load_model(inference_cfg.checkpoint_MotionGenerator, model_config, device, 'motion_generator')
+    denoising_net = motion_generator.denoising_net
+    denoising_net_onnx = load_onnx_module(opt.onnx_dir, 'denoising_net', device, opt.num_threads)
+    audio_encoder_onnx = load_onnx_module(opt.onnx_dir, 'audio_encoder', device, opt.num_threads)
+    if denoising_net_onnx is None or audio_encoder_onnx is None:
+        return
+
+    n_motions, n_prev_motions = model_args.n_motions, model_args.n_prev_motions
+    audio = torch.randn(1, round(16000 / model_args.fps * n_motions))
+
+    # audio encoder, one window
+    feat_torch, t_torch = timeit(lambda: motion_generator.extract_audio_feature(audio), opt.repeat)
+    motion_generator.audio_feature_runner = audio_encoder_onnx
+    feat_onnx, t_onnx = timeit(lambda: motion_generator.extract_audio_feature(audio), opt.repeat)
+    motion_generator.audio_feature_runner = None
+    report('audio encoder', t_torch, t_onnx, feat_torch, feat_onnx)
+
+    # one denoiser call on the two CFG entries
+    inputs = (
+        torch.randn(2, n_motions, model_args.motion_feat_dim),
+        torch.cat([feat_torch] * 2),
+        torch.randn(2, n_prev_motions, model_args.motion_feat_dim),
+        torch.randn(2, n_prev_motions, model_args.feature_dim),
+        torch.full((2,), 10, dtype=torch.long),
+    )
+    if model_args.use_indicator:
+        inputs = inputs + (torch.ones(2, n_motions),)
+    out_torch, t_torch = timeit(lambda: denoising_net(*inputs), opt.repeat)
+    out_onnx, t_onnx = timeit(lambda: denoising_net_onnx(*inputs), opt.repeat)
+    report('denoiser step', t_torch, t_onnx, out_torch, out_onnx)
+
+    # a whole window, same initial noise
+    motion_at_T = torch.randn(1, n_motions, model_args.motion_feat_dim)
+    sample = lambda: motion_generator.sample(feat_torch, motion_at_T=motion_at_T, cfg_scale=2.8, dynamic_threshold=0,
+                                             sampler='ddim', sample_steps=opt.sample_steps)[0]
+    out_torch, t_torch = timeit(sample, 1)
+    motion_generator.denoising_net = denoising_net_onnx
+    out_onnx, t_onnx = timeit(sample, 1)
+    motion_generator.denoising_net = denoising_net
+    report(f'window, {opt.sample_steps} ddim steps', t_torch, t_onnx, out_torch, out_onnx)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# coding: utf-8
+
+"""
+Benchmark of the per-frame paste back: `paste_back` in utils/crop.py against the `PasteBack` engine.
+A synthetic source image and random crops are used, so no checkpoint is needed.
+
+python scripts/bench_paste_back.py --height 1080 --width 1920 --num_frames 100
+"""
+
+import os.path as osp
+import sys
+import time
+import argparse
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.realpath(__file__))))
+from src.utils.crop import prepare_paste_back, paste_back, PasteBack, make_abs_path  # noqa: E402
+
+
+def build_M_c2o(height, width, dsize=512, face_ratio=0.45, angle=8.):
+    """similarity transform mapping a dsize x dsize crop onto a face area in the middle of the original image"""
+    scale = face_ratio * min(height, width) / dsize
+    M = cv2.getRotationMatrix2D((dsize / 2, dsize / 2), angle, scale)
+    M[:, 2] += (width / 2 - dsize / 2, height / 2 - dsize / 2)
+    return np.vstack([M, [0, 0, 1]]).astype(np.float32)
+
+
+def timeit(fn, frames, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        out = fn(frames)
+        best = min(best, time.perf_counter() - tic)
+    return out, best * 1000 / len(frames)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--num_frames', type=int, default=64)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    opt = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    img_ori = cv2.GaussianBlur(rng.integers(0, 256, (opt.height, opt.width, 3), dtype=np.uint8), (0, 0), 3)
+    frames = [rng.integers(0, 256, (512, 512, 3), dtype=np.uint8) for _ in range(opt.num_frames)]
+    mask_crop = cv2.imread(make_abs_path('./resources/mask_template.png'), cv2.IMREAD_COLOR)
+    M_c2o = build_M_c2o(opt.height, opt.width)
+    mask_ori = prepare_paste_back(mask_crop, M_c2o, dsize=(opt.width, opt.height))
+
+    ref, t_ref = timeit(lambda lst: [paste_back(img, M_c2o, img_ori, mask_ori) for img in lst], frames, opt.repeat)
+    print(f'paste_back                      : {t_ref:7.2f} ms/frame')
+
+    for num_workers in sorted({1, opt.num_workers}):
+        engine = PasteBack(M_c2o, img_ori, mask_ori, num_workers=num_workers)
+        out, t = timeit(engine.paste_back_batch, frames, opt.repeat)
+        engine.close()
+        diff = max(np.abs(a.astype(np.int16) - b).max() for a, b in zip(ref, out))
+        print(f'PasteBack(num_workers={num_workers:<2d})        : {t:7.2f} ms/frame, x{t_ref / t:.1f}, max abs diff {diff}')
+
+
+if __name__ == '__main__':
+    main()
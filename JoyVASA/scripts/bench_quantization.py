@@ -0,0 +1,117 @@
+# coding: utf-8
+
+"""
+Accuracy and latency of the int8 quantization (`--quantization dynamic|static`) against fp32 on cpu.
+G is compared only if its calibration exists, see scripts/calibrate_quantization.py.
+
+python scripts/bench_quantization.py --num_threads 8
+python scripts/bench_quantization.py --num_threads 8 --sources assets/examples/imgs/*.png
+"""
+
+import os.path as osp
+import sys
+import time
+import argparse
+
+import yaml
+import torch
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.realpath(__file__))))
+from src.config.inference_config import InferenceConfig  # noqa: E402
+from src.utils.helper import load_model  # noqa: E402
+from src.utils.quantization import quantize_dynamic_linear, load_static_spade  # noqa: E402
+
+
+@torch.no_grad()
+def timeit(fn, repeat):
+    out = fn()  # warm up
+    tic = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    return out, (time.perf_counter() - tic) * 1000 / repeat
+
+
+def report(name, t_fp32, t_int8, out_fp32, out_int8):
+    diff = (out_fp32 - out_int8).abs()
+    print(f'{name:<24s} fp32 {t_fp32:9.2f} ms | int8 {t_int8:9.2f} ms | x{t_fp32 / t_int8:.2f} | '
+          f'max abs diff {diff.max().item():.2e} | mean abs diff {diff.mean().item():.2e}')
+
+
+def main():
+    inference_cfg = InferenceConfig()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--quantization_dir', type=str, default=inference_cfg.quantization_dir)
+    parser.add_argument('--sources', nargs='*', default=[], help='source portraits for realistic inputs of G, random inputs otherwise')
+    parser.add_argument('--num_threads', type=int, default=4)
+    parser.add_argument('--sample_steps', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    opt = parser.parse_args()
+
+    device = 'cpu'
+    torch.set_num_threads(opt.num_threads)
+    model_config = yaml.load(open(inference_cfg.models_config, 'r'), Loader=yaml.SafeLoader)
+
+    # motion generator, dynamic int8
+    motion_generator, model_args = load_model(inference_cfg.checkpoint_MotionGenerator, model_config, device, 'motion_generator')
+    denoising_net, audio_encoder = motion_generator.denoising_net, motion_generator.audio_encoder
+    denoising_net_int8, audio_encoder_int8 = quantize_dynamic_linear(denoising_net), quantize_dynamic_linear(audio_encoder)
+    n_motions, n_prev_motions = model_args.n_motions, model_args.n_prev_motions
+    audio = torch.randn(1, round(16000 / model_args.fps * n_motions))
+
+    feat_fp32, t_fp32 = timeit(lambda: motion_generator.extract_audio_feature(audio), opt.repeat)
+    motion_generator.audio_encoder = audio_encoder_int8
+    feat_int8, t_int8 = timeit(lambda: motion_generator.extract_audio_feature(audio), opt.repeat)
+    motion_generator.audio_encoder = audio_encoder
+    report('audio encoder', t_fp32, t_int8, feat_fp32, feat_int8)
+
+    inputs = (
+        torch.randn(2, n_motions, model_args.motion_feat_dim),
+        torch.cat([feat_fp32] * 2),
+        torch.randn(2, n_prev_motions, model_args.motion_feat_dim),
+        torch.randn(2, n_prev_motions, model_args.feature_dim),
+        torch.full((2,), 10, dtype=torch.long),
+    )
+    if model_args.use_indicator:
+        inputs = inputs + (torch.ones(2, n_motions),)
+    out_fp32, t_fp32 = timeit(lambda: denoising_net(*inputs), opt.repeat)
+    out_int8, t_int8 = timeit(lambda: denoising_net_int8(*inputs), opt.repeat)
+    report('denoiser step', t_fp32, t_int8, out_fp32, out_int8)
+
+    motion_at_T = torch.randn(1, n_motions, model_args.motion_feat_dim)
+    sample = lambda: motion_generator.sample(feat_fp32, motion_at_T=motion_at_T, cfg_scale=2.8, dynamic_threshold=0,
+                                             sampler='ddim', sample_steps=opt.sample_steps)[0]
+    out_fp32, t_fp32 = timeit(sample, 1)
+    motion_generator.denoising_net = denoising_net_int8
+    out_int8, t_int8 = timeit(sample, 1)
+    motion_generator.denoising_net = denoising_net
+    report(f'window, {opt.sample_steps} ddim steps', t_fp32, t_int8, out_fp32, out_int8)
+
+    # stitching and retargeting MLPs, dynamic int8
+    stitching_retargeting_module = load_model(inference_cfg.checkpoint_S, model_config, device, 'stitching_retargeting_module')
+    for name, mlp in stitching_retargeting_module.items():
+        mlp_int8 = quantize_dynamic_linear(mlp)
+        x = torch.randn(1, model_config['model_params']['stitching_retargeting_module_params'][name]['input_size']) * 0.1
+        out_fp32, t_fp32 = timeit(lambda: mlp(x), opt.repeat)
+        out_int8, t_int8 = timeit(lambda: mlp_int8(x), opt.repeat)
+        report(f'stitching {name}', t_fp32, t_int8, out_fp32, out_int8)
+
+    # G, static int8
+    spade_generator = load_model(inference_cfg.checkpoint_G, model_config, device, 'spade_generator')
+    spade_generator_int8 = load_static_spade(spade_generator, osp.join(opt.quantization_dir, 'spade_generator.pth'))
+    if spade_generator_int8 is None:
+        return
+    if opt.sources:
+        from calibrate_quantization import build_pipeline, make_spade_inputs
+        features = make_spade_inputs(build_pipeline(), opt.sources, n_per_source=1, seed=1)
+    else:
+        features = [torch.randn(1, 256, 64, 64)]
+    for i, feature in enumerate(features):
+        out_fp32, t_fp32 = timeit(lambda: spade_generator(feature), opt.repeat)
+        out_int8, t_int8 = timeit(lambda: spade_generator_int8(feature), opt.repeat)
+        report(f'spade generator #{i}', t_fp32, t_int8, out_fp32, out_int8)
+        psnr = 10 * torch.log10(1. / (out_fp32 - out_int8).pow(2).mean()).item()
+        print(f'{"":<24s} psnr {psnr:.2f} dB')
+
+
+if __name__ == '__main__':
+    main()
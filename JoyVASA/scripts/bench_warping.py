@@ -0,0 +1,190 @@
+# coding: utf-8
+
+"""
+Peak memory and latency of the warping module W for a block of driving frames sharing one source, with the
+(num_kp+1)x feature repeat of create_deformed_feature and the repeated coordinate grid of kp2gaussian ("repeat")
+against the stacked grid_sample, the separable gaussians and the prepared source ("lean").
+The "input" stage is the input of the hourglass of the dense motion network (sparse motions, deformed feature and
+heatmaps), the "warping" stage is the whole W, whose peak also holds the hourglass activations.
+W has random weights, so no checkpoint is needed. On cpu the peak memory is the growth of the peak resident set
+size of a fresh process during the timed runs (linux only), large buffers are mmapped so that freed memory is returned.
+
+python scripts/bench_warping.py --batch_sizes 1 2 4 8 16
+python scripts/bench_warping.py --batch_sizes 1 2 4 8 16 --device cuda:0 --half
+"""
+
+import os
+import os.path as osp
+import sys
+import time
+import types
+import argparse
+import contextlib
+import multiprocessing
+
+import yaml
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.realpath(__file__))))
+from src.modules import dense_motion  # noqa: E402
+from src.modules.util import make_coordinate_grid  # noqa: E402
+from src.modules.warping_network import WarpingNetwork  # noqa: E402
+
+MODELS_CONFIG = osp.join(osp.dirname(osp.dirname(osp.realpath(__file__))), 'src', 'config', 'models.yaml')
+
+
+def repeat_kp2gaussian(kp, spatial_size, kp_variance):
+    """kp2gaussian on a coordinate grid repeated per keypoint"""
+    coordinate_grid = make_coordinate_grid(spatial_size, kp)
+    number_of_leading_dimensions = len(kp.shape) - 1
+    coordinate_grid = coordinate_grid.view((1,) * number_of_leading_dimensions + coordinate_grid.shape)
+    coordinate_grid = coordinate_grid.repeat(*(kp.shape[:number_of_leading_dimensions] + (1, 1, 1, 1)))
+    mean_sub = coordinate_grid - kp.view(kp.shape[:number_of_leading_dimensions] + (1, 1, 1, 3))
+    return torch.exp(-0.5 * (mean_sub ** 2).sum(-1) / kp_variance)
+
+
+def repeat_deformed_feature(self, feature, sparse_motions):
+    """create_deformed_feature on num_kp+1 copies of the feature"""
+    bs, _, d, h, w = feature.shape
+    feature_repeat = feature.unsqueeze(1).unsqueeze(1).repeat(1, self.num_kp + 1, 1, 1, 1, 1, 1)
+    feature_repeat = feature_repeat.view(bs * (self.num_kp + 1), -1, d, h, w)
+    sparse_motions = sparse_motions.view((bs * (self.num_kp + 1), d, h, w, -1))
+    sparse_deformed = F.grid_sample(feature_repeat, sparse_motions, align_corners=False)
+    return sparse_deformed.view((bs, self.num_kp + 1, -1, d, h, w))
+
+
+@contextlib.contextmanager
+def repeat_implementation(model):
+    kp2gaussian = dense_motion.kp2gaussian
+    dense_motion.kp2gaussian = repeat_kp2gaussian
+    model.dense_motion_network.create_deformed_feature = types.MethodType(repeat_deformed_feature, model.dense_motion_network)
+    try:
+        yield
+    finally:
+        dense_motion.kp2gaussian = kp2gaussian
+        del model.dense_motion_network.create_deformed_feature
+
+
+def build_inputs(batch_size, device):
+    cfg = yaml.load(open(MODELS_CONFIG, 'r'), Loader=yaml.SafeLoader)['model_params']['warping_module_params']
+    torch.manual_seed(0)
+    model = WarpingNetwork(**cfg).eval().to(device)
+    feature_3d = torch.randn(1, cfg['reshape_channel'], cfg['dense_motion_params']['reshape_depth'], 64, 64, device=device)
+    kp_source = torch.randn(1, cfg['num_kp'], 3, device=device) * 0.5
+    kp_driving = kp_source + torch.randn(batch_size, cfg['num_kp'], 3, device=device) * 0.05
+    return model, feature_3d, kp_source, kp_driving
+
+
+def hourglass_input(model, feature_3d, kp_driving, kp_source, source=None):
+    """the first stage of DenseMotionNetwork.forward"""
+    network = model.dense_motion_network
+    if source is None:
+        source = network.prepare_source(feature_3d, kp_source)
+    sparse_motion = network.create_sparse_motions(source['identity_grid'], kp_driving, source['kp_source'])
+    deformed_feature = network.create_deformed_feature(source['feature'], sparse_motion)
+    heatmap = network.create_heatmap_representations(source['gaussian_source'], kp_driving)
+    return {'out': torch.cat([heatmap, deformed_feature], dim=2)}
+
+
+def run(model, impl, stage, feature_3d, kp_source, kp_driving):
+    fn = model if stage == 'warping' else types.MethodType(hourglass_input, model)
+    bs = kp_driving.shape[0]
+    if impl == 'repeat':
+        # the source expanded to the batch and prepared again for every block, as warp_decode did
+        with repeat_implementation(model):
+            return fn(feature_3d.expand(bs, -1, -1, -1, -1), kp_driving, kp_source.expand(bs, -1, -1))
+    # the source is prepared once per clip, its cost is not part of a block
+    source = getattr(model, '_bench_source', None)
+    if source is None:
+        source = model._bench_source = model.prepare_source(feature_3d, kp_source)
+    return fn(feature_3d, kp_driving, kp_source.expand(bs, -1, -1), source=source)
+
+
+def read_rss_kb(field):
+    """VmRSS or VmHWM (peak) of this process in KB"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+
+def reset_peak_rss():
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+
+
+def measure(impl, stage, batch_size, device, flag_half, repeat):
+    """(ms per frame, peak memory in MB) of a stage of W on a block of batch_size frames"""
+    model, feature_3d, kp_source, kp_driving = build_inputs(batch_size, device)
+    flag_cuda = device.startswith('cuda')
+    ctx = torch.autocast(device_type='cuda', dtype=torch.float16) if flag_cuda and flag_half else contextlib.nullcontext()
+    with torch.no_grad(), ctx:
+        run(model, impl, stage, feature_3d, kp_source, kp_driving)  # warm up
+        if flag_cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+        else:
+            reset_peak_rss()
+            base = read_rss_kb('VmRSS')
+        best = float('inf')
+        for _ in range(repeat):
+            tic = time.perf_counter()
+            run(model, impl, stage, feature_3d, kp_source, kp_driving)
+            if flag_cuda:
+                torch.cuda.synchronize()
+            best = min(best, time.perf_counter() - tic)
+    if flag_cuda:
+        peak = (torch.cuda.max_memory_allocated() - base) / 2 ** 20
+    else:
+        peak = (read_rss_kb('VmHWM') - base) / 2 ** 10
+    return best * 1000 / batch_size, peak
+
+
+def _measure_worker(queue, *args):
+    queue.put(measure(*args))
+
+
+def measure_in_process(*args):
+    """`measure` in a fresh process whose allocator returns every large buffer to the system when it is freed"""
+    os.environ['MALLOC_MMAP_THRESHOLD_'] = '65536'
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_measure_worker, args=(queue,) + args)
+    proc.start()
+    out = queue.get()
+    proc.join()
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--half', action='store_true', help='float16 autocast on cuda, like flag_use_half_precision')
+    parser.add_argument('--stages', nargs='+', default=['input', 'warping'], choices=['input', 'warping'])
+    parser.add_argument('--repeat', type=int, default=2)
+    opt = parser.parse_args()
+
+    # both implementations give the same output
+    model, feature_3d, kp_source, kp_driving = build_inputs(min(opt.batch_sizes), opt.device)
+    with torch.no_grad():
+        ref = run(model, 'repeat', 'warping', feature_3d, kp_source, kp_driving)['out']
+        out = run(model, 'lean', 'warping', feature_3d, kp_source, kp_driving)['out']
+    print(f'max abs diff of the output: {(ref - out).abs().max().item():.2e}')
+    del model, ref, out
+
+    fn = measure if opt.device.startswith('cuda') else measure_in_process
+    for stage in opt.stages:
+        print(f'--- {stage}')
+        for batch_size in opt.batch_sizes:
+            t_ref, mem_ref = fn('repeat', stage, batch_size, opt.device, opt.half, opt.repeat)
+            t_new, mem_new = fn('lean', stage, batch_size, opt.device, opt.half, opt.repeat)
+            print(f'batch {batch_size:3d} | repeat {t_ref:8.2f} ms/frame {mem_ref:8.1f} MB | '
+                  f'lean {t_new:8.2f} ms/frame {mem_new:8.1f} MB | x{t_ref / t_new:5.2f} faster, x{mem_ref / max(mem_new, 1e-6):5.2f} less memory')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# coding: utf-8
+
+"""
+Calibrate the static int8 quantization of G (`--quantization static`) on source portraits.
+The inputs of G are the warped features of every source driven by randomly displaced keypoints.
+
+python scripts/calibrate_quantization.py --sources assets/examples/imgs/*.png
+python scripts/calibrate_quantization.py --sources assets/examples/imgs/*.png --animal
+"""
+
+import os.path as osp
+import sys
+import copy
+import argparse
+
+import torch
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.realpath(__file__))))
+from src.config.inference_config import InferenceConfig  # noqa: E402
+from src.config.crop_config import CropConfig  # noqa: E402
+from src.utils.helper import mkdir  # noqa: E402
+from src.utils.io import load_image_rgb  # noqa: E402
+from src.utils.rprint import rlog as log  # noqa: E402
+from src.utils.quantization import prepare_static_spade, convert_static_spade  # noqa: E402
+
+
+def get_wrapper(pipeline):
+    return getattr(pipeline, 'live_portrait_wrapper_animal', None) or pipeline.live_portrait_wrapper
+
+
+def build_pipeline(flag_animal=False):
+    inference_cfg = InferenceConfig(flag_force_cpu=True, flag_use_half_precision=False)
+    if flag_animal:
+        from src.live_portrait_wmg_pipeline_animal import LivePortraitPipelineAnimal
+        return LivePortraitPipelineAnimal(inference_cfg=inference_cfg, crop_cfg=CropConfig())
+    from src.live_portrait_wmg_pipeline import LivePortraitPipeline
+    return LivePortraitPipeline(inference_cfg=inference_cfg, crop_cfg=CropConfig())
+
+
+@torch.no_grad()
+def make_spade_inputs(pipeline, sources, n_per_source=8, kp_noise=0.02, seed=0):
+    """warped features of every source driven by its own keypoints plus gaussian noise, one tensor per sample"""
+    wrapper = get_wrapper(pipeline)
+    generator = torch.Generator().manual_seed(seed)
+    inputs = []
+    for source in sources:
+        source_info = pipeline.prepare_source_info(load_image_rgb(source))
+        f_s, x_s = source_info['f_s'], source_info['x_s']
+        for _ in range(n_per_source):
+            x_d = x_s + torch.randn(x_s.shape, generator=generator).to(x_s.device) * kp_noise
+            inputs.append(wrapper.warping_module(f_s, kp_source=x_s, kp_driving=x_d)['out'])
+    return inputs
+
+
+def main():
+    inference_cfg = InferenceConfig()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sources', nargs='+', required=True, help='source portraits used for calibration')
+    parser.add_argument('--n_per_source', type=int, default=8, help='number of driven frames per source')
+    parser.add_argument('--kp_noise', type=float, default=0.02, help='std of the displacement of the driving keypoints')
+    parser.add_argument('--animal', action='store_true', help='calibrate G of the animal model')
+    parser.add_argument('--output_dir', type=str, default=inference_cfg.quantization_dir)
+    opt = parser.parse_args()
+
+    pipeline = build_pipeline(opt.animal)
+    inputs = make_spade_inputs(pipeline, opt.sources, opt.n_per_source, opt.kp_noise)
+
+    spade_generator = prepare_static_spade(copy.deepcopy(get_wrapper(pipeline).spade_generator))
+    with torch.no_grad():
+        for feature in inputs:
+            spade_generator(feature)
+    spade_generator = convert_static_spade(spade_generator)
+
+    mkdir(opt.output_dir)
+    calib_path = osp.join(opt.output_dir, f"spade_generator{'_animal' if opt.animal else ''}.pth")
+    torch.save(spade_generator.state_dict(), calib_path)
+    log(f'Calibrate G on {len(inputs)} warped features of {len(opt.sources)} sources, save to {calib_path} done.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+# coding: utf-8
+
+"""
+Export models to ONNX for the onnxruntime backends (`--motion_generator_backend onnx` and `--render_backend onnx`).
+
+python scripts/export_onnx.py --modules denoising_net audio_encoder
+python scripts/export_onnx.py --modules appearance_feature_extractor motion_extractor warping_module spade_generator stitching_retargeting_module
+python scripts/export_onnx.py --modules appearance_feature_extractor motion_extractor warping_module spade_generator --animal
+"""
+
+import os.path as osp
+import sys
+import argparse
+import contextlib
+
+import yaml
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.realpath(__file__))))
+from src.config.inference_config import InferenceConfig  # noqa: E402
+from src.utils.helper import load_model, mkdir  # noqa: E402
+from src.utils.rprint import rlog as log  # noqa: E402
+from src.modules.util import grid_sample_3d  # noqa: E402
+
+MOTION_GENERATOR_MODULES = ['denoising_net', 'audio_encoder']
+RENDER_MODULES = ['appearance_feature_extractor', 'motion_extractor', 'warping_module', 'spade_generator', 'stitching_retargeting_module']
+
+
+class AudioEncoder(nn.Module):
+    """audio encoder and feature map of the motion generator on windows of n_motions frames, see `extract_audio_feature`"""
+
+    def __init__(self, motion_generator):
+        super().__init__()
+        self.motion_generator = motion_generator
+
+    def forward(self, audio):
+        return self.motion_generator.extract_audio_feature(audio)
+
+
+class TupleOutput(nn.Module):
+    """module with a dict output as a module with a tuple output in the order of `keys`, the ONNX output names"""
+
+    def __init__(self, module, keys):
+        super().__init__()
+        self.module = module
+        self.keys = keys
+
+    def forward(self, *args):
+        out = self.module(*args)
+        return tuple(out[k] for k in self.keys)
+
+
+@contextlib.contextmanager
+def volumetric_grid_sample():
+    """route F.grid_sample on volumes to `grid_sample_3d`, the exporter only supports GridSample on images"""
+    grid_sample = F.grid_sample
+
+    def _grid_sample(inp, grid, *args, **kwargs):
+        if inp.dim() == 5:
+            return grid_sample_3d(inp, grid)
+        return grid_sample(inp, grid, *args, **kwargs)
+
+    F.grid_sample = _grid_sample
+    try:
+        yield
+    finally:
+        F.grid_sample = grid_sample
+
+
+def export(model, args, onnx_path, input_names, output_names, dynamic_axes, opset_version):
+    # the fused multi-head attention kernel used in eval mode has no ONNX symbolic
+    flag_mha_fastpath = torch.backends.mha.get_fastpath_enabled()
+    torch.backends.mha.set_fastpath_enabled(False)
+    try:
+        with torch.no_grad():
+            torch.onnx.export(model, args, onnx_path, input_names=input_names, output_names=output_names,
+                              dynamic_axes=dynamic_axes, opset_version=opset_version, do_constant_folding=True)
+    finally:
+        torch.backends.mha.set_fastpath_enabled(flag_mha_fastpath)
+    log(f'Export {onnx_path} done.')
+
+
+def export_motion_generator(inference_cfg, model_config, modules, output_dir, opset_version):
+    motion_generator, model_args = load_model(inference_cfg.checkpoint_MotionGenerator, model_config, 'cpu', 'motion_generator')
+    n_motions, n_prev_motions = model_args.n_motions, model_args.n_prev_motions
+    motion_feat_dim, feature_dim = model_args.motion_feat_dim, model_args.feature_dim
+    batch_size = 2  # unconditional and audio-conditional entries of CFG, the batch axis is dynamic anyway
+
+    if 'denoising_net' in modules:
+        args = (
+            torch.randn(batch_size, n_motions, motion_feat_dim),
+            torch.randn(batch_size, n_motions, feature_dim),
+            torch.randn(batch_size, n_prev_motions, motion_feat_dim),
+            torch.randn(batch_size, n_prev_motions, feature_dim),
+            torch.full((batch_size,), 10, dtype=torch.long),
+        )
+        input_names = ['motion_feat', 'audio_feat', 'prev_motion_feat', 'prev_audio_feat', 'step']
+        if model_args.use_indicator:
+            args = args + (torch.ones(batch_size, n_motions),)
+            input_names.append('indicator')
+        export(motion_generator.denoising_net, args, osp.join(output_dir, 'denoising_net.onnx'),
+               input_names, ['motion_feat_target'], {name: {0: 'batch'} for name in input_names + ['motion_feat_target']},
+               opset_version)
+
+    if 'audio_encoder' in modules:
+        audio = torch.randn(1, round(16000 / model_args.fps * n_motions))
+        export(AudioEncoder(motion_generator).eval(), (audio,), osp.join(output_dir, 'audio_encoder.onnx'),
+               ['audio'], ['audio_feat'], {'audio': {0: 'batch'}, 'audio_feat': {0: 'batch'}}, opset_version)
+
+
+def export_dict_output(model, args, onnx_path, input_names, opset_version):
+    """export a module returning a dict, the keys become the output names"""
+    with torch.no_grad():
+        out = model(*args)
+    keys = [k for k, v in out.items() if v is not None]
+    export(TupleOutput(model, keys).eval(), args, onnx_path, input_names, keys,
+           {name: {0: 'batch'} for name in input_names + keys}, opset_version)
+
+
+def export_render(inference_cfg, model_config, modules, output_dir, opset_version, flag_animal=False):
+    """export F, M, W, G and the stitching/retargeting MLPs, a module that fails to export stays in torch at runtime"""
+    suffix = '_animal' if flag_animal else ''
+    checkpoints = {
+        'appearance_feature_extractor': inference_cfg.checkpoint_F_animal if flag_animal else inference_cfg.checkpoint_F,
+        'motion_extractor': inference_cfg.checkpoint_M_animal if flag_animal else inference_cfg.checkpoint_M,
+        'warping_module': inference_cfg.checkpoint_W_animal if flag_animal else inference_cfg.checkpoint_W,
+        'spade_generator': inference_cfg.checkpoint_G_animal if flag_animal else inference_cfg.checkpoint_G,
+        'stitching_retargeting_module': inference_cfg.checkpoint_S_animal if flag_animal else inference_cfg.checkpoint_S,
+    }
+    model_params = model_config['model_params']
+    num_kp = model_params['motion_extractor_params']['num_kp']
+    image = torch.randn(1, 3, 256, 256)
+
+    for name in modules:
+        model = load_model(checkpoints[name], model_config, 'cpu', name)
+        try:
+            if name == 'appearance_feature_extractor':
+                export(model, (image,), osp.join(output_dir, f'{name}{suffix}.onnx'), ['source_image'], ['feature_3d'],
+                       {'source_image': {0: 'batch'}, 'feature_3d': {0: 'batch'}}, opset_version)
+            elif name == 'motion_extractor':
+                export_dict_output(model, (image,), osp.join(output_dir, f'{name}{suffix}.onnx'), ['x'], opset_version)
+            elif name == 'warping_module':
+                feature_params = model_params['appearance_feature_extractor_params']
+                feature_3d = torch.randn(1, feature_params['reshape_channel'], feature_params['reshape_depth'], 64, 64)
+                kp_driving, kp_source = torch.randn(1, num_kp, 3) * 0.5, torch.randn(1, num_kp, 3) * 0.5
+                with volumetric_grid_sample():
+                    export_dict_output(model, (feature_3d, kp_driving, kp_source), osp.join(output_dir, f'{name}{suffix}.onnx'),
+                                       ['feature_3d', 'kp_driving', 'kp_source'], opset_version)
+            elif name == 'spade_generator':
+                feature = torch.randn(1, model_params['spade_generator_params']['max_features'] // 2, 64, 64)
+                export(model, (feature,), osp.join(output_dir, f'{name}{suffix}.onnx'), ['feature'], ['out'],
+                       {'feature': {0: 'batch'}, 'out': {0: 'batch'}}, opset_version)
+            elif name == 'stitching_retargeting_module':
+                for key, mlp in model.items():
+                    x = torch.randn(1, model_params['stitching_retargeting_module_params'][key]['input_size'])
+                    export(mlp, (x,), osp.join(output_dir, f'stitching_retargeting_{key}{suffix}.onnx'), ['x'], ['delta'],
+                           {'x': {0: 'batch'}, 'delta': {0: 'batch'}}, opset_version)
+        except Exception as e:
+            log(f'Failed to export {name}{suffix}: {e}. It runs with torch.')
+
+
+def main():
+    inference_cfg = InferenceConfig()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modules', nargs='+', default=MOTION_GENERATOR_MODULES, choices=MOTION_GENERATOR_MODULES + RENDER_MODULES)
+    parser.add_argument('--animal', action='store_true', help='export the animal checkpoints of F, M, W, G and S')
+    parser.add_argument('--output_dir', type=str, default=inference_cfg.onnx_dir)
+    parser.add_argument('--opset_version', type=int, default=17)
+    opt = parser.parse_args()
+
+    mkdir(opt.output_dir)
+    model_config = yaml.load(open(inference_cfg.models_config, 'r'), Loader=yaml.SafeLoader)
+    motion_generator_modules = [name for name in opt.modules if name in MOTION_GENERATOR_MODULES]
+    if motion_generator_modules:
+        export_motion_generator(inference_cfg, model_config, motion_generator_modules, opt.output_dir, opt.opset_version)
+    render_modules = [name for name in opt.modules if name in RENDER_MODULES]
+    if render_modules:
+        export_render(inference_cfg, model_config, render_modules, opt.output_dir, opt.opset_version, opt.animal)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,6 +22,22 @@ class ArgumentConfig(PrintableConfig):
     flag_use_half_precision: bool = False  # whether to use half precision (FP16). If black boxes appear, it might be due to GPU incompatibility; set to False.
     device_id: int = 0  # gpu device id
     flag_force_cpu: bool = False  # force cpu inference, WIP!
+    frames_per_batch: int = 1  # number of frames warped and decoded together by W and G, larger values trade memory for throughput
+    flag_stream_output: bool = False  # encode frames on a background thread as soon as they are rendered instead of keeping the whole clip in memory
+    frame_queue_size: int = 16  # max number of rendered frames waiting for the encoder when flag_stream_output is True
+    video_writer_backend: Literal["imageio", "ffmpeg"] = "imageio"  # "imageio" writes a temp video and adds the audio afterwards, "ffmpeg" pipes raw frames into one ffmpeg process that encodes and muxes the audio in a single pass
+    paste_back_num_workers: int = 4  # number of threads pasting a block of frames back to the original image, 1 disables the thread pool
+    flag_source_cache: bool = False  # cache the cropped source, its keypoints, 3d feature and paste back mask, keyed by the image content and crop options, so a repeated reference image skips source preparation
+    source_cache_size: int = 8  # max number of prepared sources kept in memory
+    source_cache_dir: Optional[str] = None  # if set, prepared sources are also stored in this directory and survive restarts
+    load_num_workers: int = 4  # number of threads loading the checkpoints of F, M, W, G, S, the motion generator and the cropper models in parallel at start up, 1 loads them one after another
+    quantization: Literal["none", "dynamic", "static"] = "none"  # int8 inference on cpu, "dynamic" quantizes the Linear layers of the denoiser, the HuBERT encoder and the stitching/retargeting MLPs, "static" also runs the convs of G in int8 with the calibration of scripts/calibrate_quantization.py
+    quantization_dir: str = make_abs_path('../../pretrained_weights/int8')  # directory of the int8 calibrations of G
+    motion_generator_backend: Literal["torch", "onnx"] = "torch"  # "onnx" runs the denoiser and the audio encoder of the motion generator with onnxruntime, export them with scripts/export_onnx.py first
+    onnx_dir: str = make_abs_path('../../pretrained_weights/onnx')  # directory of the exported ONNX graphs
+    render_backend: Literal["torch", "onnx"] = "torch"  # "onnx" runs F, M, W, G and the stitching/retargeting MLPs with onnxruntime, a module without an exported graph stays in torch
+    flag_latency_report: bool = False  # log the number of calls and the latency of every module of F, M, W, G and the stitching/retargeting MLPs after each run
+    onnx_num_threads: int = 4  # intra-op threads of the onnxruntime sessions on cpu
     flag_normalize_lip: bool = False  # False,  whether to let the lip to close state before animation, only take effect when flag_eye_retargeting and flag_lip_retargeting is False
 
     flag_source_video_eye_retargeting: bool = False  # when the input is a source video, whether to let the eye-open scalar of each frame to be the same as the first source frame before the animation, only take effect when flag_eye_retargeting and flag_lip_retargeting is False, may cause the inter-frame jittering
@@ -60,6 +76,20 @@ class ArgumentConfig(PrintableConfig):
     cfg_cond = None
     cfg_scale: float = 2.8
     is_smooth_motion: bool = True
+    smooth_method: Literal["ema", "median", "mean", "kalman"] = "ema"  # filter of the generated scale, translation and head angles when is_smooth_motion is True, "kalman" smooths with driving_smooth_observation_variance
+    flag_zero_phase_smooth: bool = False  # run the "ema", "median" or "mean" filter forward and backward, removes the lag of the causal filter
+    flag_stream_motion: bool = False  # render every window of the motion generator as soon as it is sampled instead of waiting for the whole motion sequence, the motion is smoothed causally and "kalman" is a constant velocity Kalman filter; with flag_stream_output or the "ffmpeg" writer the first frames are encoded while the motion of the next windows is generated
+    stream_window_frames: int = 0  # frames per window of the streaming mode (src/streaming.py), between n_prev_motions and n_motions; shorter windows lower the latency to the first frame, the rest of the window is masked as padding; 0 uses n_motions
+    sampler: Literal["ddpm", "ddim"] = "ddpm"  # "ddpm" runs all diffusion steps of the motion generator, "ddim" runs sample_steps deterministic steps of the same schedule
+    sample_steps: int = 50  # number of denoising steps per window when sampler is "ddim", e.g. 25 or 50, from 1 to the number of diffusion steps of the motion generator
+    window_mode: Literal["sequential", "parallel"] = "sequential"  # "sequential" generates the windows one after another, "parallel" denoises all (overlapping) windows as one batch and cross-fades the overlaps
+    parallel_coarse_steps: int = 10  # DDIM steps of the coarse pass that provides the preceding motion of every window in "parallel" mode, from 1 to the number of diffusion steps
+    flag_log_sampler_timing: bool = False  # log the time per diffusion step spent in the denoiser and in the update of the motion generator, synchronizes the device at every step
+    audio_encode_mode: Literal["window", "clip"] = "window"  # "window" runs the audio encoder on every window separately, "clip" encodes the whole clip once and slices the features per window
+    audio_encode_chunk_windows: int = 4  # in "clip" mode, encode chunks of this many windows (plus one second of context on both sides) to bound memory, 0 encodes the whole clip in one pass
+    audio_feature_cache_dir: Optional[str] = None  # if set, the audio features of every window are stored here as .npy files, keyed by the audio content and the encoder, and reused when the same audio is run again
+    driving_motion: Optional[str] = None  # motion sequence saved before (.npz, or a legacy .pkl template), animates the reference instead of a motion generated from the audio, the audio is still muxed into the video
+    flag_save_motion: bool = False  # save the generated motion sequence to <output_dir>/<audio>_motion.npz, to be reused with driving_motion
 
     ########## gradio arguments ##########
     server_port: Annotated[int, tyro.conf.arg(aliases=["-p"])] = 7862  # port for gradio server
@@ -67,3 +97,5 @@ class ArgumentConfig(PrintableConfig):
     server_name: Optional[str] = "127.0.0.1"  # set the local server name, "0.0.0.0" to broadcast all
     flag_do_torch_compile: bool = False  # whether to use torch.compile to accelerate generation
     gradio_temp_dir: Optional[str] = None  # directory to save gradio temp files
+    gradio_num_workers: int = 1  # number of worker processes running the requests, each one loads its own model set; 0 runs the requests one at a time in the gradio process
+    gradio_max_queued_jobs: int = 8  # max number of requests waiting for a worker, further requests are rejected until the queue drains
@@ -8,7 +8,7 @@ import cv2
 from numpy import ndarray
 import pickle as pkl
 from dataclasses import dataclass, field
-from typing import Literal, Tuple
+from typing import Literal, Tuple, Optional
 from .base_config import PrintableConfig, make_abs_path
 
 def load_lip_array():
@@ -58,6 +58,22 @@ class InferenceConfig(PrintableConfig):
     source_max_dim: int = 1280 # the max dim of height and width of source image or video
     source_division: int = 2 # make sure the height and width of source image or video can be divided by this number
     animation_region: Literal["exp", "pose", "lip", "eyes", "all"] = "all" # the region where the animation was performed, "exp" means the expression, "pose" means the head pose
+    frames_per_batch: int = 1 # number of frames warped and decoded together, larger values trade memory for throughput
+    flag_stream_output: bool = False # encode frames on a background thread as they are rendered, keeps memory flat for long clips
+    frame_queue_size: int = 16 # max number of rendered frames waiting for the encoder in streaming mode
+    video_writer_backend: Literal["imageio", "ffmpeg"] = "imageio" # "ffmpeg" pipes raw frames into one ffmpeg process that also muxes the audio
+    paste_back_num_workers: int = 4 # threads used to paste a block of frames back, 1 disables the thread pool
+    flag_source_cache: bool = False # reuse the prepared source of a reference image seen before
+    source_cache_size: int = 8 # max number of prepared sources kept in memory
+    source_cache_dir: Optional[str] = None # optional directory backing the source cache on disk
+    load_num_workers: int = 4 # threads loading the checkpoints and the cropper models in parallel, 1 loads them one after another
+    quantization: Literal["none", "dynamic", "static"] = "none" # int8 on cpu, "dynamic" for the Linear layers of the motion generator and S, "static" also for the convs of G
+    quantization_dir: str = make_abs_path('../../pretrained_weights/int8') # directory of the calibrations written by scripts/calibrate_quantization.py
+    motion_generator_backend: Literal["torch", "onnx"] = "torch" # run the denoiser and the audio encoder of the motion generator with onnxruntime
+    onnx_dir: str = make_abs_path('../../pretrained_weights/onnx') # directory of the graphs written by scripts/export_onnx.py
+    render_backend: Literal["torch", "onnx"] = "torch" # run F, M, W, G and the stitching/retargeting MLPs with onnxruntime, per module fallback to torch
+    flag_latency_report: bool = False # log the latency of F, M, W, G and the stitching/retargeting MLPs after each run
+    onnx_num_threads: int = 4 # intra-op threads of the onnxruntime cpu sessions
 
     # NOT EXPORTED PARAMS
     lip_normalize_threshold: float = 0.03 # threshold for flag_normalize_lip
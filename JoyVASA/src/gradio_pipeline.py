@@ -20,13 +20,54 @@ def update_args(args, user_args):
             setattr(args, k, v)
     return args
 
+def a2v_user_args(
+    input_image=None,
+    input_audio=None,
+    flag_normalize_lip=False,
+    flag_relative_motion=True,
+    driving_multiplier=1.0,
+    animation_mode="human",
+    driving_option_input="pose-friendly",
+    flag_do_crop_input=True,
+    scale=2.3,
+    vx_ratio=0.0,
+    vy_ratio=-0.125,
+    flag_stitching_input=True,
+    flag_remap_input=True,
+    cfg_scale=1.2,
+):
+    """the args of one a2v request, in the order of the inputs of the gradio ui"""
+    return {
+        'reference': input_image,
+        'audio': input_audio,
+        'flag_normalize_lip' : flag_normalize_lip,
+        'flag_relative_motion': flag_relative_motion,
+        'driving_multiplier': driving_multiplier,
+        'animation_mode': animation_mode, 
+        'driving_option': driving_option_input,
+        'flag_do_crop': flag_do_crop_input,
+        'scale': scale,
+        'vx_ratio': vx_ratio,
+        'vy_ratio': vy_ratio,
+        'flag_pasteback': flag_remap_input,
+        'flag_stitching': flag_stitching_input,
+        'cfg_scale': cfg_scale,
+    }
+
 class GradioPipeline(LivePortraitPipeline):
     """gradio for human
     """
-    def __init__(self, inference_cfg, crop_cfg, args: ArgumentConfig):
-        super().__init__(inference_cfg, crop_cfg)
+    def __init__(self, inference_cfg, crop_cfg, args: ArgumentConfig, registry=None):
+        super().__init__(inference_cfg, crop_cfg, registry=registry)
         self.args = args
 
+    @torch.no_grad()
+    def execute_args(self, args: ArgumentConfig):
+        """run one request, the configs of the wrapper and the cropper are updated from its args first"""
+        self.live_portrait_wrapper.update_config(args.__dict__)
+        self.cropper.update_config(args.__dict__)
+        return self.execute(args)
+
     @torch.no_grad()
     def execute_a2v(
         self,
@@ -46,29 +87,15 @@ class GradioPipeline(LivePortraitPipeline):
         cfg_scale=1.2,
     ):
         if input_image is not None and input_audio is not None:
-            args_user = {
-                'reference': input_image,
-                'audio': input_audio,
-                'flag_normalize_lip' : flag_normalize_lip,
-                'flag_relative_motion': flag_relative_motion,
-                'driving_multiplier': driving_multiplier,
-                'animation_mode': animation_mode, 
-                'driving_option': driving_option_input,
-                'flag_do_crop': flag_do_crop_input,
-                'scale': scale,
-                'vx_ratio': vx_ratio,
-                'vy_ratio': vy_ratio,
-                'flag_pasteback': flag_remap_input,
-                'flag_stitching': flag_stitching_input,
-                'cfg_scale': cfg_scale,
-            }
+            args_user = a2v_user_args(
+                input_image, input_audio, flag_normalize_lip, flag_relative_motion, driving_multiplier, animation_mode,
+                driving_option_input, flag_do_crop_input, scale, vx_ratio, vy_ratio, flag_stitching_input, flag_remap_input, cfg_scale,
+            )
             # update config from user input
             self.args = update_args(self.args, args_user)
-            self.live_portrait_wrapper.update_config(self.args.__dict__)
-            self.cropper.update_config(self.args.__dict__)
 
             # generate
-            output_path = self.execute(self.args)
+            output_path = self.execute_args(self.args)
             gr.Info("Run successfully!", duration=2)
 
             return output_path
@@ -79,10 +106,17 @@ class GradioPipeline(LivePortraitPipeline):
 class GradioPipelineAnimal(LivePortraitPipelineAnimal):
     """gradio for animal
     """
-    def __init__(self, inference_cfg, crop_cfg, args: ArgumentConfig):
-        super().__init__(inference_cfg, crop_cfg)
+    def __init__(self, inference_cfg, crop_cfg, args: ArgumentConfig, registry=None):
+        super().__init__(inference_cfg, crop_cfg, registry=registry)
         self.args = args
 
+    @torch.no_grad()
+    def execute_args(self, args: ArgumentConfig):
+        """run one request, the configs of the wrapper and the cropper are updated from its args first"""
+        self.live_portrait_wrapper_animal.update_config(args.__dict__)
+        self.cropper.update_config(args.__dict__)
+        return self.execute(args)
+
     @torch.no_grad()
     def execute_a2v(
         self,
@@ -102,29 +136,15 @@ class GradioPipelineAnimal(LivePortraitPipelineAnimal):
         cfg_scale=1.2,
     ):
         if input_image is not None and input_audio is not None:
-            args_user = {
-                'reference': input_image,
-                'audio': input_audio,
-                'flag_normalize_lip' : flag_normalize_lip,
-                'flag_relative_motion': flag_relative_motion,
-                'driving_multiplier': driving_multiplier,
-                'animation_mode': animation_mode, 
-                'driving_option': driving_option_input,
-                'flag_do_crop': flag_do_crop_input,
-                'scale': scale,
-                'vx_ratio': vx_ratio,
-                'vy_ratio': vy_ratio,
-                'flag_pasteback': flag_remap_input,
-                'flag_stitching': flag_stitching_input,
-                'cfg_scale': cfg_scale,
-            }
+            args_user = a2v_user_args(
+                input_image, input_audio, flag_normalize_lip, flag_relative_motion, driving_multiplier, animation_mode,
+                driving_option_input, flag_do_crop_input, scale, vx_ratio, vy_ratio, flag_stitching_input, flag_remap_input, cfg_scale,
+            )
             # update config from user input
             self.args = update_args(self.args, args_user)
-            self.live_portrait_wrapper_animal.update_config(self.args.__dict__)
-            self.cropper.update_config(self.args.__dict__)
 
             # generate
-            output_path = self.execute(self.args)
+            output_path = self.execute_args(self.args)
             gr.Info("Run successfully!", duration=2)
 
             return output_path
@@ -0,0 +1,191 @@
+# coding: utf-8
+
+"""
+Job queue of the gradio demo: every request becomes a job with its own copy of the args, waits in a bounded queue and
+runs in one of the worker processes, each of which holds a model set. Progress is sent back as events.
+"""
+
+import os
+import os.path as osp
+import uuid
+import queue
+import threading
+import traceback
+import dataclasses
+import multiprocessing as mp
+
+from .config.argument_config import ArgumentConfig
+from .utils.rprint import rlog as log
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class Job:
+    job_id: str
+    args: ArgumentConfig  # private to the job, never updated after submission
+
+
+def make_job_args(args: ArgumentConfig, user_args: dict, job_id: str) -> ArgumentConfig:
+    """new args of one request: the server args updated with the user inputs and a private output directory"""
+    fields = {k: v for k, v in user_args.items() if hasattr(args, k)}
+    fields['output_dir'] = osp.join(args.output_dir, job_id)  # concurrent jobs of the same inputs write the same file names
+    return dataclasses.replace(args, **fields)
+
+
+def worker_main(worker_id, inference_cfg, crop_cfg, args, job_queue, event_queue):
+    """loop of a worker process: load one model set, then run the jobs of the queue until it gets None"""
+    from .gradio_pipeline import GradioPipeline, GradioPipelineAnimal
+    from .utils.registry import ModelRegistry
+
+    registry = ModelRegistry()
+    pipelines = {
+        'human': GradioPipeline(inference_cfg=inference_cfg, crop_cfg=crop_cfg, args=args, registry=registry),
+        'animal': GradioPipelineAnimal(inference_cfg=inference_cfg, crop_cfg=crop_cfg, args=args, registry=registry),
+    }
+    log(f'Job worker {worker_id} is ready.')
+
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        event_queue.put((job.job_id, 'started', (worker_id, os.getpid())))
+        pipeline = pipelines['animal' if job.args.animation_mode == 'animal' else 'human']
+        pipeline.progress_callback = lambda fraction, description: event_queue.put((job.job_id, 'progress', (fraction, description)))
+        try:
+            output_path = pipeline.execute_args(job.args)
+            event_queue.put((job.job_id, 'done', output_path))
+        except Exception:
+            event_queue.put((job.job_id, 'failed', traceback.format_exc()))
+        finally:
+            pipeline.progress_callback = None
+
+
+class JobQueue(object):
+    """bounded queue of jobs served by `num_workers` worker processes
+
+    `submit` returns the id of a job, `events` yields its events until it is done:
+    ('started', worker id), ('progress', (fraction, description)), then ('done', output path) or ('failed', traceback).
+    A job fails as soon as the worker running it dies (out of memory, segfault), and a dead worker is restarted up to
+    `max_worker_restarts` times
+    """
+
+    def __init__(self, inference_cfg, crop_cfg, args: ArgumentConfig, num_workers=1, max_queued_jobs=8, max_worker_restarts=3, poll_interval=1.0):
+        self.ctx = mp.get_context('spawn')  # cuda can not be used in forked processes
+        self.inference_cfg = inference_cfg
+        self.crop_cfg = crop_cfg
+        self.args = args
+        self.max_queued_jobs = max_queued_jobs
+        self.max_worker_restarts = max_worker_restarts
+        self.poll_interval = poll_interval
+        self.job_queue = self.ctx.Queue(maxsize=max_queued_jobs)
+        self.event_queue = self.ctx.Queue()
+
+        self.jobs = {}  # job id -> queue of its events
+        self.running = {}  # job id -> pid of the worker running it
+        self.processes = {}  # pid -> live worker process
+        self.workers = [None] * num_workers
+        self.restarts = [0] * num_workers
+        self.closing = False
+        self.lock = threading.Lock()
+        for worker_id in range(num_workers):
+            self._start_worker(worker_id)
+
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def _start_worker(self, worker_id):
+        worker = self.ctx.Process(target=worker_main, args=(worker_id, self.inference_cfg, self.crop_cfg, self.args, self.job_queue, self.event_queue), daemon=True)
+        worker.start()
+        with self.lock:
+            self.workers[worker_id] = worker
+            self.processes[worker.pid] = worker
+
+    def _put_event(self, job_id, kind, payload):
+        with self.lock:
+            events = self.jobs.get(job_id)
+        if events is not None:
+            events.put((kind, payload))
+
+    def _dispatch(self):
+        while True:
+            try:
+                job_id, kind, payload = self.event_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            if kind == 'started':
+                worker_id, pid = payload
+                self.running[job_id] = pid
+                payload = worker_id
+            elif kind in ('done', 'failed'):
+                self.running.pop(job_id, None)
+            self._put_event(job_id, kind, payload)
+            if self.event_queue.empty():
+                # only once the events a dead worker sent before exiting are all read
+                self._check_workers()
+
+    def _check_workers(self):
+        """fail the jobs of the dead workers and restart them"""
+        with self.lock:
+            self.processes = {pid: worker for pid, worker in self.processes.items() if worker.is_alive()}
+            dead_jobs = [(job_id, pid) for job_id, pid in self.running.items() if pid not in self.processes]
+        for job_id, pid in dead_jobs:
+            del self.running[job_id]
+            log(f'Job worker process {pid} exited while running job {job_id}.')
+            self._put_event(job_id, 'failed', f'The job worker process {pid} exited while running the job.')
+
+        if self.closing:
+            return
+        for worker_id, worker in enumerate(self.workers):
+            if worker.is_alive():
+                continue
+            if self.restarts[worker_id] >= self.max_worker_restarts:
+                continue
+            self.restarts[worker_id] += 1
+            log(f'Job worker {worker_id} exited with code {worker.exitcode}, restart it ({self.restarts[worker_id]}/{self.max_worker_restarts}).')
+            self._start_worker(worker_id)
+
+    def has_workers(self):
+        """whether a worker is alive or can still be restarted"""
+        with self.lock:
+            return any(worker.is_alive() or n < self.max_worker_restarts for worker, n in zip(self.workers, self.restarts))
+
+    def submit(self, user_args: dict) -> str:
+        job_id = uuid.uuid4().hex
+        job = Job(job_id=job_id, args=make_job_args(self.args, user_args, job_id))
+        with self.lock:
+            self.jobs[job_id] = queue.Queue()
+        try:
+            self.job_queue.put_nowait(job)
+        except queue.Full:
+            with self.lock:
+                del self.jobs[job_id]
+            raise JobQueueFull(f'{self.max_queued_jobs} jobs are already waiting')
+        return job_id
+
+    def events(self, job_id):
+        events = self.jobs[job_id]
+        try:
+            while True:
+                try:
+                    kind, payload = events.get(timeout=self.poll_interval)
+                except queue.Empty:
+                    if not self.has_workers():
+                        raise RuntimeError('All job workers exited.')
+                    continue
+                yield kind, payload
+                if kind in ('done', 'failed'):
+                    return
+        finally:
+            with self.lock:
+                self.jobs.pop(job_id, None)
+
+    def close(self, timeout=None):
+        self.closing = True
+        for _ in self.workers:
+            self.job_queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout)
@@ -14,19 +14,20 @@ torch.backends.cudnn.benchmark = True # disable CUDNN_BACKEND_EXECUTION_PLAN_DES
 
 import cv2; cv2.setNumThreads(0); cv2.ocl.setUseOpenCL(False)
 import numpy as np
-import os
 import os.path as osp
+import math
 from rich.progress import track
 
 from .config.argument_config import ArgumentConfig
 from .config.inference_config import InferenceConfig
 from .config.crop_config import CropConfig
 from .utils.cropper import Cropper
-from .utils.camera import get_rotation_matrix
-from .utils.video import images2video, concat_frames, get_fps, add_audio_to_video, has_audio_stream, video2gif
-from .utils.crop import _transform_img, prepare_paste_back, paste_back
+from .utils.video import images2video, VideoWriter, FFmpegPipeWriter, AsyncVideoWriter, concat_frames, get_fps, add_audio_to_video, has_audio_stream, video2gif
+from .utils.crop import _transform_img, prepare_paste_back, PasteBack
 from .utils.io import load_image_rgb, load_video, resize_to_limit, dump, load
-from .utils.helper import mkdir, basename, dct2device, is_video, is_template, remove_suffix, is_image, calc_motion_multiplier
+from .utils.helper import ParallelLoader, mkdir, basename, dct2device, is_video, is_template, remove_suffix, is_image
+from .utils.cache import SourceCache, hash_array, make_cache_key
+from .utils.motion import MotionSequence, record_chunks
 from .utils.rprint import rlog as log
 from .live_portrait_wmg_wrapper import LivePortraitWrapperAnimal
 
@@ -36,11 +37,131 @@ def make_abs_path(fn):
 
 class LivePortraitPipelineAnimal(object):
 
-    def __init__(self, inference_cfg: InferenceConfig, crop_cfg: CropConfig):
-        self.live_portrait_wrapper_animal: LivePortraitWrapperAnimal = LivePortraitWrapperAnimal(inference_cfg=inference_cfg)
-        self.cropper: Cropper = Cropper(crop_cfg=crop_cfg, image_type='animal_face', flag_use_half_precision=inference_cfg.flag_use_half_precision)
+    def __init__(self, inference_cfg: InferenceConfig, crop_cfg: CropConfig, registry=None):
+        # load the cropper models in a background thread while the wrapper loads its checkpoints
+        loader = ParallelLoader(min(inference_cfg.load_num_workers, 2))
+        loader.submit('cropper', Cropper, crop_cfg=crop_cfg, image_type='animal_face', flag_use_half_precision=inference_cfg.flag_use_half_precision, load_num_workers=inference_cfg.load_num_workers, registry=registry)
+        self.live_portrait_wrapper_animal: LivePortraitWrapperAnimal = LivePortraitWrapperAnimal(inference_cfg=inference_cfg, registry=registry)
+        self.cropper: Cropper = loader.result('cropper')
+        loader.shutdown()
+        self.source_cache = None
+        self.progress_callback = None  # optional callable(fraction, description), e.g. to report to a UI
+        if inference_cfg.flag_source_cache:
+            self.source_cache = SourceCache(max_items=inference_cfg.source_cache_size, cache_dir=inference_cfg.source_cache_dir, device=self.live_portrait_wrapper_animal.device)
+
+    def prepare_source_info(self, img_rgb):
+        """crop the source image and extract its keypoints and 3d feature, reusing the cached result of the same image"""
+        inf_cfg = self.live_portrait_wrapper_animal.inference_cfg
+        crop_cfg = self.cropper.crop_cfg
+        flag_pasteback = inf_cfg.flag_pasteback and inf_cfg.flag_do_crop and inf_cfg.flag_stitching
+
+        source_key = None
+        if self.source_cache is not None:
+            source_key = make_cache_key(
+                hash_array(img_rgb), inf_cfg.checkpoint_F_animal, inf_cfg.checkpoint_M_animal, crop_cfg.xpose_ckpt_path,
+                # features computed at another precision, on another device or with another backend differ
+                flag_use_half_precision=inf_cfg.flag_use_half_precision, device=self.live_portrait_wrapper_animal.device, render_backend=inf_cfg.render_backend,
+                flag_do_crop=inf_cfg.flag_do_crop, flag_pasteback=flag_pasteback, animal_face_type=crop_cfg.animal_face_type,
+                dsize=crop_cfg.dsize, scale=crop_cfg.scale, vx_ratio=crop_cfg.vx_ratio, vy_ratio=crop_cfg.vy_ratio,
+                flag_do_rot=crop_cfg.flag_do_rot,
+            )
+            source_info = self.source_cache.get(source_key)
+            if source_info is not None:
+                log("Load prepared source from cache")
+                return source_info
+
+        crop_info = None
+        if inf_cfg.flag_do_crop:
+            crop_info = self.cropper.crop_source_image(img_rgb, crop_cfg)
+            if crop_info is None:
+                raise Exception("No animal face detected in the source image!")
+            img_crop_256x256 = crop_info['img_crop_256x256']
+        else:
+            img_crop_256x256 = cv2.resize(img_rgb, (256, 256))  # force to resize to 256x256
+        I_s = self.live_portrait_wrapper_animal.prepare_source(img_crop_256x256)
+        x_s_info = self.live_portrait_wrapper_animal.get_kp_info(I_s)
+        f_s = self.live_portrait_wrapper_animal.extract_feature_3d(I_s)
+        x_s = self.live_portrait_wrapper_animal.transform_keypoint(x_s_info)
+
+        mask_ori_float = None
+        if flag_pasteback:
+            mask_ori_float = prepare_paste_back(inf_cfg.mask_crop, crop_info['M_c2o'], dsize=(img_rgb.shape[1], img_rgb.shape[0]))
+
+        source_info = {
+            'crop_info': crop_info,
+            'x_s_info': x_s_info,
+            'f_s': f_s,
+            'x_s': x_s,
+            'mask_ori_float': mask_ori_float,
+        }
+        if self.source_cache is not None:
+            source_info = self.source_cache.put(source_key, source_info)
+        return source_info
+
+    def report_progress(self, fraction, description):
+        if self.progress_callback is not None:
+            self.progress_callback(fraction, description)
+
+    def iter_frames(self, source_rgb, source_info, motion_chunks):
+        """
+        render the source driven by an iterable of MotionSequence chunks, yields the frames of every block of
+        frames_per_batch driving frames as a list of HxWx3 RGB images, pasted back to the source image if enabled.
+        The motion is relative to the first frame of the first chunk, the chunks can be generated while the
+        previous ones are rendered.
+        """
+        inf_cfg = self.live_portrait_wrapper_animal.inference_cfg
+        device = self.live_portrait_wrapper_animal.device
+        frames_per_batch = max(1, inf_cfg.frames_per_batch)
+        crop_info = source_info['crop_info']
+        x_s_info, f_s, x_s = source_info['x_s_info'], source_info['f_s'], source_info['x_s']
+
+        paste_back_engine = None
+        if inf_cfg.flag_pasteback and inf_cfg.flag_do_crop and inf_cfg.flag_stitching:
+            paste_back_engine = PasteBack(crop_info['M_c2o'], source_rgb, source_info['mask_ori_float'], num_workers=inf_cfg.paste_back_num_workers)
+            log("Prepared pasteback mask done.")
 
-    def execute(self, args: ArgumentConfig):
+        def driving_keypoint_blocks():
+            # driving keypoints of every motion chunk in one vectorized pass, animals always follow the relative
+            # motion of all keypoints with the source scale and the motion multiplier
+            motion_0 = None
+            for motion_chunk in motion_chunks:
+                driving_motion = dct2device(motion_chunk.stacked(), device)
+                if motion_0 is None:
+                    motion_0 = {k: v[:1] for k, v in driving_motion.items()}
+                x_d_chunk = self.live_portrait_wrapper_animal.calc_driving_keypoints(
+                    x_s_info, x_s, driving_motion, motion_0,
+                    animation_region="all",
+                    lip_indices=(),
+                    flag_relative_scale=False,
+                    flag_motion_multiplier=True,
+                )
+                for i in range(0, x_d_chunk.shape[0], frames_per_batch):
+                    yield x_d_chunk[i:i + frames_per_batch]
+
+        # the source-dependent part of W is shared by all the frames
+        warp_source = self.live_portrait_wrapper_animal.prepare_warp_source(f_s, x_s)
+
+        try:
+            for x_d_i in driving_keypoint_blocks():
+                if not inf_cfg.flag_stitching:
+                    pass
+                else:
+                    x_d_i = self.live_portrait_wrapper_animal.stitching(x_s, x_d_i)
+
+                x_d_i = x_s + (x_d_i - x_s) * inf_cfg.driving_multiplier
+
+                # warp and decode a block of frames in one go
+                out = self.live_portrait_wrapper_animal.warp_decode(f_s, x_s, x_d_i, warp_source=warp_source)
+                I_p_blk = self.live_portrait_wrapper_animal.parse_output(out['out'])
+                if paste_back_engine is not None:
+                    I_p_blk = paste_back_engine.paste_back_batch(I_p_blk)
+                yield I_p_blk
+        finally:
+            if paste_back_engine is not None:
+                paste_back_engine.close()
+
+    def execute(self, args: ArgumentConfig, motion_seq: MotionSequence = None):
+        """animate `args.reference` with the audio `args.audio`, `motion_seq` is the motion sequence of the audio if it was generated beforehand"""
         inf_cfg = self.live_portrait_wrapper_animal.inference_cfg
         device = self.live_portrait_wrapper_animal.device
         crop_cfg = self.cropper.crop_cfg
@@ -54,101 +175,69 @@ class LivePortraitPipelineAnimal(object):
             raise Exception(f"Unknown reference image format: {args.reference}")
 
         ######## generate motion sequence ########
-        driving_template_dct = self.live_portrait_wrapper_animal.gen_motion_sequence(args)
-        n_frames = driving_template_dct['n_frames']
-
-        ######## prepare for pasteback ########
-        I_p_pstbk_lst = None
-        if inf_cfg.flag_pasteback and inf_cfg.flag_do_crop and inf_cfg.flag_stitching:
-            I_p_pstbk_lst = []
-            log("Prepared pasteback mask done.")
+        self.report_progress(0., 'Generating motions')
+        motion_path = osp.join(args.output_dir, f'{basename(args.audio)}_motion.npz')
+        if motion_seq is None and args.driving_motion is not None:
+            motion_seq = MotionSequence.load(args.driving_motion)
+            log(f"Load motion sequence from {args.driving_motion}")
+        elif motion_seq is None and args.flag_stream_motion:
+            # the motion chunks are generated while the previous ones are rendered
+            n_frames, motion_chunks = self.live_portrait_wrapper_animal.gen_motion_sequence_stream(args)
+        elif motion_seq is None:
+            motion_seq = self.live_portrait_wrapper_animal.gen_motion_sequence(args)
+            if args.flag_save_motion:
+                mkdir(args.output_dir)
+                motion_seq.save(motion_path)
+        if motion_seq is not None:
+            n_frames, motion_chunks = motion_seq.n_frames, [motion_seq]
+        self.report_progress(0.2, 'Animating')
 
         ######## process source info ########
-        if inf_cfg.flag_do_crop:
-            crop_info = self.cropper.crop_source_image(img_rgb, crop_cfg)
-            if crop_info is None:
-                raise Exception("No animal face detected in the source image!")
-            img_crop_256x256 = crop_info['img_crop_256x256']
-        else:
-            img_crop_256x256 = cv2.resize(img_rgb, (256, 256))  # force to resize to 256x256
-        I_s = self.live_portrait_wrapper_animal.prepare_source(img_crop_256x256)
-        x_s_info = self.live_portrait_wrapper_animal.get_kp_info(I_s)
-        x_c_s = x_s_info['kp']
-        # print("x_c_s.shape: ", x_c_s.shape)
-        R_s = get_rotation_matrix(x_s_info['pitch'], x_s_info['yaw'], x_s_info['roll'])
-        f_s = self.live_portrait_wrapper_animal.extract_feature_3d(I_s)
-        x_s = self.live_portrait_wrapper_animal.transform_keypoint(x_s_info)
+        source_info = self.prepare_source_info(img_rgb)
 
-        if inf_cfg.flag_pasteback and inf_cfg.flag_do_crop and inf_cfg.flag_stitching:
-            mask_ori_float = prepare_paste_back(inf_cfg.mask_crop, crop_info['M_c2o'], dsize=(img_rgb.shape[1], img_rgb.shape[0]))
+        ######## prepare output ########
+        mkdir(args.output_dir)
+        temp_video = osp.join(args.output_dir, f'{basename(args.reference)}_{basename(args.audio)}_temp.mp4')
+        final_video = osp.join(args.output_dir, f'{basename(args.reference)}_{basename(args.audio)}.mp4')
+        writer = None
+        if inf_cfg.video_writer_backend == "ffmpeg":
+            # one ffmpeg process encodes the frames and muxes the audio, no temp video
+            writer = FFmpegPipeWriter(wfp=final_video, fps=inf_cfg.output_fps, audio_fp=args.audio, crf=18)
+        elif inf_cfg.flag_stream_output:
+            writer = VideoWriter(wfp=temp_video, fps=inf_cfg.output_fps, ffmpeg_params=['-crf', '18'])
+        if writer is not None and inf_cfg.flag_stream_output:
+            writer = AsyncVideoWriter(writer, queue_size=inf_cfg.frame_queue_size)
 
         ######## animate ########
+        streamed_chunks = [] if args.flag_save_motion and motion_seq is None else None
+        if streamed_chunks is not None:
+            motion_chunks = record_chunks(motion_chunks, streamed_chunks)
+
         I_p_lst = []
-        for i in track(range(n_frames), description='🚀Animating Image with Generated Motions...', total=n_frames):
-            x_d_i_info = driving_template_dct['motion'][i]
-            x_d_i_info = dct2device(x_d_i_info, device)
-
-            R_d_i = x_d_i_info['R'] if 'R' in x_d_i_info.keys() else x_d_i_info['R_d']  # compatible with previous keys
-            if i == 0:  # cache the first frame
-                R_d_0 = R_d_i
-                x_d_0_info = x_d_i_info
-            R_d_i = (R_d_i @ R_d_0.permute(0, 2, 1)) @ R_s
-
-            # expression
-            # 原始
-            # delta_new = x_d_i_info['exp']
-            delta_new = x_s_info['exp'] + (x_d_i_info['exp'] - x_d_0_info['exp'])
-            # 绝对
-            # delta_new = x_s_info['exp'].clone() # 源图像的exp信息，这里delta_new用于保存源图像变化后的exp
-            # for idx in [1,2,6,11,12,13,14,15,16,17,18,19,20]:
-            #     delta_new[:, idx, :] = x_d_i_info['exp'][:, idx, :]
-            # delta_new[:, 3:5, 1] =  x_d_i_info['exp'][:, 3:5, 1]
-            # delta_new[:, 5, 2] =  x_d_i_info['exp'][:, 5, 2]
-            # delta_new[:, 8, 2] =  x_d_i_info['exp'][:, 8, 2]
-            # delta_new[:, 9, 1:] = x_d_i_info['exp'][:, 9, 1:]
-
-            # scale
-            scale_new = x_s_info['scale']
-
-            # translation
-            # 绝对
-            # t_new = x_d_i_info['t']
-            # 相对
-            t_new = x_s_info['t'] + (x_d_i_info['t'] - x_d_0_info['t'])
-            t_new[..., 2].fill_(0)  # zero tz
-
-            # 公式二
-            x_d_i = scale_new * (x_c_s @ R_d_i + delta_new) + t_new
-
-            if i == 0:
-                x_d_0 = x_d_i
-                motion_multiplier = calc_motion_multiplier(x_s, x_d_0)
-
-            x_d_diff = (x_d_i - x_d_0) * motion_multiplier
-            x_d_i = x_d_diff + x_s
-
-            if not inf_cfg.flag_stitching:
-                pass
-            else:
-                x_d_i = self.live_portrait_wrapper_animal.stitching(x_s, x_d_i)
-
-            x_d_i = x_s + (x_d_i - x_s) * inf_cfg.driving_multiplier
-            out = self.live_portrait_wrapper_animal.warp_decode(f_s, x_s, x_d_i)
-            I_p_i = self.live_portrait_wrapper_animal.parse_output(out['out'])[0]
-            I_p_lst.append(I_p_i)
-
-            if inf_cfg.flag_pasteback and inf_cfg.flag_do_crop and inf_cfg.flag_stitching:
-                I_p_pstbk = paste_back(I_p_i, crop_info['M_c2o'], img_rgb, mask_ori_float)
-                I_p_pstbk_lst.append(I_p_pstbk)
+        n_batches = math.ceil(n_frames / max(1, inf_cfg.frames_per_batch))
+        n_done = 0
+        for I_p_blk in track(self.iter_frames(img_rgb, source_info, motion_chunks), description='🚀Animating Image with Generated Motions...', total=n_batches):
+            for I_p_i in I_p_blk:
+                if writer is not None:
+                    # hand the finished frame to the encoder instead of keeping it
+                    writer.write(I_p_i)
+                else:
+                    I_p_lst.append(I_p_i)
+            n_done += len(I_p_blk)
+            self.report_progress(0.2 + 0.75 * min(n_done, n_frames) / n_frames, 'Animating')
+
+        if streamed_chunks is not None:
+            MotionSequence.concatenate(streamed_chunks).save(motion_path)
+
+        if inf_cfg.flag_latency_report:
+            self.live_portrait_wrapper_animal.latency_report()
 
         # save the animated result
-        if not os.path.exists(args.output_dir):
-            mkdir(args.output_dir)
-        temp_video = osp.join(args.output_dir, f'{basename(args.reference)}_{basename(args.audio)}_temp.mp4')
-        if I_p_pstbk_lst is not None and len(I_p_pstbk_lst) > 0:
-            images2video(I_p_pstbk_lst, wfp=temp_video, fps=inf_cfg.output_fps)
+        self.report_progress(0.95, 'Writing the video')
+        if writer is not None:
+            writer.close()
         else:
             images2video(I_p_lst, wfp=temp_video, fps=inf_cfg.output_fps)
-        final_video = osp.join(args.output_dir, f'{basename(args.reference)}_{basename(args.audio)}.mp4')
-        add_audio_to_video(temp_video, args.audio, final_video)
+        if inf_cfg.video_writer_backend != "ffmpeg":
+            add_audio_to_video(temp_video, args.audio, final_video)
         return final_video
\ No newline at end of file
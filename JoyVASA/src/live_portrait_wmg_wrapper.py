@@ -7,6 +7,8 @@ Wrappers for LivePortrait core functions
 import contextlib
 import os.path as osp
 import os
+import time
+import threading
 import pickle
 import numpy as np
 import cv2
@@ -15,15 +17,25 @@ import yaml
 import math
 import librosa
 import torch.nn.functional as F
-from rich.progress import track
 
-from .utils.timer import Timer
-from .utils.helper import load_model, concat_feat
+from .utils.timer import Timer, ModuleTimer
+from .utils.helper import load_model, concat_feat, calc_motion_multiplier, ParallelLoader
 from .utils.camera import headpose_pred_to_degree, get_rotation_matrix
 from .utils.retargeting_utils import calc_eye_close_ratio, calc_lip_close_ratio
 from .config.inference_config import InferenceConfig
 from .utils.rprint import rlog as log
-from .utils.filter import smooth_
+from .utils.filter import smooth_, OnlineMotionSmoother
+from .utils.motion import MotionSequence
+from .utils.cache import AudioFeatureCache
+from .utils.onnx_backend import OnnxModule, load_onnx_module
+from .utils.quantization import quantize_dynamic_linear, load_static_spade
+from .utils.registry import load_shared
+
+
+LIP_INDICES = (6, 12, 14, 17, 19, 20)  # implicit keypoints driven absolutely by the generated lip motion
+RENDER_MODULES = ('appearance_feature_extractor', 'motion_extractor', 'warping_module', 'spade_generator')
+RETARGETING_MODULES = ('stitching', 'lip', 'eye')
+DEFERRED = object()  # placeholder of a module loaded on its first use
 
 
 class LivePortraitWrapper(object):
@@ -31,9 +43,10 @@ class LivePortraitWrapper(object):
     Wrapper for Human
     """
 
-    def __init__(self, inference_cfg: InferenceConfig):
+    def __init__(self, inference_cfg: InferenceConfig, registry=None):
 
         self.inference_cfg = inference_cfg
+        self.registry = registry  # optional ModelRegistry shared with other pipelines of the process
         self.device_id = inference_cfg.device_id
         self.compile = inference_cfg.flag_do_torch_compile
         if inference_cfg.flag_force_cpu:
@@ -49,37 +62,18 @@ class LivePortraitWrapper(object):
         
 
 
-        model_config = yaml.load(open(inference_cfg.models_config, 'r'), Loader=yaml.SafeLoader)
-        # init F
-        self.appearance_feature_extractor = load_model(inference_cfg.checkpoint_F, model_config, self.device, 'appearance_feature_extractor')
-        log(f'Load appearance_feature_extractor from {osp.realpath(inference_cfg.checkpoint_F)} done.')
-        # init M
-        self.motion_extractor = load_model(inference_cfg.checkpoint_M, model_config, self.device, 'motion_extractor')
-        log(f'Load motion_extractor from {osp.realpath(inference_cfg.checkpoint_M)} done.')
-        # init W
-        self.warping_module = load_model(inference_cfg.checkpoint_W, model_config, self.device, 'warping_module')
-        log(f'Load warping_module from {osp.realpath(inference_cfg.checkpoint_W)} done.')
-        # init G
-        self.spade_generator = load_model(inference_cfg.checkpoint_G, model_config, self.device, 'spade_generator')
-        log(f'Load spade_generator from {osp.realpath(inference_cfg.checkpoint_G)} done.')
-        # init S and R
-        if inference_cfg.checkpoint_S is not None and osp.exists(inference_cfg.checkpoint_S):
-            self.stitching_retargeting_module = load_model(inference_cfg.checkpoint_S, model_config, self.device, 'stitching_retargeting_module')
-            log(f'Load stitching_retargeting_module from {osp.realpath(inference_cfg.checkpoint_S)} done.')
-        else:
-            self.stitching_retargeting_module = None
+        self.model_suffix = ''
+        self.load_models(inference_cfg.checkpoint_F, inference_cfg.checkpoint_M, inference_cfg.checkpoint_W,
+                         inference_cfg.checkpoint_G, inference_cfg.checkpoint_S)
         # Optimize for inference
         if self.compile:
             torch._dynamo.config.suppress_errors = True  # Suppress errors and fall back to eager execution
             self.warping_module = torch.compile(self.warping_module, mode='max-autotune')
             self.spade_generator = torch.compile(self.spade_generator, mode='max-autotune')
 
-        self.model_config = model_config
         self.timer = Timer()
 
         # Motion Genertor
-        self.motion_generator, self.motion_generator_args = load_model(inference_cfg.checkpoint_MotionGenerator, model_config, self.device, 'motion_generator')
-        log(f'Load motion_generator from {osp.realpath(inference_cfg.checkpoint_MotionGenerator)} done.')
         self.n_motions = self.motion_generator_args.n_motions
         self.n_prev_motions = self.motion_generator_args.n_prev_motions
         self.fps = self.motion_generator_args.fps
@@ -88,7 +82,150 @@ class LivePortraitWrapper(object):
         self.pad_mode = self.motion_generator_args.pad_mode
         self.use_indicator = self.motion_generator_args.use_indicator
         self.templete_dict = pickle.load(open(inference_cfg.motion_template_path, 'rb'))
-
+        if inference_cfg.quantization != "none":
+            self.setup_quantization()
+        if inference_cfg.render_backend == "onnx":
+            self.setup_render_onnx()
+        if inference_cfg.flag_latency_report:
+            self.setup_latency_report()
+        if self._stitching_retargeting_module is not None and self._stitching_retargeting_module is not DEFERRED:
+            self._stitching_retargeting_module = self.setup_stitching_retargeting_module(self._stitching_retargeting_module)
+
+
+    def load_models(self, checkpoint_F, checkpoint_M, checkpoint_W, checkpoint_G, checkpoint_S):
+        """load F, M, W, G, S and the motion generator in parallel threads and report the load time of each one,
+        S is deferred to its first use when neither stitching nor retargeting is enabled.
+        The motion generator and S come from the registry if there is one"""
+        inference_cfg = self.inference_cfg
+        start_time = time.time()
+        self.model_config = yaml.load(open(inference_cfg.models_config, 'r'), Loader=yaml.SafeLoader)
+        checkpoints = {
+            'appearance_feature_extractor': checkpoint_F,
+            'motion_extractor': checkpoint_M,
+            'warping_module': checkpoint_W,
+            'spade_generator': checkpoint_G,
+        }
+        loader = ParallelLoader(inference_cfg.load_num_workers)
+        loader.submit('motion_generator', load_shared, self.registry,
+                      ('motion_generator', inference_cfg.checkpoint_MotionGenerator, self.device, inference_cfg.quantization, inference_cfg.motion_generator_backend),
+                      self.load_motion_generator)
+        for name, ckpt_path in checkpoints.items():
+            loader.submit(name, load_model, ckpt_path, self.model_config, self.device, name)
+
+        self.checkpoint_S = checkpoint_S
+        self.lazy_load_lock = threading.Lock()
+        if checkpoint_S is None or not osp.exists(checkpoint_S):
+            self._stitching_retargeting_module = None
+        elif inference_cfg.flag_stitching or inference_cfg.flag_eye_retargeting or inference_cfg.flag_lip_retargeting:
+            loader.submit('stitching_retargeting_module', self.load_stitching_retargeting_module)
+        else:
+            self._stitching_retargeting_module = DEFERRED
+            log('Defer loading stitching_retargeting_module to its first use.')
+
+        for name, ckpt_path in checkpoints.items():
+            setattr(self, name, loader.result(name))
+            log(f'Load {name} from {osp.realpath(ckpt_path)} done.')
+        if 'stitching_retargeting_module' in loader.futures:
+            self._stitching_retargeting_module = loader.result('stitching_retargeting_module')
+            log(f'Load stitching_retargeting_module from {osp.realpath(checkpoint_S)} done.')
+        self.motion_generator, self.motion_generator_args = loader.result('motion_generator')
+        log(f'Load motion_generator from {osp.realpath(inference_cfg.checkpoint_MotionGenerator)} done.')
+        loader.shutdown()
+        loader.report(type(self).__name__, time.time() - start_time)
+
+    @property
+    def stitching_retargeting_module(self):
+        """S and R, loaded here on the first use if `load_models` deferred it"""
+        if self._stitching_retargeting_module is DEFERRED:
+            with self.lazy_load_lock:
+                if self._stitching_retargeting_module is DEFERRED:
+                    start_time = time.time()
+                    stitching_retargeting_module = self.load_stitching_retargeting_module()
+                    self._stitching_retargeting_module = self.setup_stitching_retargeting_module(stitching_retargeting_module)
+                    log(f'Load stitching_retargeting_module from {osp.realpath(self.checkpoint_S)} done, load time: {time.time() - start_time:.3f}s')
+        return self._stitching_retargeting_module
+
+    def load_stitching_retargeting_module(self):
+        return load_shared(self.registry, ('stitching_retargeting_module', self.checkpoint_S, self.device),
+                           load_model, self.checkpoint_S, self.model_config, self.device, 'stitching_retargeting_module')
+
+    def load_motion_generator(self):
+        """motion generator with the quantization and the backend of the config"""
+        inference_cfg = self.inference_cfg
+        motion_generator, motion_generator_args = load_model(inference_cfg.checkpoint_MotionGenerator, self.model_config, self.device, 'motion_generator')
+        if inference_cfg.quantization != "none" and self.device == 'cpu':
+            motion_generator.denoising_net = quantize_dynamic_linear(motion_generator.denoising_net)
+            motion_generator.audio_encoder = quantize_dynamic_linear(motion_generator.audio_encoder)
+            log('Quantize the Linear layers of the motion generator to int8 done.')
+        if inference_cfg.motion_generator_backend == "onnx":
+            self.setup_motion_generator_onnx(motion_generator)
+        return motion_generator, motion_generator_args
+
+    def setup_stitching_retargeting_module(self, stitching_retargeting_module):
+        """apply the quantization, onnxruntime backend and latency timers of the config to the stitching/retargeting MLPs,
+        the torch modules may be shared with other wrappers so the result is a new dict"""
+        inference_cfg = self.inference_cfg
+        stitching_retargeting_module = dict(stitching_retargeting_module)
+        for name in RETARGETING_MODULES:
+            module = stitching_retargeting_module[name]
+            if inference_cfg.quantization != "none" and self.device == 'cpu':
+                module = quantize_dynamic_linear(module)
+            if inference_cfg.render_backend == "onnx":
+                onnx_module = load_onnx_module(inference_cfg.onnx_dir, f'stitching_retargeting_{name}{self.model_suffix}', self.device, inference_cfg.onnx_num_threads)
+                if onnx_module is not None:
+                    module = onnx_module
+            if inference_cfg.flag_latency_report:
+                module = ModuleTimer(module, self.device)
+                self.module_timers[f'stitching_retargeting_{name}'] = module
+            stitching_retargeting_module[name] = module
+        return stitching_retargeting_module
+
+    def setup_quantization(self):
+        """int8 cpu inference: static quantization of the convs of G with `<quantization_dir>/spade_generator<model_suffix>.pth`
+        in the "static" mode. The motion generator and the stitching/retargeting MLPs are quantized in
+        `load_motion_generator` and `setup_stitching_retargeting_module`"""
+        inference_cfg = self.inference_cfg
+        if self.device != 'cpu':
+            log(f'int8 quantization runs on cpu only, ignore quantization={inference_cfg.quantization} on {self.device}.')
+            return
+        if inference_cfg.quantization == "static":
+            spade_generator = load_static_spade(self.spade_generator, osp.join(inference_cfg.quantization_dir, f'spade_generator{self.model_suffix}.pth'))
+            if spade_generator is not None:
+                self.spade_generator = spade_generator
+
+    def setup_motion_generator_onnx(self, motion_generator):
+        """run the denoiser and the audio encoder of the motion generator with onnxruntime, each one falls back to torch if its graph is missing"""
+        inference_cfg = self.inference_cfg
+        denoising_net = load_onnx_module(inference_cfg.onnx_dir, 'denoising_net', self.device, inference_cfg.onnx_num_threads)
+        if denoising_net is not None:
+            motion_generator.denoising_net = denoising_net
+        motion_generator.audio_feature_runner = load_onnx_module(inference_cfg.onnx_dir, 'audio_encoder', self.device, inference_cfg.onnx_num_threads)
+
+    def setup_render_onnx(self):
+        """run F, M, W and G with onnxruntime, a module whose graph is missing stays in torch.
+        The stitching/retargeting MLPs are switched in `setup_stitching_retargeting_module`"""
+        inference_cfg = self.inference_cfg
+        for name in RENDER_MODULES:
+            module = load_onnx_module(inference_cfg.onnx_dir, f'{name}{self.model_suffix}', self.device, inference_cfg.onnx_num_threads)
+            if module is not None:
+                setattr(self, name, module)
+
+    def setup_latency_report(self):
+        """time every call of F, M, W, G and the stitching/retargeting MLPs, see `latency_report`"""
+        self.module_timers = {}
+        for name in RENDER_MODULES:
+            self.module_timers[name] = ModuleTimer(getattr(self, name), self.device)
+            setattr(self, name, self.module_timers[name])
+
+    def latency_report(self, clear=True):
+        """log the latency of every timed module since the last report"""
+        for name, timer in getattr(self, 'module_timers', {}).items():
+            if timer.calls == 0:
+                continue
+            backend = 'onnxruntime' if isinstance(timer.module, OnnxModule) else 'torch'
+            log(f'{name:<32s} {backend:<12s} {timer.calls:6d} calls {timer.total_time * 1000:10.1f} ms {timer.total_time * 1000 / timer.calls:8.2f} ms/call')
+            if clear:
+                timer.clear()
 
     def inference_ctx(self):
         if self.device == "mps":
@@ -281,7 +418,9 @@ class LivePortraitWrapper(object):
 
         if self.stitching_retargeting_module is not None:
 
-            bs, num_kp = kp_source.shape[:2]
+            bs, num_kp = kp_driving.shape[:2]
+            if kp_source.shape[0] != bs:
+                kp_source = kp_source.expand(bs, -1, -1)
 
             kp_driving_new = kp_driving.clone()
             delta = self.stitch(kp_source, kp_driving_new)
@@ -296,19 +435,103 @@ class LivePortraitWrapper(object):
 
         return kp_driving
 
-    def warp_decode(self, feature_3d: torch.Tensor, kp_source: torch.Tensor, kp_driving: torch.Tensor) -> torch.Tensor:
+    def calc_driving_keypoints(self, x_s_info: dict, x_s: torch.Tensor, motion: dict, motion_0: dict = None, *,
+                               animation_region: str = 'all', lip_indices=LIP_INDICES, flag_relative_scale: bool = True,
+                               flag_motion_multiplier: bool = False) -> torch.Tensor:
+        """ compute the driving keypoints of a whole motion sequence in one vectorized pass
+        x_s_info: the implicit keypoint information of the source image, batch size 1
+        x_s: 1xNx3, the transformed source keypoints
+        motion: stacked driving motion, exp: TxNx3, R: Tx3x3, scale: Tx1, t: Tx3
+        motion_0: the first driving frame that relative motion refers to, default to the first frame of `motion`
+        animation_region: "all", "exp", "pose", "lip" or "eyes"
+        lip_indices: keypoints whose expression is taken directly from the driving motion
+        flag_relative_scale: whether to rescale the source by the driving scale relative to motion_0
+        flag_motion_multiplier: whether to adapt the motion by the expression-friendly multiplier
+        return: TxNx3
+        """
+        lip_indices = list(lip_indices)
+
+        if motion_0 is None:
+            motion_0 = {k: v[:1] for k, v in motion.items()}
+        R_d_0 = motion_0['R'] if 'R' in motion_0 else motion_0['R_d']  # compatible with previous keys
+        x_c_s = x_s_info['kp']
+        R_s = get_rotation_matrix(x_s_info['pitch'], x_s_info['yaw'], x_s_info['roll'])
+
+        def _transform(m):
+            n = m['exp'].shape[0]
+            # R
+            R_d = m['R'] if 'R' in m else m['R_d']
+            if animation_region == "all" or animation_region == "pose":
+                R_new = (R_d @ R_d_0.permute(0, 2, 1)) @ R_s
+            else:
+                R_new = R_s
+
+            # delta
+            exp_rel = x_s_info['exp'] + (m['exp'] - motion_0['exp'])
+            if animation_region == "all" or animation_region == "exp":
+                delta_new = exp_rel
+                if len(lip_indices) > 0:
+                    delta_new[:, lip_indices, :] = m['exp'][:, lip_indices, :]
+            elif animation_region == "lip":
+                delta_new = x_s_info['exp'].repeat(n, 1, 1)
+                if len(lip_indices) > 0:
+                    delta_new[:, lip_indices, :] = exp_rel[:, lip_indices, :]
+            else:
+                delta_new = x_s_info['exp']
+
+            # scale
+            if flag_relative_scale:
+                scale_new = x_s_info['scale'] * (m['scale'] / motion_0['scale'])
+            else:
+                scale_new = x_s_info['scale'].expand(n, -1)
+
+            # translation
+            t_new = x_s_info['t'] + (m['t'] - motion_0['t'])
+            t_new[..., 2].fill_(0)  # zero tz
+
+            # Eqn.2: s * (x_c,s @ R + exp) + t
+            return scale_new.view(n, 1, 1) * (x_c_s @ R_new + delta_new) + t_new.view(n, 1, 3)
+
+        x_d_new = _transform(motion)
+        if flag_motion_multiplier:
+            x_d_0_new = _transform(motion_0)
+            motion_multiplier = calc_motion_multiplier(x_s, x_d_0_new)
+            x_d_new = (x_d_new - x_d_0_new) * motion_multiplier + x_s
+
+        return x_d_new
+
+    def prepare_warp_source(self, feature_3d: torch.Tensor, kp_source: torch.Tensor):
+        """ the source-conditioned inputs of W for `warp_decode`: compressed feature, identity grid and source heatmaps,
+        computed once for a source driven by many frames. None if W runs with onnxruntime
+        feature_3d: 1x32x16x64x64, feature volume
+        kp_source: 1xNx3
+        """
+        if not hasattr(self.warping_module, 'prepare_source'):
+            return None
+        with torch.no_grad(), self.inference_ctx():
+            return self.warping_module.prepare_source(feature_3d, kp_source)
+
+    def warp_decode(self, feature_3d: torch.Tensor, kp_source: torch.Tensor, kp_driving: torch.Tensor, warp_source=None) -> torch.Tensor:
         """ get the image after the warping of the implicit keypoints
-        feature_3d: Bx32x16x64x64, feature volume
-        kp_source: BxNx3
+        feature_3d: Bx32x16x64x64 or 1x32x16x64x64, feature volume
+        kp_source: BxNx3 or 1xNx3
         kp_driving: BxNx3
+        warp_source: output of `prepare_warp_source` for feature_3d and kp_source, optional
         """
+        # a single source is shared by a block of driving frames, W takes it as is with a prepared source
+        bs = kp_driving.shape[0]
+        if feature_3d.shape[0] != bs and warp_source is None:
+            feature_3d = feature_3d.expand(bs, -1, -1, -1, -1)
+        if kp_source.shape[0] != bs:
+            kp_source = kp_source.expand(bs, -1, -1)
+
         # The line 18 in Algorithm 1: D(W(f_s; x_s, x′_d,i)）
         with torch.no_grad(), self.inference_ctx():
             if self.compile:
                 # Mark the beginning of a new CUDA Graph step
                 torch.compiler.cudagraph_mark_step_begin()
             # get decoder input
-            ret_dct = self.warping_module(feature_3d, kp_source=kp_source, kp_driving=kp_driving)
+            ret_dct = self.warping_module(feature_3d, kp_source=kp_source, kp_driving=kp_driving, source=warp_source)
             # decode
             ret_dct['out'] = self.spade_generator(feature=ret_dct['out'])
 
@@ -322,9 +545,9 @@ class LivePortraitWrapper(object):
 
     def parse_output(self, out: torch.Tensor) -> np.ndarray:
         """ construct the output as standard
-        return: 1xHxWx3, uint8
+        return: BxHxWx3, uint8
         """
-        out = np.transpose(out.data.cpu().numpy(), [0, 2, 3, 1])  # 1x3xHxW -> 1xHxWx3
+        out = np.transpose(out.data.cpu().numpy(), [0, 2, 3, 1])  # Bx3xHxW -> BxHxWx3
         out = np.clip(out, 0, 1)  # clip to 0~1
         out = np.clip(out * 255, 0, 255).astype(np.uint8)  # 0~1 -> 0~255
 
@@ -356,19 +579,65 @@ class LivePortraitWrapper(object):
         combined_lip_ratio_tensor = torch.cat([c_s_lip_tensor, c_d_lip_i_tensor], dim=1) # 1x2
         return combined_lip_ratio_tensor
     
-    def gen_motion_sequence(self, args):
-       # preprocess audio
-        log(f"start loading audio from {args.audio}")
-        audio, _ = librosa.load(args.audio, sr=16000, mono=True)
-        log(f"audio loaded! {audio.shape}")
-        if isinstance(audio, np.ndarray):
-            audio = torch.from_numpy(audio).to(self.device)
+    def load_audio(self, audio_fp):
+        """load the audio at 16k, returns the raw waveform and the normalized 1D tensor on the device"""
+        log(f"start loading audio from {audio_fp}")
+        audio_raw, _ = librosa.load(audio_fp, sr=16000, mono=True)
+        log(f"audio loaded! {audio_raw.shape}")
+        audio = torch.from_numpy(audio_raw).to(self.device)
         assert audio.ndim == 1, 'Audio must be 1D tensor.'
         audio_mean, audio_std = torch.mean(audio), torch.std(audio)
         audio = (audio - audio_mean) / (audio_std + 1e-5)
-        log(f"loading audio from: {args.audio}")
+        return audio_raw, audio
+
+    def pad_audio(self, audio, n_frames):
+        """pad the normalized audio to n_frames frames according to pad_mode"""
+        n_padding_audio_samples = round(self.audio_unit * n_frames) - len(audio)
+        if n_padding_audio_samples > 0:
+            if self.pad_mode == 'zero':
+                padding_value = 0
+            elif self.pad_mode == 'replicate':
+                padding_value = audio[-1]
+            else:
+                raise ValueError(f'Unknown pad mode: {self.pad_mode}')
+            audio = F.pad(audio, (0, n_padding_audio_samples), value=padding_value)
+        return audio
 
-        # crop audio into n_subdivision according to n_motions 
+    def window_audio_features(self, args, audio, window_starts, audio_feat_cache=None):
+        """
+        per-window audio features (1, n_motions, feature_dim) taken from the cache or from a clip-level encoding,
+        None for the windows the caller has to encode. Also returns which windows came from the cache.
+        """
+        audio_feat_lst = [None] * len(window_starts)
+        if audio_feat_cache is not None:
+            audio_feat_lst = [audio_feat_cache.get(i, self.device) for i in range(len(window_starts))]
+        flag_feat_cached = [audio_feat is not None for audio_feat in audio_feat_lst]
+        if args.audio_encode_mode == "clip" and not all(flag_feat_cached):
+            n_frames = window_starts[-1] + self.n_motions
+            audio_feat_all = self.motion_generator.extract_audio_feature_clip(audio.unsqueeze(0), n_frames,
+                                                                              chunk_frames=args.audio_encode_chunk_windows * self.n_motions)
+            audio_feat_lst = [audio_feat_all[:, start:start + self.n_motions] for start in window_starts]
+        return audio_feat_lst, flag_feat_cached
+
+    def check_sample_steps(self, args):
+        """fail before sampling if a number of DDIM steps is out of [1, num_steps] of the diffusion schedule"""
+        num_steps = self.motion_generator.diffusion_sched.num_steps
+        steps = {}
+        if args.sampler == "ddim":
+            steps['sample_steps'] = args.sample_steps
+        if args.window_mode == "parallel":
+            steps['parallel_coarse_steps'] = args.parallel_coarse_steps
+        for name, n_steps in steps.items():
+            if not 1 <= n_steps <= num_steps:
+                raise ValueError(f'{name} must be in [1, {num_steps}], the number of diffusion steps of the motion generator, got {n_steps}')
+
+    def gen_motion_coef_sequential(self, args, audio, audio_feat_cache=None):
+        """generate the windows one after another, each one conditioned on the motion of the previous one"""
+        return torch.cat(list(self.iter_motion_coef_sequential(args, audio, audio_feat_cache)), dim=0)
+
+    def iter_motion_coef_sequential(self, args, audio, audio_feat_cache=None):
+        """yield the motion coefficients (n, 70) of every window as soon as it is sampled, without the padded frames"""
+        # crop audio into n_subdivision according to n_motions
         clip_len = int(len(audio) / 16000 * self.fps)
         stride = self.n_motions
         if clip_len <= self.n_motions:
@@ -379,82 +648,205 @@ class LivePortraitWrapper(object):
         # padding
         n_padding_audio_samples = self.n_audio_samples * n_subdivision - len(audio)
         n_padding_frames = math.ceil(n_padding_audio_samples / self.audio_unit)
-        if n_padding_audio_samples > 0:
-            if self.pad_mode == 'zero':
-                padding_value = 0
-            elif self.pad_mode == 'replicate':
-                padding_value = audio[-1]
-            else:
-                raise ValueError(f'Unknown pad mode: {self.pad_mode}')
-            audio = F.pad(audio, (0, n_padding_audio_samples), value=padding_value)
+        audio = self.pad_audio(audio, self.n_motions * n_subdivision)
+
+        audio_feat_lst, flag_feat_cached = self.window_audio_features(args, audio, [i * stride for i in range(n_subdivision)], audio_feat_cache)
+
+        def _windows():
+            for i in range(0, n_subdivision):
+                start_idx = i * stride
+                end_idx = start_idx + self.n_motions
+                audio_in = audio[round(start_idx * self.audio_unit):round(end_idx * self.audio_unit)].unsqueeze(0)
+                if audio_feat_lst[i] is not None:
+                    audio_in = audio_feat_lst[i]  # sample takes the (1, n_motions, feature_dim) feature as is
+                yield audio_in, n_padding_frames if i == n_subdivision - 1 else 0
 
         # generate motions
-        coef_list = []
-        for i in range(0, n_subdivision):
-            start_idx = i * stride
-            end_idx = start_idx + self.n_motions
+        for i, (motion_coef, audio_feat) in enumerate(self.iter_motion_coef_windows(args, _windows())):
+            if audio_feat_cache is not None and not flag_feat_cached[i]:
+                audio_feat_cache.put(i, audio_feat)
+            yield motion_coef
+
+    def iter_motion_coef_windows(self, args, audio_windows):
+        """
+        sample the windows of an iterable of (audio, n_padding_frames) one after another, each one conditioned on the
+        motion and audio features of the previous one. audio is a (1, n_audio_samples) normalized waveform or a
+        (1, n_motions, feature_dim) feature, its last n_padding_frames frames are padding. The windows can be produced
+        while the motion is sampled, e.g. from a live audio stream, a window following a padded one needs at least
+        n_prev_motions frames of audio in the padded one.
+        yield the motion coefficients (n, 70) of every window without the padded frames, and its audio feature
+        """
+        self.check_sample_steps(args)
+        prev_motion_feat, prev_audio_feat, noise = None, None, None
+        for i, (audio_in, n_padding_frames) in enumerate(audio_windows):
             indicator = torch.ones((1, self.n_motions)).to(self.device) if self.use_indicator else None
-            if indicator is not None and i == n_subdivision - 1 and n_padding_frames > 0:
+            if indicator is not None and n_padding_frames > 0:
                 indicator[:, -n_padding_frames:] = 0
-            audio_in = audio[round(start_idx * self.audio_unit):round(end_idx * self.audio_unit)].unsqueeze(0)
 
             if i == 0:
-                motion_feat, noise, prev_audio_feat = self.motion_generator.sample(audio_in,
+                motion_feat, noise, audio_feat = self.motion_generator.sample(audio_in,
                                                                         indicator=indicator, cfg_mode=args.cfg_mode,
                                                                         cfg_cond=args.cfg_cond, cfg_scale=args.cfg_scale,
-                                                                        dynamic_threshold=0)
+                                                                        dynamic_threshold=0, sampler=args.sampler,
+                                                                        sample_steps=args.sample_steps)
             else:
-                motion_feat, noise, prev_audio_feat = self.motion_generator.sample(audio_in,
+                motion_feat, noise, audio_feat = self.motion_generator.sample(audio_in,
                                                                         prev_motion_feat, prev_audio_feat, noise,
                                                                         indicator=indicator, cfg_mode=args.cfg_mode,
                                                                         cfg_cond=args.cfg_cond, cfg_scale=args.cfg_scale,
-                                                                        dynamic_threshold=0)
-            prev_motion_feat = motion_feat[:, -self.n_prev_motions:].clone()
-            prev_audio_feat = prev_audio_feat[:, -self.n_prev_motions:]
+                                                                        dynamic_threshold=0, sampler=args.sampler,
+                                                                        sample_steps=args.sample_steps)
+            # the next window follows the last frames that are not padding
+            n_real = self.n_motions - n_padding_frames
+            prev_motion_feat = motion_feat[:, n_real - self.n_prev_motions:n_real].clone()
+            prev_audio_feat = audio_feat[:, n_real - self.n_prev_motions:n_real]
 
             motion_coef = motion_feat
-            if i == n_subdivision - 1 and n_padding_frames > 0:
+            if n_padding_frames > 0:
                 motion_coef = motion_coef[:, :-n_padding_frames]  # delete padded frames
-            coef_list.append(motion_coef)
-            motion_coef = torch.cat(coef_list, dim=1)
-            # motion_coef = self.reformat_motion(args, motion_coef)
-
-        motion_coef = motion_coef.squeeze() #.cpu().numpy().astype(np.float32)
-        motion_list = []
-        for idx in track(range(motion_coef.shape[0]), description='🚀Generating Motion Sequence...', total=motion_coef.shape[0]):
-            exp = motion_coef[idx][:63].cpu() * self.templete_dict["std_exp"] + self.templete_dict["mean_exp"]
-            scale = motion_coef[idx][63:64].cpu() * (self.templete_dict["max_scale"] - self.templete_dict["min_scale"]) + self.templete_dict["min_scale"]
-            t = motion_coef[idx][64:67].cpu() * (self.templete_dict["max_t"] - self.templete_dict["min_t"]) + self.templete_dict["min_t"]
-            pitch = motion_coef[idx][67:68].cpu() * (self.templete_dict["max_pitch"] - self.templete_dict["min_pitch"]) + self.templete_dict["min_pitch"]
-            yaw = motion_coef[idx][68:69].cpu() * (self.templete_dict["max_yaw"] - self.templete_dict["min_yaw"]) + self.templete_dict["min_yaw"]
-            roll = motion_coef[idx][69:70].cpu() * (self.templete_dict["max_roll"] - self.templete_dict["min_roll"]) + self.templete_dict["min_roll"]
-
-            R = get_rotation_matrix(pitch, yaw, roll)
-            R = R.reshape(1, 3, 3).cpu().numpy().astype(np.float32)
-            
-            exp = exp.reshape(1, 21, 3).cpu().numpy().astype(np.float32)
-            scale = scale.reshape(1, 1).cpu().numpy().astype(np.float32)
-            t = t.reshape(1, 3).cpu().numpy().astype(np.float32)
-            pitch = pitch.reshape(1, 1).cpu().numpy().astype(np.float32)
-            yaw = yaw.reshape(1, 1).cpu().numpy().astype(np.float32)
-            roll = roll.reshape(1, 1).cpu().numpy().astype(np.float32)
-            
-            motion_list.append({"exp": exp, "scale": scale, "R": R, "t": t, "pitch": pitch, "yaw": yaw, "roll": roll})
-        tgt_motion = {'n_frames': motion_coef.shape[0], 'output_fps': 25, 'motion': motion_list}
+            yield motion_coef.squeeze(0), audio_feat
+
+    def gen_motion_coef_parallel(self, args, audio, audio_feat_cache=None):
+        """
+        generate all windows in one batch. Windows overlap by n_prev_motions frames: a coarse DDIM pass conditioned
+        on the start features gives every window the motion preceding it, the main pass is conditioned on that
+        motion, and the overlaps of the main pass are cross-faded.
+        """
+        self.check_sample_steps(args)
+        clip_len = int(len(audio) / 16000 * self.fps)
+        stride = self.n_motions - self.n_prev_motions
+        n_windows = 1 if clip_len <= self.n_motions else math.ceil((clip_len - self.n_motions) / stride) + 1
+        window_starts = [i * stride for i in range(n_windows)]
+        n_frames = window_starts[-1] + self.n_motions
+        n_padding_frames = n_frames - clip_len
+        audio = self.pad_audio(audio, n_frames)
+
+        # audio features of all windows, the missing ones are encoded in one batch
+        audio_feat_lst, flag_feat_cached = self.window_audio_features(args, audio, window_starts, audio_feat_cache)
+        idx_missing = [i for i, audio_feat in enumerate(audio_feat_lst) if audio_feat is None]
+        if len(idx_missing) > 0:
+            audio_in = torch.stack([audio[round(window_starts[i] * self.audio_unit):round(window_starts[i] * self.audio_unit) + self.n_audio_samples] for i in idx_missing])
+            with torch.no_grad():
+                audio_feat_missing = self.motion_generator.extract_audio_feature(audio_in)
+            for i, audio_feat in zip(idx_missing, audio_feat_missing.split(1, dim=0)):
+                audio_feat_lst[i] = audio_feat
+        if audio_feat_cache is not None:
+            for i in range(n_windows):
+                if not flag_feat_cached[i]:
+                    audio_feat_cache.put(i, audio_feat_lst[i])
+        audio_feat = torch.cat(audio_feat_lst, dim=0)  # (n_windows, n_motions, feature_dim)
+
+        indicator = None
+        if self.use_indicator:
+            indicator = torch.ones((n_windows, self.n_motions), device=self.device)
+            if n_padding_frames > 0:
+                indicator[-1, -n_padding_frames:] = 0
+
+        # the frames preceding window i are the frames [stride - n_prev_motions, stride) of window i - 1
+        def _preceding(feat, start_feat):
+            return torch.cat([start_feat, feat[:-1, stride - self.n_prev_motions:stride]], dim=0)
+
+        prev_audio_feat = _preceding(audio_feat, self.motion_generator.start_audio_feat)
+        noise = torch.randn((1, self.n_motions, self.motion_generator.motion_feat_dim), device=self.device).expand(n_windows, -1, -1)
+        sample_kwargs = dict(indicator=indicator, cfg_mode=args.cfg_mode, cfg_cond=args.cfg_cond, cfg_scale=args.cfg_scale, dynamic_threshold=0)
+
+        motion_feat = None
+        if n_windows > 1:
+            motion_feat, _, _ = self.motion_generator.sample(audio_feat, None, prev_audio_feat, noise, sampler='ddim',
+                                                             sample_steps=args.parallel_coarse_steps, **sample_kwargs)
+        prev_motion_feat = None if motion_feat is None else _preceding(motion_feat, self.motion_generator.start_motion_feat)
+        motion_feat, _, _ = self.motion_generator.sample(audio_feat, prev_motion_feat, prev_audio_feat, noise, sampler=args.sampler,
+                                                         sample_steps=args.sample_steps, **sample_kwargs)
+
+        # cross-fade the overlapping frames of neighbouring windows
+        ramp = torch.arange(1, self.n_prev_motions + 1, device=self.device, dtype=motion_feat.dtype) / (self.n_prev_motions + 1)
+        weight = torch.ones((n_windows, self.n_motions, 1), device=self.device, dtype=motion_feat.dtype)
+        weight[1:, :self.n_prev_motions, 0] = ramp
+        weight[:-1, -self.n_prev_motions:, 0] = 1 - ramp
+        motion_coef = torch.zeros((n_frames, motion_feat.shape[-1]), device=self.device, dtype=motion_feat.dtype)
+        for i, start in enumerate(window_starts):
+            motion_coef[start:start + self.n_motions] += weight[i] * motion_feat[i]
+        return motion_coef[:clip_len]
+
+    def make_audio_feature_cache(self, args, audio_raw):
+        if args.audio_feature_cache_dir is None:
+            return None
+        # the features also go through audio_feature_map, so they depend on the motion generator checkpoint
+        encoder_name = f'{self.motion_generator_args.audio_model}_{self.inference_cfg.checkpoint_MotionGenerator}_{self.n_motions}_{self.fps}_{args.window_mode}'
+        # the int8 encoder (cpu only) and the onnxruntime graph give other features than the float torch encoder
+        encoder_name += f'_{self.inference_cfg.quantization}_{self.device}_{self.inference_cfg.motion_generator_backend}'
+        if args.audio_encode_mode == "clip":
+            encoder_name += f'_clip{args.audio_encode_chunk_windows}'
+        return AudioFeatureCache(args.audio_feature_cache_dir, audio_raw, encoder_name)
+
+    def log_sampler_timing(self):
+        timing = self.motion_generator.timing
+        n_steps = max(timing['n_steps'], 1)
+        log(f"motion generator: {timing['n_steps']} diffusion steps, denoise {timing['denoise'] / n_steps * 1000:.2f} ms/step, "
+            f"update {timing['update'] / n_steps * 1000:.2f} ms/step")
+
+    def gen_motion_sequence(self, args):
+        audio_raw, audio = self.load_audio(args.audio)
+        audio_feat_cache = self.make_audio_feature_cache(args, audio_raw)
+
+        self.motion_generator.flag_timing = args.flag_log_sampler_timing
+        self.motion_generator.reset_timing()
+        if args.window_mode == "parallel":
+            motion_coef = self.gen_motion_coef_parallel(args, audio, audio_feat_cache)
+        else:
+            motion_coef = self.gen_motion_coef_sequential(args, audio, audio_feat_cache)
+        if args.flag_log_sampler_timing:
+            self.log_sampler_timing()
+
+        motion_seq = MotionSequence.from_coef(motion_coef, self.templete_dict, output_fps=25)
 
         if args.is_smooth_motion:
-            tgt_motion = smooth_(tgt_motion, method="ema")
-        return tgt_motion
+            motion_seq = smooth_(motion_seq, method=args.smooth_method, flag_zero_phase=args.flag_zero_phase_smooth,
+                                 observation_variance=args.driving_smooth_observation_variance)
+        return motion_seq
+
+    def gen_motion_sequence_stream(self, args):
+        """
+        number of frames of the audio and an iterator of the motion sequence in chunks, one per window, each one
+        available as soon as its window is sampled so that rendering can start after the first window.
+        The chunks are smoothed causally with the filter state carried across windows. The "parallel" window mode
+        samples all windows together and gives a single chunk.
+        """
+        self.check_sample_steps(args)  # the chunks are sampled lazily
+        audio_raw, audio = self.load_audio(args.audio)
+        audio_feat_cache = self.make_audio_feature_cache(args, audio_raw)
+        n_frames = int(len(audio) / 16000 * self.fps)
+        if args.is_smooth_motion and args.flag_zero_phase_smooth:
+            log('flag_zero_phase_smooth needs the whole motion sequence, the streamed motion is smoothed causally.')
+
+        def _iter_chunks():
+            self.motion_generator.flag_timing = args.flag_log_sampler_timing
+            self.motion_generator.reset_timing()
+            if args.window_mode == "parallel":
+                coef_chunks = iter([self.gen_motion_coef_parallel(args, audio, audio_feat_cache)])
+            else:
+                coef_chunks = self.iter_motion_coef_sequential(args, audio, audio_feat_cache)
+            smoother = None
+            if args.is_smooth_motion:
+                smoother = OnlineMotionSmoother(method=args.smooth_method, observation_variance=args.driving_smooth_observation_variance)
+            for motion_coef in coef_chunks:
+                motion_seq = MotionSequence.from_coef(motion_coef, self.templete_dict, output_fps=25)
+                yield motion_seq if smoother is None else smoother.update(motion_seq)
+            if args.flag_log_sampler_timing:
+                self.log_sampler_timing()
+
+        return n_frames, _iter_chunks()
     
 
 class LivePortraitWrapperAnimal(LivePortraitWrapper):
     """
     Wrapper for Animal
     """
-    def __init__(self, inference_cfg: InferenceConfig):
+    def __init__(self, inference_cfg: InferenceConfig, registry=None):
         # super().__init__(inference_cfg)  # 调用父类的初始化方法
 
         self.inference_cfg = inference_cfg
+        self.registry = registry  # optional ModelRegistry shared with other pipelines of the process
         self.device_id = inference_cfg.device_id
         self.compile = inference_cfg.flag_do_torch_compile
         if inference_cfg.flag_force_cpu:
@@ -468,25 +860,9 @@ class LivePortraitWrapperAnimal(LivePortraitWrapper):
             except:
                     self.device = 'cuda:' + str(self.device_id)
 
-        model_config = yaml.load(open(inference_cfg.models_config, 'r'), Loader=yaml.SafeLoader)
-        # init F
-        self.appearance_feature_extractor = load_model(inference_cfg.checkpoint_F_animal, model_config, self.device, 'appearance_feature_extractor')
-        log(f'Load appearance_feature_extractor from {osp.realpath(inference_cfg.checkpoint_F_animal)} done.')
-        # init M
-        self.motion_extractor = load_model(inference_cfg.checkpoint_M_animal, model_config, self.device, 'motion_extractor')
-        log(f'Load motion_extractor from {osp.realpath(inference_cfg.checkpoint_M_animal)} done.')
-        # init W
-        self.warping_module = load_model(inference_cfg.checkpoint_W_animal, model_config, self.device, 'warping_module')
-        log(f'Load warping_module from {osp.realpath(inference_cfg.checkpoint_W_animal)} done.')
-        # init G
-        self.spade_generator = load_model(inference_cfg.checkpoint_G_animal, model_config, self.device, 'spade_generator')
-        log(f'Load spade_generator from {osp.realpath(inference_cfg.checkpoint_G_animal)} done.')
-        # init S and R
-        if inference_cfg.checkpoint_S_animal is not None and osp.exists(inference_cfg.checkpoint_S_animal):
-            self.stitching_retargeting_module = load_model(inference_cfg.checkpoint_S_animal, model_config, self.device, 'stitching_retargeting_module')
-            log(f'Load stitching_retargeting_module from {osp.realpath(inference_cfg.checkpoint_S_animal)} done.')
-        else:
-            self.stitching_retargeting_module = None
+        self.model_suffix = '_animal'
+        self.load_models(inference_cfg.checkpoint_F_animal, inference_cfg.checkpoint_M_animal, inference_cfg.checkpoint_W_animal,
+                         inference_cfg.checkpoint_G_animal, inference_cfg.checkpoint_S_animal)
 
         # Optimize for inference
         if self.compile:
@@ -497,8 +873,6 @@ class LivePortraitWrapperAnimal(LivePortraitWrapper):
         self.timer = Timer()
 
         # Motion Genertor
-        self.motion_generator, self.motion_generator_args = load_model(inference_cfg.checkpoint_MotionGenerator, model_config, self.device, 'motion_generator')
-        log(f'Load motion_generator from {osp.realpath(inference_cfg.checkpoint_MotionGenerator)} done.')
         self.n_motions = self.motion_generator_args.n_motions
         self.n_prev_motions = self.motion_generator_args.n_prev_motions
         self.fps = self.motion_generator_args.fps
@@ -507,3 +881,11 @@ class LivePortraitWrapperAnimal(LivePortraitWrapper):
         self.pad_mode = self.motion_generator_args.pad_mode
         self.use_indicator = self.motion_generator_args.use_indicator
         self.templete_dict = pickle.load(open(inference_cfg.motion_template_path, 'rb'))
+        if inference_cfg.quantization != "none":
+            self.setup_quantization()
+        if inference_cfg.render_backend == "onnx":
+            self.setup_render_onnx()
+        if inference_cfg.flag_latency_report:
+            self.setup_latency_report()
+        if self._stitching_retargeting_module is not None and self._stitching_retargeting_module is not DEFERRED:
+            self._stitching_retargeting_module = self.setup_stitching_retargeting_module(self._stitching_retargeting_module)
@@ -26,36 +26,56 @@ class DenseMotionNetwork(nn.Module):
         else:
             self.occlusion = None
 
-    def create_sparse_motions(self, feature, kp_driving, kp_source):
-        bs, _, d, h, w = feature.shape  # (bs, 4, 16, 64, 64)
-        identity_grid = make_coordinate_grid((d, h, w), ref=kp_source)  # (16, 64, 64, 3)
-        identity_grid = identity_grid.view(1, 1, d, h, w, 3)  # (1, 1, d=16, h=64, w=64, 3)
-        coordinate_grid = identity_grid - kp_driving.view(bs, self.num_kp, 1, 1, 1, 3)
+    def prepare_source(self, feature, kp_source):
+        """the inputs of `forward` that only depend on the source: the compressed feature, the identity grid and the
+        gaussian heatmaps of the source keypoints, computed once for a source driven by many frames"""
+        feature = self.compress(feature)  # (bs, 4, 16, 64, 64)
+        feature = self.norm(feature)  # (bs, 4, 16, 64, 64)
+        feature = F.relu(feature)  # (bs, 4, 16, 64, 64)
 
-        k = coordinate_grid.shape[1]
+        spatial_size = feature.shape[2:]  # (d=16, h=64, w=64)
+        identity_grid = make_coordinate_grid(spatial_size, ref=kp_source)  # (16, 64, 64, 3)
+        identity_grid = identity_grid.view(1, 1, *spatial_size, 3)  # (1, 1, d=16, h=64, w=64, 3)
+        gaussian_source = kp2gaussian(kp_source, spatial_size=spatial_size, kp_variance=0.01)  # (bs, num_kp, d, h, w)
+
+        return {
+            'feature': feature,
+            'kp_source': kp_source,
+            'identity_grid': identity_grid,
+            'gaussian_source': gaussian_source,
+        }
+
+    def create_sparse_motions(self, identity_grid, kp_driving, kp_source):
+        bs = kp_driving.shape[0]
+        coordinate_grid = identity_grid - kp_driving.view(bs, self.num_kp, 1, 1, 1, 3)
 
         # NOTE: there lacks an one-order flow
-        driving_to_source = coordinate_grid + kp_source.view(bs, self.num_kp, 1, 1, 1, 3)    # (bs, num_kp, d, h, w, 3)
+        driving_to_source = coordinate_grid + kp_source.view(-1, self.num_kp, 1, 1, 1, 3)    # (bs, num_kp, d, h, w, 3)
 
         # adding background feature
-        identity_grid = identity_grid.repeat(bs, 1, 1, 1, 1, 1)
+        identity_grid = identity_grid.expand(bs, -1, -1, -1, -1, -1)
         sparse_motions = torch.cat([identity_grid, driving_to_source], dim=1)  # (bs, 1+num_kp, d, h, w, 3)
         return sparse_motions
 
     def create_deformed_feature(self, feature, sparse_motions):
-        bs, _, d, h, w = feature.shape
-        feature_repeat = feature.unsqueeze(1).unsqueeze(1).repeat(1, self.num_kp+1, 1, 1, 1, 1, 1)      # (bs, num_kp+1, 1, c, d, h, w)
-        feature_repeat = feature_repeat.view(bs * (self.num_kp+1), -1, d, h, w)                         # (bs*(num_kp+1), c, d, h, w)
-        sparse_motions = sparse_motions.view((bs * (self.num_kp+1), d, h, w, -1))                       # (bs*(num_kp+1), d, h, w, 3)
-        sparse_deformed = F.grid_sample(feature_repeat, sparse_motions, align_corners=False)
-        sparse_deformed = sparse_deformed.view((bs, self.num_kp+1, -1, d, h, w))                        # (bs, num_kp+1, c, d, h, w)
+        """
+        sample the feature at the sparse motions of every keypoint in a single grid_sample, the grids of the keypoints
+        (and of the frames when one source feature is shared by the batch) are stacked along the output depth instead
+        of repeating the feature num_kp+1 times
+        feature: (n, c, d, h, w) with n = bs or 1, sparse_motions: (bs, num_kp+1, d, h, w, 3)
+        """
+        bs, _, d, h, w, _ = sparse_motions.shape
+        n, c = feature.shape[:2]
+        sparse_motions = sparse_motions.view(n, -1, h, w, 3)                                            # (n, bs/n*(num_kp+1)*d, h, w, 3)
+        sparse_deformed = F.grid_sample(feature, sparse_motions, align_corners=False)                  # (n, c, bs/n*(num_kp+1)*d, h, w)
+        sparse_deformed = sparse_deformed.view(n, c, -1, self.num_kp+1, d, h, w)                        # (n, c, bs/n, num_kp+1, d, h, w)
+        sparse_deformed = sparse_deformed.permute(0, 2, 3, 1, 4, 5, 6).reshape(bs, self.num_kp+1, c, d, h, w)  # (bs, num_kp+1, c, d, h, w)
 
         return sparse_deformed
 
-    def create_heatmap_representations(self, feature, kp_driving, kp_source):
-        spatial_size = feature.shape[3:]  # (d=16, h=64, w=64)
+    def create_heatmap_representations(self, gaussian_source, kp_driving):
+        spatial_size = gaussian_source.shape[2:]  # (d=16, h=64, w=64)
         gaussian_driving = kp2gaussian(kp_driving, spatial_size=spatial_size, kp_variance=0.01)  # (bs, num_kp, d, h, w)
-        gaussian_source = kp2gaussian(kp_source, spatial_size=spatial_size, kp_variance=0.01)  # (bs, num_kp, d, h, w)
         heatmap = gaussian_driving - gaussian_source  # (bs, num_kp, d, h, w)
 
         # adding background feature
@@ -64,21 +84,23 @@ class DenseMotionNetwork(nn.Module):
         heatmap = heatmap.unsqueeze(2)         # (bs, 1+num_kp, 1, d, h, w)
         return heatmap
 
-    def forward(self, feature, kp_driving, kp_source):
-        bs, _, d, h, w = feature.shape  # (bs, 32, 16, 64, 64)
-
-        feature = self.compress(feature)  # (bs, 4, 16, 64, 64)
-        feature = self.norm(feature)  # (bs, 4, 16, 64, 64)
-        feature = F.relu(feature)  # (bs, 4, 16, 64, 64)
+    def forward(self, feature, kp_driving, kp_source, source=None):
+        """`source` is the output of `prepare_source` for feature and kp_source, it is computed here if None.
+        A source of batch size 1 is shared by all the driving keypoints"""
+        if source is None:
+            source = self.prepare_source(feature, kp_source)
+        bs = kp_driving.shape[0]
+        feature = source['feature']  # (bs or 1, 4, 16, 64, 64)
+        _, _, d, h, w = feature.shape
 
         out_dict = dict()
 
         # 1. deform 3d feature
-        sparse_motion = self.create_sparse_motions(feature, kp_driving, kp_source)  # (bs, 1+num_kp, d, h, w, 3)
+        sparse_motion = self.create_sparse_motions(source['identity_grid'], kp_driving, source['kp_source'])  # (bs, 1+num_kp, d, h, w, 3)
         deformed_feature = self.create_deformed_feature(feature, sparse_motion)  # (bs, 1+num_kp, c=4, d=16, h=64, w=64)
 
         # 2. (bs, 1+num_kp, d, h, w)
-        heatmap = self.create_heatmap_representations(deformed_feature, kp_driving, kp_source)  # (bs, 1+num_kp, 1, d, h, w)
+        heatmap = self.create_heatmap_representations(source['gaussian_source'], kp_driving)  # (bs, 1+num_kp, 1, d, h, w)
 
         input = torch.cat([heatmap, deformed_feature], dim=2)  # (bs, 1+num_kp, c=5, d=16, h=64, w=64)
         input = input.view(bs, -1, d, h, w)  # (bs, (1+num_kp)*c=105, d=16, h=64, w=64)
@@ -1,3 +1,5 @@
+import time
+import contextlib
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -161,6 +163,13 @@ class DitTalkingHead(nn.Module):
             audio_feat_dim = feature_dim
             self.null_audio_feat = nn.Parameter(torch.randn(1, 1, audio_feat_dim)) # 1, 1, 512
 
+        # optional runner (e.g. an onnxruntime session) of `extract_audio_feature` on windows of n_motions frames
+        self.audio_feature_runner = None
+
+        # timing counters of `sample`, per phase of the diffusion steps, only measured when flag_timing is True
+        self.flag_timing = False
+        self.reset_timing()
+
         self.to(device)
 
     @property
@@ -244,6 +253,9 @@ class DitTalkingHead(nn.Module):
 
     def extract_audio_feature(self, audio, frame_num=None):
         frame_num = frame_num or self.n_motions
+        if self.audio_feature_runner is not None and frame_num == self.n_motions \
+                and audio.shape[1] == 16000 * self.n_motions / self.fps:
+            return self.audio_feature_runner(audio)
 
         # # Strategy 1: resample during audio feature extraction
         # hidden_states = self.audio_encoder(pad_audio(audio), self.fps, frame_num=frame_num).last_hidden_state  # (N, L, 768)
@@ -258,10 +270,98 @@ class DitTalkingHead(nn.Module):
         audio_feat = self.audio_feature_map(hidden_states)  # (N, L, feature_dim)
         return audio_feat
 
+    @torch.no_grad()
+    def extract_audio_feature_clip(self, audio, n_frames, chunk_frames=0, overlap_frames=None):
+        """
+        Encode a whole clip at once instead of window by window.
+
+        Args:
+            audio: (1, n_frames * 16000 / fps) normalized and padded audio
+            n_frames: number of motion frames covered by the audio
+            chunk_frames: encode chunks of this many frames to bound the attention cost, 0 for the whole clip
+            overlap_frames: frames of audio context added on both sides of a chunk, default to one second
+
+        Returns:
+            audio_feat: (1, n_frames, feature_dim), windows of it are accepted by `sample` as is
+        """
+        samples_per_frame = audio.shape[1] // n_frames
+        if overlap_frames is None:
+            overlap_frames = self.fps
+        if chunk_frames <= 0:
+            chunk_frames = n_frames
+
+        audio_feat_lst = []
+        for f0 in range(0, n_frames, chunk_frames):
+            f1 = min(f0 + chunk_frames, n_frames)
+            ctx_l = min(overlap_frames, f0)
+            ctx_r = min(overlap_frames, n_frames - f1)
+            audio_chunk = audio[:, (f0 - ctx_l) * samples_per_frame:(f1 + ctx_r) * samples_per_frame]
+            audio_feat = self.extract_audio_feature(audio_chunk, frame_num=ctx_l + f1 - f0 + ctx_r)
+            audio_feat_lst.append(audio_feat[:, ctx_l:ctx_l + f1 - f0])
+        return torch.cat(audio_feat_lst, dim=1)
+
+    def reset_timing(self):
+        self.timing = {'n_steps': 0, 'denoise': 0., 'update': 0.}
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        """accumulate the wall time of the block into self.timing[name] when flag_timing is on"""
+        if not self.flag_timing:
+            yield
+            return
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        tic = time.perf_counter()
+        yield
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        self.timing[name] += time.perf_counter() - tic
+
+    def _guided_prediction(self, guidance, motion_at_t, t, cfg_mode, cfg_scale, dynamic_threshold):
+        """run the denoiser on the unconditional and conditional entries of step t and combine them with CFG"""
+        batch_size = motion_at_t.shape[0]
+        n_entries = guidance.n_entries
+        motion_in, step_in = guidance.fill(motion_at_t, t)
+
+        kwargs = {} if guidance.memory_kv is None else {'memory_kv': guidance.memory_kv}
+        results = self.denoising_net(motion_in, guidance.audio_feat_in, guidance.prev_motion_feat_in,
+                                     guidance.prev_audio_feat_in, step_in, guidance.indicator_in, **kwargs)
+
+        # Apply thresholding if specified
+        if dynamic_threshold:
+            dt_ratio, dt_min, dt_max = dynamic_threshold
+            abs_results = results[:, -self.n_motions:].reshape(batch_size * n_entries, -1).abs()
+            s = torch.quantile(abs_results, dt_ratio, dim=1)
+            s = torch.clamp(s, min=dt_min, max=dt_max)
+            s = s[..., None, None]
+            results = torch.clamp(results, min=-s, max=s)
+
+        results = results.chunk(n_entries)
+
+        # Unconditional target (CFG) or the conditional target (non-CFG)
+        target_theta = results[0][:, -self.n_motions:]
+        # Classifier-free Guidance (optional)
+        for i in range(0, n_entries - 1):
+            if cfg_mode == 'independent':
+                target_theta += cfg_scale[i] * (
+                            results[i + 1][:, -self.n_motions:] - results[0][:, -self.n_motions:])
+            elif cfg_mode == 'incremental':
+                target_theta += cfg_scale[i] * (
+                            results[i + 1][:, -self.n_motions:] - results[i][:, -self.n_motions:])
+            else:
+                raise NotImplementedError(f'Unknown cfg_mode {cfg_mode}')
+        return target_theta
+
     @torch.no_grad()
     def sample(self, audio_or_feat, prev_motion_feat=None, prev_audio_feat=None,
                motion_at_T=None, indicator=None, cfg_mode=None, cfg_cond=None, cfg_scale=1.15, flexibility=0,
-               dynamic_threshold=None, ret_traj=False):
+               dynamic_threshold=None, ret_traj=False, sampler='ddpm', sample_steps=50, eta=0.):
+        """
+        sampler: 'ddpm' runs the ancestral loop over all `num_steps` steps, 'ddim' runs the deterministic (eta=0)
+            DDIM update over `sample_steps` evenly spaced steps of the same schedule
+        ret_traj: return the whole trajectory {t: motion}, moved to cpu step by step. Otherwise only the current
+            motion is kept, on the device.
+        """
         # Check and convert inputs
         batch_size = audio_or_feat.shape[0]
 
@@ -311,77 +411,102 @@ class DitTalkingHead(nn.Module):
         for cond in cfg_cond:
             if cond == 'audio':
                 audio_feat_in.append(audio_feat)
-
-        n_entries = len(audio_feat_in)
-        audio_feat_in = torch.cat(audio_feat_in, dim=0)
-        prev_motion_feat_in = torch.cat([prev_motion_feat] * n_entries, dim=0)
-        prev_audio_feat_in = torch.cat([prev_audio_feat] * n_entries, dim=0)
-        indicator_in = torch.cat([indicator] * n_entries, dim=0) if indicator is not None else None
-
-        traj = {self.diffusion_sched.num_steps: motion_at_T}
-        for t in range(self.diffusion_sched.num_steps, 0, -1):
-            if t > 1:
-                z = torch.randn_like(motion_at_T)
-            else:
-                z = torch.zeros_like(motion_at_T)
-
-            alpha = self.diffusion_sched.alphas[t]
-            alpha_bar = self.diffusion_sched.alpha_bars[t]
-            alpha_bar_prev = self.diffusion_sched.alpha_bars[t - 1]
-            sigma = self.diffusion_sched.get_sigmas(t, flexibility)
-
-            motion_at_t = traj[t]
-            motion_in = torch.cat([motion_at_t] * n_entries, dim=0)
-            step_in = torch.tensor([t] * batch_size, device=self.device)
-            step_in = torch.cat([step_in] * n_entries, dim=0)
-
-            results = self.denoising_net(motion_in, audio_feat_in, prev_motion_feat_in,
-                                         prev_audio_feat_in, step_in, indicator_in)
-
-            # Apply thresholding if specified
-            if dynamic_threshold:
-                dt_ratio, dt_min, dt_max = dynamic_threshold
-                abs_results = results[:, -self.n_motions:].reshape(batch_size * n_entries, -1).abs()
-                s = torch.quantile(abs_results, dt_ratio, dim=1)
-                s = torch.clamp(s, min=dt_min, max=dt_max)
-                s = s[..., None, None]
-                results = torch.clamp(results, min=-s, max=s)
-
-            results = results.chunk(n_entries)
-
-            # Unconditional target (CFG) or the conditional target (non-CFG)
-            target_theta = results[0][:, -self.n_motions:]
-            # Classifier-free Guidance (optional)
-            for i in range(0, n_entries - 1):
-                if cfg_mode == 'independent':
-                    target_theta += cfg_scale[i] * (
-                                results[i + 1][:, -self.n_motions:] - results[0][:, -self.n_motions:])
-                elif cfg_mode == 'incremental':
-                    target_theta += cfg_scale[i] * (
-                                results[i + 1][:, -self.n_motions:] - results[i][:, -self.n_motions:])
-                else:
-                    raise NotImplementedError(f'Unknown cfg_mode {cfg_mode}')
-
+        guidance = GuidanceBatch(motion_at_T, audio_feat_in, prev_motion_feat, prev_audio_feat, indicator)
+        # the audio memory is the same at every step, project it to keys and values once
+        if isinstance(self.denoising_net, DenoisingNetwork):
+            guidance.memory_kv = self.denoising_net.precompute_memory_kv(guidance.prev_audio_feat_in, guidance.audio_feat_in)
+
+        sched = self.diffusion_sched
+        if sampler == 'ddpm':
+            time_steps = list(range(sched.num_steps, -1, -1))
+            t_idx = torch.tensor(time_steps[:-1], device=sched.alphas.device)
+            alpha, alpha_bar, alpha_bar_prev = sched.alphas[t_idx], sched.alpha_bars[t_idx], sched.alpha_bars[t_idx - 1]
+            sigmas = sched.get_sigmas(t_idx, flexibility).tolist()
             if self.target == 'noise':
                 c0 = 1 / torch.sqrt(alpha)
                 c1 = (1 - alpha) / torch.sqrt(1 - alpha_bar)
-                motion_next = c0 * (motion_at_t - c1 * target_theta) + sigma * z
             elif self.target == 'sample':
                 c0 = (1 - alpha_bar_prev) * torch.sqrt(alpha) / (1 - alpha_bar)
                 c1 = (1 - alpha) * torch.sqrt(alpha_bar_prev) / (1 - alpha_bar)
-                motion_next = c0 * motion_at_t + c1 * target_theta + sigma * z
             else:
                 raise ValueError('Unknown target type: {}'.format(self.target))
-
-            traj[t - 1] = motion_next.detach()  # Stop gradient and save trajectory.
-            traj[t] = traj[t].cpu()  # Move previous output to CPU memory.
-            if not ret_traj:
-                del traj[t]
+            c0, c1 = c0.tolist(), c1.tolist()
+            z = torch.empty(motion_at_T.shape, dtype=motion_at_T.dtype, device=motion_at_T.device)
+        elif sampler == 'ddim':
+            if not 1 <= sample_steps <= sched.num_steps:
+                raise ValueError(f'sample_steps of the ddim sampler must be in [1, {sched.num_steps}], got {sample_steps}')
+            # evenly spaced sub-sequence of the training steps, from num_steps down to 0
+            time_steps = torch.linspace(sched.num_steps, 0, sample_steps + 1).round().long().tolist()
+            alpha_bar = sched.alpha_bars[time_steps[:-1]]
+            alpha_bar_prev = sched.alpha_bars[time_steps[1:]]
+            sigmas = eta * torch.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar) * (1 - alpha_bar / alpha_bar_prev))
+            sqrt_ab, sqrt_1m_ab = torch.sqrt(alpha_bar).tolist(), torch.sqrt(1 - alpha_bar).tolist()
+            sqrt_ab_prev = torch.sqrt(alpha_bar_prev).tolist()
+            c_eps = torch.sqrt(1 - alpha_bar_prev - sigmas ** 2).tolist()
+            sigmas = sigmas.tolist()
+        else:
+            raise ValueError(f'Unknown sampler {sampler}')
+
+        motion_at_t = motion_at_T
+        traj = {time_steps[0]: motion_at_T} if ret_traj else None
+        for i, (t, t_prev) in enumerate(zip(time_steps[:-1], time_steps[1:])):
+            with self._timed('denoise'):
+                target_theta = self._guided_prediction(guidance, motion_at_t, t, cfg_mode, cfg_scale, dynamic_threshold)
+
+            with self._timed('update'):
+                if sampler == 'ddpm':
+                    if self.target == 'noise':
+                        motion_next = c0[i] * (motion_at_t - c1[i] * target_theta)
+                    else:
+                        motion_next = c0[i] * motion_at_t + c1[i] * target_theta
+                    if t > 1:
+                        motion_next += sigmas[i] * z.normal_()
+                else:
+                    # both parameterizations give the predicted clean sample and the predicted noise
+                    if self.target == 'noise':
+                        eps = target_theta
+                        motion_0 = (motion_at_t - sqrt_1m_ab[i] * eps) / sqrt_ab[i]
+                    else:
+                        motion_0 = target_theta
+                        eps = (motion_at_t - sqrt_ab[i] * motion_0) / sqrt_1m_ab[i]
+                    motion_next = sqrt_ab_prev[i] * motion_0 + c_eps[i] * eps
+                    if t_prev > 0 and eta > 0:
+                        motion_next += sigmas[i] * torch.randn_like(motion_next)
+                motion_at_t = motion_next.detach()
+            self.timing['n_steps'] += 1
+
+            if ret_traj:
+                traj[t_prev] = motion_at_t
+                traj[t] = traj[t].cpu()  # Move previous output to CPU memory.
 
         if ret_traj:
             return traj, motion_at_T, audio_feat
         else:
-            return traj[0], motion_at_T, audio_feat
+            return motion_at_t, motion_at_T, audio_feat
+
+
+class GuidanceBatch(object):
+    """
+    denoiser inputs of all classifier-free guidance entries of one `sample` call. The conditions are concatenated
+    once, the noisy motion and the time step are copied into buffers allocated once and reused at every step.
+    """
+
+    def __init__(self, motion_at_T, audio_feat_in, prev_motion_feat, prev_audio_feat, indicator=None):
+        self.n_entries = len(audio_feat_in)
+        self.audio_feat_in = torch.cat(audio_feat_in, dim=0)
+        self.prev_motion_feat_in = torch.cat([prev_motion_feat] * self.n_entries, dim=0)
+        self.prev_audio_feat_in = torch.cat([prev_audio_feat] * self.n_entries, dim=0)
+        self.indicator_in = torch.cat([indicator] * self.n_entries, dim=0) if indicator is not None else None
+        self.memory_kv = None
+
+        batch_size = motion_at_T.shape[0]
+        self.motion_in = torch.empty((self.n_entries,) + tuple(motion_at_T.shape), dtype=motion_at_T.dtype, device=motion_at_T.device)
+        self.step_in = torch.empty((self.n_entries * batch_size,), dtype=torch.long, device=motion_at_T.device)
+
+    def fill(self, motion_at_t, t):
+        self.motion_in.copy_(motion_at_t.unsqueeze(0).expand_as(self.motion_in))
+        self.step_in.fill_(t)
+        return self.motion_in.flatten(0, 1), self.step_in
 
 
 class DenoisingNetwork(nn.Module):
@@ -433,7 +558,7 @@ class DenoisingNetwork(nn.Module):
             self.transformer = nn.TransformerDecoder(decoder_layer, num_layers=self.n_layers)
             if self.align_mask_width > 0:
                 motion_len = self.n_prev_motions + self.n_motions
-                alignment_mask = enc_dec_mask(motion_len, motion_len, frame_width=1, expansion=self.align_mask_width - 1)
+                alignment_mask = enc_dec_mask(motion_len, motion_len, frame_width=1, expansion=self.align_mask_width - 1, device=device)
                 # print(f"alignment_mask: ", alignment_mask.shape)
                 # alignment_mask = F.pad(alignment_mask, (0, 0, 1, 0), value=False)
                 self.register_buffer('alignment_mask', alignment_mask)
@@ -457,7 +582,55 @@ class DenoisingNetwork(nn.Module):
     def device(self):
         return next(self.parameters()).device
 
-    def forward(self, motion_feat, audio_feat, prev_motion_feat, prev_audio_feat, step, indicator=None):
+    def precompute_memory_kv(self, prev_audio_feat, audio_feat):
+        """
+        Project the audio memory to the cross-attention keys and values of every decoder layer. The memory does not
+        change across the diffusion steps of a window, so this is done once and passed to `forward` as `memory_kv`.
+
+        Returns:
+            memory_kv: dict with 'kv', a list of (k, v) of shape (N, n_heads, L_p + L, head_dim) per layer, and
+                'attn_mask', the alignment mask in the convention of scaled_dot_product_attention (True = attend)
+        """
+        memory = torch.cat([prev_audio_feat, audio_feat], dim=1)  # (N, L_p + L, d_audio)
+        batch_size, mem_len, _ = memory.shape
+        kv = []
+        for layer in self.transformer.layers:
+            attn = layer.multihead_attn
+            _, w_k, w_v = attn.in_proj_weight.chunk(3)
+            _, b_k, b_v = attn.in_proj_bias.chunk(3)
+            k = F.linear(memory, w_k, b_k).view(batch_size, mem_len, attn.num_heads, -1).transpose(1, 2)
+            v = F.linear(memory, w_v, b_v).view(batch_size, mem_len, attn.num_heads, -1).transpose(1, 2)
+            kv.append((k, v))
+        attn_mask = ~self.alignment_mask if self.alignment_mask is not None else None
+        return {'kv': kv, 'attn_mask': attn_mask}
+
+    def decode_with_memory_kv(self, x, memory_kv):
+        """the transformer decoder in eval mode, with the cross-attention keys and values of `precompute_memory_kv`"""
+        batch_size, tgt_len, _ = x.shape
+        for layer, (k, v) in zip(self.transformer.layers, memory_kv['kv']):
+            attn = layer.multihead_attn
+            w_q, _, _ = attn.in_proj_weight.chunk(3)
+            b_q, _, _ = attn.in_proj_bias.chunk(3)
+
+            def _cross_attn(h):
+                q = F.linear(h, w_q, b_q).view(batch_size, tgt_len, attn.num_heads, -1).transpose(1, 2)
+                out = F.scaled_dot_product_attention(q, k, v, attn_mask=memory_kv['attn_mask'])
+                out = out.transpose(1, 2).reshape(batch_size, tgt_len, -1)
+                return layer.dropout2(attn.out_proj(out))
+
+            if layer.norm_first:
+                x = x + layer._sa_block(layer.norm1(x), None, None)
+                x = x + _cross_attn(layer.norm2(x))
+                x = x + layer._ff_block(layer.norm3(x))
+            else:
+                x = layer.norm1(x + layer._sa_block(x, None, None))
+                x = layer.norm2(x + _cross_attn(x))
+                x = layer.norm3(x + layer._ff_block(x))
+        if self.transformer.norm is not None:
+            x = self.transformer.norm(x)
+        return x
+
+    def forward(self, motion_feat, audio_feat, prev_motion_feat, prev_audio_feat, step, indicator=None, memory_kv=None):
         """
         Args:
             motion_feat: (N, L, d_motion). Noisy motion feature
@@ -466,6 +639,7 @@ class DenoisingNetwork(nn.Module):
             prev_audio_feat: (N, L_p, d_audio). Padded previous motion coefficients or feature
             step: (N,)
             indicator: (N, L). 0/1 indicator for the real (unpadded) motion feature
+            memory_kv: optional output of `precompute_memory_kv` for these audio features, inference only
 
         Returns:
             motion_feat_target: (N, L_p + L, d_motion)
@@ -498,7 +672,9 @@ class DenoisingNetwork(nn.Module):
             feats_in = self.PE(feats_in) + diff_step_embedding
 
         # Transformer
-        if self.architecture == 'decoder':
+        if self.architecture == 'decoder' and memory_kv is not None:
+            feat_out = self.decode_with_memory_kv(feats_in, memory_kv)
+        elif self.architecture == 'decoder':
             audio_feat_in = torch.cat([prev_audio_feat, audio_feat], dim=1)  # (N, L_p + L, d_audio)
             # print(f"feats_in: {feats_in.shape}, audio_feat_in: {audio_feat_in.shape}, memory_mask: {self.alignment_mask.shape}")
             feat_out = self.transformer(feats_in, audio_feat_in, memory_mask=self.alignment_mask)
@@ -20,25 +20,23 @@ def kp2gaussian(kp, spatial_size, kp_variance):
     """
     mean = kp
 
-    coordinate_grid = make_coordinate_grid(spatial_size, mean)
+    z, y, x = make_coordinate_axes(spatial_size, mean)
     number_of_leading_dimensions = len(mean.shape) - 1
-    shape = (1,) * number_of_leading_dimensions + coordinate_grid.shape
-    coordinate_grid = coordinate_grid.view(*shape)
-    repeats = mean.shape[:number_of_leading_dimensions] + (1, 1, 1, 1)
-    coordinate_grid = coordinate_grid.repeat(*repeats)
+    shape = mean.shape[:number_of_leading_dimensions] + (1, 1, 1)
 
-    # Preprocess kp shape
-    shape = mean.shape[:number_of_leading_dimensions] + (1, 1, 1, 3)
-    mean = mean.view(*shape)
+    # the squared distance to the keypoint is separable over the axes of the grid, it is summed by broadcasting
+    # (..., 1, 1, w) + (..., 1, h, 1) + (..., d, 1, 1) instead of on a (..., d, h, w, 3) grid repeated per keypoint
+    dist_x = (x.view(1, 1, -1) - mean[..., 0].reshape(shape)) ** 2
+    dist_y = (y.view(1, -1, 1) - mean[..., 1].reshape(shape)) ** 2
+    dist_z = (z.view(-1, 1, 1) - mean[..., 2].reshape(shape)) ** 2
 
-    mean_sub = (coordinate_grid - mean)
-
-    out = torch.exp(-0.5 * (mean_sub ** 2).sum(-1) / kp_variance)
+    out = torch.exp(-0.5 * (dist_x + dist_y + dist_z) / kp_variance)
 
     return out
 
 
-def make_coordinate_grid(spatial_size, ref, **kwargs):
+def make_coordinate_axes(spatial_size, ref):
+    """the z, y and x coordinates of the grid of `make_coordinate_grid`, each one in [-1, 1]"""
     d, h, w = spatial_size
     x = torch.arange(w).type(ref.dtype).to(ref.device)
     y = torch.arange(h).type(ref.dtype).to(ref.device)
@@ -49,6 +47,13 @@ def make_coordinate_grid(spatial_size, ref, **kwargs):
     y = (2 * (y / (h - 1)) - 1)  # the y axis faces to the bottom
     z = (2 * (z / (d - 1)) - 1)  # the z axis faces to the inner
 
+    return z, y, x
+
+
+def make_coordinate_grid(spatial_size, ref, **kwargs):
+    d, h, w = spatial_size
+    z, y, x = make_coordinate_axes(spatial_size, ref)
+
     yy = y.view(1, -1, 1).repeat(d, 1, w)
     xx = x.view(1, 1, -1).repeat(d, h, 1)
     zz = z.view(-1, 1, 1).repeat(1, h, w)
@@ -58,6 +63,34 @@ def make_coordinate_grid(spatial_size, ref, **kwargs):
     return meshed
 
 
+def grid_sample_3d(inp, grid):
+    """
+    F.grid_sample on a volume (trilinear, zeros padding, align_corners=False) written with gather, so that it can
+    be exported to ONNX opsets without the volumetric GridSample.
+    inp: NxCxDxHxW, grid: NxDoxHoxWox3 with (x, y, z) in [-1, 1]
+    """
+    n, c, d, h, w = inp.shape
+    out_shape = grid.shape[1:4]
+    grid = grid.reshape(n, -1, 3)
+    # unnormalize, align_corners=False
+    ix = ((grid[..., 0] + 1) * w - 1) / 2
+    iy = ((grid[..., 1] + 1) * h - 1) / 2
+    iz = ((grid[..., 2] + 1) * d - 1) / 2
+    ix0, iy0, iz0 = torch.floor(ix), torch.floor(iy), torch.floor(iz)
+    fx, fy, fz = ix - ix0, iy - iy0, iz - iz0
+
+    inp = inp.reshape(n, c, d * h * w)
+    out = 0
+    for cz, wz in ((iz0, 1 - fz), (iz0 + 1, fz)):
+        for cy, wy in ((iy0, 1 - fy), (iy0 + 1, fy)):
+            for cx, wx in ((ix0, 1 - fx), (ix0 + 1, fx)):
+                valid = (cx >= 0) & (cx <= w - 1) & (cy >= 0) & (cy <= h - 1) & (cz >= 0) & (cz <= d - 1)
+                idx = (cz.clamp(0, d - 1) * h + cy.clamp(0, h - 1)) * w + cx.clamp(0, w - 1)
+                val = torch.gather(inp, 2, idx.long().unsqueeze(1).expand(-1, c, -1))
+                out = out + val * (wx * wy * wz * valid.to(inp.dtype)).unsqueeze(1)
+    return out.reshape(n, c, *out_shape)
+
+
 class ConvT2d(nn.Module):
     """
     Upsampling block for use in decoder.
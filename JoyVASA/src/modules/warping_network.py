@@ -44,13 +44,26 @@ class WarpingNetwork(nn.Module):
         self.estimate_occlusion_map = estimate_occlusion_map
 
     def deform_input(self, inp, deformation):
+        bs, d, h, w, _ = deformation.shape
+        if inp.shape[0] == 1 and bs > 1:
+            # a source volume shared by the batch: the deformations are stacked along the output depth of one
+            # grid_sample instead of repeating the volume bs times
+            out = F.grid_sample(inp, deformation.reshape(1, bs * d, h, w, 3), align_corners=False)  # 1xCx(B*D)xHxW
+            return out.view(-1, bs, d, h, w).transpose(0, 1).contiguous()
         return F.grid_sample(inp, deformation, align_corners=False)
 
-    def forward(self, feature_3d, kp_driving, kp_source):
+    def prepare_source(self, feature_3d, kp_source):
+        """the source-conditioned part of the dense motion, pass it as `source` to every call of `forward` with the
+        same feature_3d and kp_source"""
+        if self.dense_motion_network is None:
+            return None
+        return self.dense_motion_network.prepare_source(feature_3d, kp_source)
+
+    def forward(self, feature_3d, kp_driving, kp_source, source=None):
         if self.dense_motion_network is not None:
             # Feature warper, Transforming feature representation according to deformation and occlusion
             dense_motion = self.dense_motion_network(
-                feature=feature_3d, kp_driving=kp_driving, kp_source=kp_source
+                feature=feature_3d, kp_driving=kp_driving, kp_source=kp_source, source=source
             )
             if 'occlusion_map' in dense_motion:
                 occlusion_map = dense_motion['occlusion_map']  # Bx1x64x64
@@ -0,0 +1,227 @@
+# coding: utf-8
+
+"""
+Streaming mode for live avatars: 16 kHz mono PCM chunks in, rendered frames (or fragmented MP4 segments) out.
+The motion generator samples one window as soon as its audio has arrived, conditioned on the motion and audio
+features of the previous window, and the frames of the window are rendered before the next one is sampled.
+"""
+
+import time
+import socket
+from collections import deque
+
+import numpy as np
+import torch
+
+from .config.argument_config import ArgumentConfig
+from .utils.io import load_image_rgb, resize_to_limit
+from .utils.motion import MotionSequence
+from .utils.filter import OnlineMotionSmoother
+from .utils.video import encode_fmp4_segment
+from .utils.rprint import rlog as log
+
+SAMPLE_RATE = 16000
+
+
+def iter_audio_file(audio_fp, chunk_ms=200, flag_realtime=False):
+    """chunks of an audio file at 16 kHz, paced at real time speed like a live source if flag_realtime"""
+    import librosa
+    audio, _ = librosa.load(audio_fp, sr=SAMPLE_RATE, mono=True)
+    chunk_size = max(1, SAMPLE_RATE * chunk_ms // 1000)
+    tic = time.perf_counter()
+    for start in range(0, len(audio), chunk_size):
+        if flag_realtime:
+            # a chunk is available once its last sample has been recorded
+            time.sleep(max(0., tic + min(start + chunk_size, len(audio)) / SAMPLE_RATE - time.perf_counter()))
+        yield audio[start:start + chunk_size]
+
+
+def iter_socket_audio(host='127.0.0.1', port=9000, chunk_bytes=6400):
+    """chunks of 16 kHz mono signed 16-bit little-endian PCM sent by one TCP client, until it closes the connection"""
+    with socket.create_server((host, port)) as server:
+        log(f'Waiting for a PCM stream on {host}:{port}')
+        conn, addr = server.accept()
+        log(f'Receive audio from {addr}')
+        with conn:
+            remainder = b''
+            while True:
+                data = conn.recv(chunk_bytes)
+                if not data:
+                    break
+                data = remainder + data
+                n_bytes = len(data) // 2 * 2
+                remainder = data[n_bytes:]
+                if n_bytes > 0:
+                    yield np.frombuffer(data[:n_bytes], dtype='<i2').astype(np.float32) / 32768.
+
+
+class StreamLatency(object):
+    """timestamps of one stream: the first audio sample in, the first frame out, and for every window when its audio
+    was complete, when its motion was sampled and when its last frame was out"""
+
+    def __init__(self, fps=25):
+        self.fps = fps
+        self.t_first_audio = None
+        self.t_first_frame = None
+        self.n_audio_samples = 0
+        self.n_frames_out = 0
+        self.windows = []
+
+    def on_audio(self, n_samples):
+        if self.t_first_audio is None:
+            self.t_first_audio = time.perf_counter()
+        self.n_audio_samples += n_samples
+
+    def on_window_ready(self, n_frames):
+        self.windows.append({'n_frames': n_frames, 't_ready': time.perf_counter(), 't_motion': None, 't_out': None})
+
+    def on_motion_done(self):
+        self.windows[-1]['t_motion'] = time.perf_counter()
+
+    def on_frames(self, n_frames):
+        now = time.perf_counter()
+        if self.t_first_frame is None:
+            self.t_first_frame = now
+        self.n_frames_out += n_frames
+        n_cum = 0
+        for window in self.windows:
+            n_cum += window['n_frames']
+            if window['t_out'] is None and self.n_frames_out >= n_cum:
+                window['t_out'] = now
+
+    def report(self):
+        """latency budget of the stream in seconds, and the real-time factor of the windows after the first one:
+        the time spent on a window over its duration, below 1 the stream keeps up with the audio"""
+        if self.t_first_frame is None or len(self.windows) == 0:
+            return {}
+        first = self.windows[0]
+        report = {
+            'audio_to_first_frame': self.t_first_frame - self.t_first_audio,
+            'first_window_buffering': first['t_ready'] - self.t_first_audio,
+            'first_window_motion': first['t_motion'] - first['t_ready'],
+            'first_frame_render': self.t_first_frame - first['t_motion'],
+        }
+        busy, duration = 0., 0.
+        for prev, window in zip(self.windows[:-1], self.windows[1:]):
+            if window['t_out'] is None:
+                continue
+            # a window starts when both its audio and the frames of the previous window are there
+            busy += window['t_out'] - max(window['t_ready'], prev['t_out'])
+            duration += window['n_frames'] / self.fps
+        if duration > 0:
+            report['steady_state_rtf'] = busy / duration
+
+        log(f"stream latency: audio in to first frame out {report['audio_to_first_frame']:.3f}s = "
+            f"buffering of the first window {report['first_window_buffering']:.3f}s + motion {report['first_window_motion']:.3f}s + "
+            f"first frame {report['first_frame_render']:.3f}s")
+        if 'steady_state_rtf' in report:
+            log(f"stream steady state: real-time factor {report['steady_state_rtf']:.3f} over {len(self.windows) - 1} windows")
+        return report
+
+
+class StreamingTalkingHead(object):
+    """
+    stream a reference image driven by live audio with a LivePortraitPipeline or LivePortraitPipelineAnimal
+
+    streamer = StreamingTalkingHead(pipeline, args)
+    streamer.set_reference('assets/examples/imgs/joyvasa_003.png')
+    for frames in streamer.stream(iter_socket_audio(port=9000)):
+        ...  # lists of HxWx3 RGB frames at args.output_fps
+    """
+
+    def __init__(self, pipeline, args: ArgumentConfig):
+        self.pipeline = pipeline
+        self.wrapper = getattr(pipeline, 'live_portrait_wrapper_animal', None) or pipeline.live_portrait_wrapper
+        self.args = args
+        self.source_rgb, self.source_info = None, None
+        self.window_audio = deque()  # (n_frames, raw pcm) of the windows whose frames are not out yet
+        self.latency = None
+
+    def set_reference(self, reference):
+        inf_cfg = self.wrapper.inference_cfg
+        img_rgb = load_image_rgb(reference)
+        self.source_rgb = resize_to_limit(img_rgb, inf_cfg.source_max_dim, inf_cfg.source_division)
+        self.source_info = self.pipeline.prepare_source_info(self.source_rgb)
+        log(f"Load reference image from {reference}")
+
+    def window_frames(self):
+        n_motions, n_prev_motions = self.wrapper.n_motions, self.wrapper.n_prev_motions
+        if self.args.stream_window_frames <= 0:
+            return n_motions
+        return min(max(self.args.stream_window_frames, n_prev_motions), n_motions)
+
+    def audio_windows(self, audio_chunks):
+        """(normalized audio of n_motions frames, n_padding_frames) of every window, as soon as its audio has arrived.
+        The audio is normalized by the statistics of all the audio received so far, the clip is not known in advance."""
+        wrapper = self.wrapper
+        window_frames = self.window_frames()
+        window_samples = round(window_frames * wrapper.audio_unit)
+        buffer = np.zeros(0, dtype=np.float32)
+        n_seen, audio_sum, audio_sum_sq = 0, 0., 0.
+
+        def _window(pcm, n_frames):
+            mean = audio_sum / n_seen
+            std = np.sqrt(max(audio_sum_sq / n_seen - mean ** 2, 0.))
+            audio = torch.from_numpy((pcm - mean) / (std + 1e-5)).float().to(wrapper.device)
+            self.window_audio.append((n_frames, pcm))
+            self.latency.on_window_ready(n_frames)
+            return wrapper.pad_audio(audio, wrapper.n_motions).unsqueeze(0), wrapper.n_motions - n_frames
+
+        for chunk in audio_chunks:
+            chunk = np.asarray(chunk, dtype=np.float32).reshape(-1)
+            self.latency.on_audio(len(chunk))
+            n_seen += len(chunk)
+            audio_sum += float(chunk.sum(dtype=np.float64))
+            audio_sum_sq += float(np.square(chunk, dtype=np.float64).sum())
+            buffer = np.concatenate([buffer, chunk])
+            while len(buffer) >= window_samples:
+                yield _window(buffer[:window_samples], window_frames)
+                buffer = buffer[window_samples:]
+
+        # the rest of the audio after the end of the stream
+        n_frames = int(len(buffer) / SAMPLE_RATE * wrapper.fps)
+        if n_frames > 0:
+            yield _window(buffer[:round(n_frames * wrapper.audio_unit)], n_frames)
+
+    def motion_chunks(self, audio_chunks):
+        smoother = None
+        if self.args.is_smooth_motion:
+            smoother = OnlineMotionSmoother(method=self.args.smooth_method, observation_variance=self.args.driving_smooth_observation_variance)
+        for motion_coef, _ in self.wrapper.iter_motion_coef_windows(self.args, self.audio_windows(audio_chunks)):
+            motion_seq = MotionSequence.from_coef(motion_coef, self.wrapper.templete_dict, output_fps=self.wrapper.fps)
+            if smoother is not None:
+                motion_seq = smoother.update(motion_seq)
+            self.latency.on_motion_done()
+            yield motion_seq
+
+    def _iter_blocks(self, audio_chunks):
+        if self.source_info is None:
+            raise RuntimeError('Call set_reference before streaming.')
+        self.window_audio.clear()
+        self.latency = StreamLatency(fps=self.wrapper.fps)
+        return self.pipeline.iter_frames(self.source_rgb, self.source_info, self.motion_chunks(audio_chunks))
+
+    @torch.no_grad()
+    def stream(self, audio_chunks):
+        """yield the rendered frames, a list of HxWx3 RGB images per block of frames_per_batch frames, as soon as they
+        are rendered, then log the latency report"""
+        for frames in self._iter_blocks(audio_chunks):
+            self.latency.on_frames(len(frames))
+            yield frames
+        self.latency.report()
+
+    @torch.no_grad()
+    def stream_segments(self, audio_chunks, **kwargs):
+        """yield one self-contained fragmented MP4 segment (bytes) per window, with the audio of the window, as soon as
+        the window is rendered, then log the latency report"""
+        fps = self.wrapper.inference_cfg.output_fps
+        frames, time_offset = [], 0.
+        for block in self._iter_blocks(audio_chunks):
+            frames.extend(block)
+            while len(self.window_audio) > 0 and len(frames) >= self.window_audio[0][0]:
+                n_frames, pcm = self.window_audio.popleft()
+                segment = encode_fmp4_segment(frames[:n_frames], fps=fps, audio=pcm, sample_rate=SAMPLE_RATE, time_offset=time_offset, **kwargs)
+                frames, time_offset = frames[n_frames:], time_offset + n_frames / fps
+                self.latency.on_frames(n_frames)
+                yield segment
+        self.latency.report()
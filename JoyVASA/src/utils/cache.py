@@ -0,0 +1,137 @@
+# coding: utf-8
+
+"""
+caches of intermediate results that are expensive to recompute across requests
+"""
+
+import os
+import os.path as osp
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from .helper import mkdir
+from .rprint import rlog as log
+
+
+def hash_array(arr: np.ndarray) -> str:
+    """content hash of a numpy array, the shape and dtype are part of the hash"""
+    h = hashlib.sha1()
+    h.update(f'{arr.shape}{arr.dtype}'.encode())
+    h.update(np.ascontiguousarray(arr).data)
+    return h.hexdigest()
+
+
+def make_cache_key(*parts, **fields) -> str:
+    """stable key from positional parts (e.g. content hashes) and named config fields"""
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(str(part).encode())
+    for k in sorted(fields):
+        h.update(f'{k}={fields[k]!r};'.encode())
+    return h.hexdigest()
+
+
+def _to_device(obj, device):
+    if isinstance(obj, torch.Tensor):
+        return obj.to(device)
+    if isinstance(obj, dict):
+        return {k: _to_device(v, device) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_device(v, device) for v in obj)
+    return obj
+
+
+class SourceCache(object):
+    """in-memory LRU cache of prepared source portraits, optionally backed by a directory on disk
+
+    An entry is a dict of numpy arrays and tensors, e.g. crop_info, x_s_info, f_s, x_s and the paste back mask.
+    Entries are kept on the inference device in memory and stored on cpu with torch.save on disk.
+    """
+
+    def __init__(self, max_items=8, cache_dir=None, device='cpu'):
+        self.max_items = max_items
+        self.cache_dir = cache_dir
+        self.device = device
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        if cache_dir is not None:
+            mkdir(cache_dir)
+
+    def _path(self, key):
+        return osp.join(self.cache_dir, f'{key}.pt')
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        if self.cache_dir is None or not osp.exists(self._path(key)):
+            return None
+        try:
+            entry = torch.load(self._path(key), map_location=self.device, weights_only=False)
+        except Exception as e:
+            log(f'Failed to load cached source {self._path(key)}: {e}')
+            return None
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        entry = _to_device(entry, self.device)
+        self._remember(key, entry)
+        if self.cache_dir is not None:
+            # write to a temp file first so that a concurrent reader never sees a partial file
+            tmp_path = f'{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp'
+            torch.save(_to_device(entry, 'cpu'), tmp_path)
+            os.replace(tmp_path, self._path(key))
+        return entry
+
+    def _remember(self, key, entry):
+        if self.max_items <= 0:
+            return
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_items:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class AudioFeatureCache(object):
+    """content-addressed on-disk cache of the per-window audio features of the motion generator
+
+    The key of a clip is made of the hash of the waveform and the name of the encoder, every window is stored as
+    `<key>_<window index>.npy` and loaded memory-mapped, so running the same audio again skips the audio encoder.
+    """
+
+    def __init__(self, cache_dir, audio: np.ndarray, encoder_name: str):
+        self.cache_dir = cache_dir
+        self.key = make_cache_key(hash_array(audio), encoder_name)
+        mkdir(cache_dir)
+
+    def _path(self, idx):
+        return osp.join(self.cache_dir, f'{self.key}_{idx:05d}.npy')
+
+    def get(self, idx, device='cpu'):
+        if not osp.exists(self._path(idx)):
+            return None
+        try:
+            # copy-on-write mapping: writable for torch.from_numpy, pages are only read when the feature is used
+            audio_feat = np.load(self._path(idx), mmap_mode='c')
+        except Exception as e:
+            log(f'Failed to load cached audio feature {self._path(idx)}: {e}')
+            return None
+        return torch.from_numpy(audio_feat).to(device)
+
+    def put(self, idx, audio_feat: torch.Tensor):
+        # np.save only keeps the name as is when it ends with .npy
+        tmp_path = f'{self._path(idx)[:-4]}.{os.getpid()}.{threading.get_ident()}.tmp.npy'
+        np.save(tmp_path, audio_feat.detach().cpu().numpy())
+        os.replace(tmp_path, self._path(idx))
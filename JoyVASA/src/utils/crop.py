@@ -7,6 +7,7 @@ cropping function and the related preprocess functions for cropping
 import numpy as np
 import os.path as osp
 from math import sin, cos, acos, degrees
+from concurrent.futures import ThreadPoolExecutor
 import cv2; cv2.setNumThreads(0); cv2.ocl.setUseOpenCL(False) # NOTE: enforce single thread
 from .rprint import rprint as print
 
@@ -421,3 +422,61 @@ def paste_back(img_crop, M_c2o, img_ori, mask_ori):
     result = _transform_img(img_crop, M_c2o, dsize=dsize)
     result = np.clip(mask_ori * result + (1 - mask_ori) * img_ori, 0, 255).astype(np.uint8)
     return result
+
+
+class PasteBack(object):
+    """paste back engine for a fixed crop-to-original transform
+
+    M_c2o, the original image and the mask never change within a job, so the bounding box of the mask and the
+    background term of the blend are computed once. Each frame is then warped and blended only inside that box
+    with uint16 integer arithmetic, and batches of frames are spread over a thread pool.
+    """
+
+    def __init__(self, M_c2o, img_ori, mask_ori, num_workers=1):
+        self.img_ori = img_ori
+        alpha = np.round(mask_ori * 255).astype(np.uint8)  # mask_ori is a uint8 mask divided by 255
+        if alpha.ndim == 2:
+            alpha = alpha[..., None]
+
+        ys, xs = np.nonzero(alpha.max(axis=2))
+        if len(ys) == 0:
+            self.roi = None
+        else:
+            y0, y1, x0, x1 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+            self.roi = (slice(y0, y1), slice(x0, x1))
+
+            # warp straight into the roi by shifting the translation of the transform
+            self.M_c2roi = M_c2o[:2, :].astype(np.float64).copy()
+            self.M_c2roi[:, 2] -= (x0, y0)
+            self.roi_dsize = (int(x1 - x0), int(y1 - y0))
+
+            # alpha * fg + (255 - alpha) * bg, the background term is constant
+            self.alpha = np.broadcast_to(alpha[self.roi], img_ori[self.roi].shape).astype(np.uint16)
+            self.bg_term = (255 - self.alpha) * img_ori[self.roi].astype(np.uint16)
+
+        self.executor = ThreadPoolExecutor(max_workers=num_workers) if num_workers > 1 else None
+
+    def __call__(self, img_crop):
+        result = self.img_ori.copy()
+        if self.roi is None:
+            return result
+
+        fg = cv2.warpAffine(img_crop, self.M_c2roi, dsize=self.roi_dsize, flags=CV2_INTERP)
+        acc = np.multiply(self.alpha, fg, dtype=np.uint16)
+        acc += self.bg_term
+        # floor(acc / 255) without a division, exact for acc <= 255 * 255
+        acc += 1
+        acc += acc >> 8
+        acc >>= 8
+        result[self.roi] = acc
+        return result
+
+    def paste_back_batch(self, img_crop_lst):
+        if self.executor is None:
+            return [self(img_crop) for img_crop in img_crop_lst]
+        return list(self.executor.map(self, img_crop_lst))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -1,6 +1,7 @@
 # coding: utf-8
 
 import os.path as osp
+import time
 import torch
 import numpy as np
 import cv2; cv2.setNumThreads(0); cv2.ocl.setUseOpenCL(False)
@@ -18,6 +19,8 @@ from .crop import (
 )
 from .io import contiguous
 from .rprint import rlog as log
+from .helper import ParallelLoader
+from .registry import load_shared
 from .face_analysis_diy import FaceAnalysisDIY
 from .human_landmark_runner import LandmarkRunner as HumanLandmark
 
@@ -42,6 +45,7 @@ class Cropper(object):
     def __init__(self, **kwargs) -> None:
         self.crop_cfg: CropConfig = kwargs.get("crop_cfg", None)
         self.image_type = kwargs.get("image_type", 'human_face')
+        registry = kwargs.get("registry", None)  # the face detectors are the same for every pipeline of the process
         device_id = kwargs.get("device_id", 0)
         flag_force_cpu = kwargs.get("flag_force_cpu", False)
         if flag_force_cpu:
@@ -60,30 +64,51 @@ class Cropper(object):
             except:
                     device = "cuda"
                     face_analysis_wrapper_provider = ["CUDAExecutionProvider"]
-        self.face_analysis_wrapper = FaceAnalysisDIY(
+        # the detectors are independent, load and warm them up in parallel
+        start_time = time.time()
+        loader = ParallelLoader(kwargs.get("load_num_workers", 4))
+        loader.submit('face_analysis_wrapper', load_shared, registry,
+                      ('face_analysis_wrapper', self.crop_cfg.insightface_root, tuple(face_analysis_wrapper_provider), device_id, self.crop_cfg.det_thresh),
+                      self._load_face_analysis, face_analysis_wrapper_provider, device_id)
+        loader.submit('human_landmark_runner', load_shared, registry,
+                      ('human_landmark_runner', self.crop_cfg.landmark_ckpt_path, device, device_id),
+                      self._load_human_landmark_runner, device, device_id)
+        if self.image_type == "animal_face":
+            loader.submit('animal_landmark_runner', self._load_animal_landmark_runner, kwargs.get("flag_use_half_precision", True))
+        for name in loader.futures:
+            setattr(self, name, loader.result(name))
+        loader.shutdown()
+        loader.report('Cropper', time.time() - start_time)
+
+    def _load_face_analysis(self, providers, device_id):
+        face_analysis_wrapper = FaceAnalysisDIY(
                     name="buffalo_l",
                     root=self.crop_cfg.insightface_root,
-                    providers=face_analysis_wrapper_provider,
+                    providers=providers,
                 )
-        self.face_analysis_wrapper.prepare(ctx_id=device_id, det_size=(512, 512), det_thresh=self.crop_cfg.det_thresh)
-        self.face_analysis_wrapper.warmup()
+        face_analysis_wrapper.prepare(ctx_id=device_id, det_size=(512, 512), det_thresh=self.crop_cfg.det_thresh)
+        face_analysis_wrapper.warmup()
+        return face_analysis_wrapper
 
-        self.human_landmark_runner = HumanLandmark(
+    def _load_human_landmark_runner(self, device, device_id):
+        human_landmark_runner = HumanLandmark(
             ckpt_path=self.crop_cfg.landmark_ckpt_path,
             onnx_provider=device,
             device_id=device_id,
         )
-        self.human_landmark_runner.warmup()
-
-        if self.image_type == "animal_face":
-            from .animal_landmark_runner import XPoseRunner as AnimalLandmarkRunner
-            self.animal_landmark_runner = AnimalLandmarkRunner(
-                    model_config_path=self.crop_cfg.xpose_config_file_path,
-                    model_checkpoint_path=self.crop_cfg.xpose_ckpt_path,
-                    embeddings_cache_path=self.crop_cfg.xpose_embedding_cache_path,
-                    flag_use_half_precision=kwargs.get("flag_use_half_precision", True),
-                )
-            self.animal_landmark_runner.warmup()
+        human_landmark_runner.warmup()
+        return human_landmark_runner
+
+    def _load_animal_landmark_runner(self, flag_use_half_precision):
+        from .animal_landmark_runner import XPoseRunner as AnimalLandmarkRunner
+        animal_landmark_runner = AnimalLandmarkRunner(
+                model_config_path=self.crop_cfg.xpose_config_file_path,
+                model_checkpoint_path=self.crop_cfg.xpose_ckpt_path,
+                embeddings_cache_path=self.crop_cfg.xpose_embedding_cache_path,
+                flag_use_half_precision=flag_use_half_precision,
+            )
+        animal_landmark_runner.warmup()
+        return animal_landmark_runner
 
     def update_config(self, user_args):
         for k, v in user_args.items():
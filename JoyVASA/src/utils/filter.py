@@ -2,7 +2,10 @@
 
 import torch
 import numpy as np
-from pykalman import KalmanFilter
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import lfilter
+
+from .motion import MotionSequence
 PI = np.pi
 
 device = "cuda"
@@ -53,13 +56,7 @@ def get_rotation_matrix(pitch_, yaw_, roll_):
 def smooth(x_d_lst, shape, device, observation_variance=3e-7, process_variance=1e-5):
     x_d_lst_reshape = [x.reshape(-1) for x in x_d_lst]
     x_d_stacked = np.vstack(x_d_lst_reshape)
-    kf = KalmanFilter(
-        initial_state_mean=x_d_stacked[0],
-        n_dim_obs=x_d_stacked.shape[1],
-        transition_covariance=process_variance * np.eye(x_d_stacked.shape[1]),
-        observation_covariance=observation_variance * np.eye(x_d_stacked.shape[1])
-    )
-    smoothed_state_means, _ = kf.smooth(x_d_stacked)
+    smoothed_state_means = kalman_smooth(x_d_stacked, observation_variance, process_variance)
     x_d_lst_smooth = [torch.tensor(state_mean.reshape(shape[-2:]), dtype=torch.float32, device=device) for state_mean in smoothed_state_means]
     return x_d_lst_smooth
 
@@ -75,90 +72,211 @@ class ExponentialMovingAverageFilter:
             self.smoothed_value = self.alpha * new_value + (1 - self.alpha) * self.smoothed_value
         return self.smoothed_value
 
-class MovingAverageFilter:
+    def update_chunk(self, values):
+        """filter a TxD chunk at once, same as calling update on every row"""
+        values = np.asarray(values, dtype=np.float64)
+        prev = values[:1] if self.smoothed_value is None else np.asarray(self.smoothed_value, dtype=np.float64).reshape(1, -1)
+        smoothed, _ = lfilter([self.alpha], [1., self.alpha - 1.], values, axis=0, zi=(1. - self.alpha) * prev)
+        self.smoothed_value = smoothed[-1]
+        return smoothed
+
+class _WindowFilter:
+    """circular buffer of the last window_size values"""
     def __init__(self, window_size):
         self.window_size = window_size
         self.buffer = np.zeros((window_size, 7))
         self.index = 0
         self.full = False
 
-    def update(self, new_value):
+    def push(self, new_value):
         # 更新队列
         self.buffer[self.index] = new_value
         self.index = (self.index + 1) % self.window_size
-        
+
         # 如果队列未满，则只计算已有的元素
         if not self.full and self.index == 0:
             self.full = True
 
+    def history(self):
+        """the values in the buffer, oldest first"""
+        if self.full:
+            return np.roll(self.buffer, -self.index, axis=0)
+        return self.buffer[:self.index]
+
+    def update_chunk_with(self, reduce_fn, values):
+        values = np.asarray(values, dtype=np.float64)
+        # the windows of the chunk start in the last window_size - 1 values of the previous chunks
+        history = self.history()
+        history = history[max(len(history) - (self.window_size - 1), 0):]
+        padded = np.concatenate([np.full((self.window_size - 1 - len(history),) + values.shape[1:], np.nan), history, values], axis=0)
+        smoothed = reduce_fn(sliding_window_view(padded, self.window_size, axis=0), axis=-1)
+
+        # only the last window_size values stay in the buffer
+        n_skip = max(len(values) - self.window_size, 0)
+        if n_skip > 0:
+            self.full = self.full or self.index + n_skip >= self.window_size
+            self.index = (self.index + n_skip) % self.window_size
+        for value in values[n_skip:]:
+            self.push(value)
+        return smoothed
+
+class MovingAverageFilter(_WindowFilter):
+    def update(self, new_value):
+        self.push(new_value)
+
         # 计算平均值
         return np.mean(self.buffer[:self.window_size if self.full else self.index], axis=0)
 
-class MedianFilter:
-    def __init__(self, window_size):
-        self.window_size = window_size
-        self.buffer = np.zeros((window_size, 7))
-        self.index = 0
-        self.full = False
+    def update_chunk(self, values):
+        """filter a TxD chunk at once, same as calling update on every row"""
+        return self.update_chunk_with(np.nanmean, values)
 
+class MedianFilter(_WindowFilter):
     def update(self, new_value):
-        # 更新队列
-        self.buffer[self.index] = new_value
-        self.index = (self.index + 1) % self.window_size
-        
-        # 如果队列未满，则只计算已有的元素
-        if not self.full and self.index == 0:
-            self.full = True
+        self.push(new_value)
 
         # 计算中值
         return np.median(self.buffer[:self.window_size if self.full else self.index], axis=0)
 
-def smooth_(ori_data, method="median"):
-    # 均值滤波 & 中值滤波
-    data_array = []
-    for frame_idx in range(ori_data["n_frames"]):
-        data_array.append(
-            np.concatenate((
-                ori_data['motion'][frame_idx]["scale"].flatten(),
-                ori_data['motion'][frame_idx]["t"].flatten(),
-                ori_data['motion'][frame_idx]["pitch"].flatten(),
-                ori_data['motion'][frame_idx]["yaw"].flatten(),
-                ori_data['motion'][frame_idx]["roll"].flatten(),
-            ))
-        )
-    data_array = np.array(data_array).astype(np.float32)
-    # print("data_array.shape: ", data_array.shape)
-    
-    # 滑动窗口大小
+    def update_chunk(self, values):
+        """filter a TxD chunk at once, same as calling update on every row"""
+        return self.update_chunk_with(np.nanmedian, values)
+
+class ConstantVelocityKalmanFilter:
+    """causal Kalman filter of a constant velocity model, every dimension is filtered independently with the same variances"""
+    def __init__(self, observation_variance=3e-7, process_variance=1e-5, initial_variance=1.):
+        self.observation_variance = observation_variance
+        self.initial_variance = initial_variance
+        # white noise acceleration over one frame
+        self.transition_covariance = process_variance * np.array([[1. / 3., 1. / 2.], [1. / 2., 1.]])
+        self.position, self.velocity, self.covariance = None, None, None
+
+    def update(self, new_value):
+        return self.update_chunk(np.asarray(new_value)[None])[0]
+
+    def update_chunk(self, values):
+        """filter a TxD chunk, the state is carried to the next chunk"""
+        values = np.asarray(values, dtype=np.float64)
+        smoothed = np.empty_like(values)
+        for i, value in enumerate(values):
+            if self.position is None:
+                self.position, self.velocity = value.copy(), np.zeros_like(value)
+                self.covariance = np.diag([self.observation_variance, self.initial_variance])
+                smoothed[i] = value
+                continue
+            # predict
+            position = self.position + self.velocity
+            P = self.covariance
+            P = np.array([[P[0, 0] + 2 * P[0, 1] + P[1, 1], P[0, 1] + P[1, 1]],
+                          [P[0, 1] + P[1, 1], P[1, 1]]]) + self.transition_covariance
+            # update with the observed position
+            gain = P[:, 0] / (P[0, 0] + self.observation_variance)
+            innovation = value - position
+            self.position = position + gain[0] * innovation
+            self.velocity = self.velocity + gain[1] * innovation
+            self.covariance = P - np.outer(gain, P[0])
+            smoothed[i] = self.position
+        return smoothed
+
+
+# filters of whole TxD arrays, the causal ones give the same output as the per-frame filters above
+
+def ema_filter(x, alpha=0.6):
+    """causal exponential moving average of the rows of a TxD array, y[0] = x[0]"""
+    x = np.asarray(x, dtype=np.float64)
+    # y[n] = alpha * x[n] + (1 - alpha) * y[n - 1] as one IIR filter along the time axis
+    y, _ = lfilter([alpha], [1., alpha - 1.], x, axis=0, zi=(1. - alpha) * x[:1])
+    return y
+
+
+def _sliding_windows(x, window_size):
+    """TxDxW windows of the last window_size frames, the missing frames before the first one are nan"""
+    x = np.asarray(x, dtype=np.float64)
+    padded = np.concatenate([np.full((window_size - 1,) + x.shape[1:], np.nan), x], axis=0)
+    return sliding_window_view(padded, window_size, axis=0)
+
+
+def moving_average_filter(x, window_size=10):
+    """causal mean of the last window_size rows of a TxD array"""
+    return np.nanmean(_sliding_windows(x, window_size), axis=-1)
+
+
+def median_filter(x, window_size=3):
+    """causal median of the last window_size rows of a TxD array"""
+    return np.nanmedian(_sliding_windows(x, window_size), axis=-1)
+
+
+def zero_phase(filter_fn, x, *args, **kwargs):
+    """run a causal filter forward then backward in time, the delays of the two passes cancel out"""
+    y = filter_fn(x, *args, **kwargs)
+    return filter_fn(y[::-1], *args, **kwargs)[::-1]
+
+
+def kalman_smooth(x, observation_variance=3e-7, process_variance=1e-5, initial_variance=1.):
+    """Kalman (RTS) smoothing of a TxD random walk observed with noise, the covariances are diagonal so every dimension
+    is filtered independently in O(T * D), same result as pykalman with `variance * np.eye(D)` covariances"""
+    x = np.asarray(x, dtype=np.float64)
+    T = x.shape[0]
+    # the variances do not depend on the data and are the same for every dimension
+    p_pred = np.empty(T)
+    p_filt = np.empty(T)
+    m_filt = np.empty_like(x)
+    m, p = x[0], initial_variance
+    for i in range(T):
+        if i > 0:
+            p = p_filt[i - 1] + process_variance
+        p_pred[i] = p
+        gain = p / (p + observation_variance)
+        m = m + gain * (x[i] - m)
+        m_filt[i] = m
+        p_filt[i] = (1. - gain) * p
+
+    m_smooth = m_filt.copy()
+    for i in range(T - 2, -1, -1):
+        m_smooth[i] = m_filt[i] + p_filt[i] / p_pred[i + 1] * (m_smooth[i + 1] - m_filt[i])
+    return m_smooth
+
+
+def smooth_(motion_seq, method="median", flag_zero_phase=False, observation_variance=3e-7, process_variance=1e-5):
+    """smooth the scale, t and angles of a MotionSequence, R is rebuilt from the smoothed angles in one batch"""
+    data_array = np.concatenate((motion_seq.scale, motion_seq.t, motion_seq.angles), axis=1)
+
     if method == "median":
-        window_size = 3
-        ma_filter = MedianFilter(window_size)
+        filter_fn, kwargs = median_filter, {'window_size': 3}
     elif method == "ema":
-        ma_filter = ExponentialMovingAverageFilter(alpha=0.01)
-    else: 
-        window_size = 10
-        ma_filter = MovingAverageFilter(window_size)
-    smoothed_data = []
-    for value in data_array:
-        smoothed_value = ma_filter.update(value)
-        smoothed_data.append(smoothed_value)
-    smoothed_data = np.array(smoothed_data).astype(np.float32)
-    # print("smoothed_data_mean.shape: ", smoothed_data.shape)
-
-    # 整理结果
-    motion_list = []
-    for idx in range(smoothed_data.shape[0]):
-        exp = ori_data["motion"][idx]["exp"]
-        scale = smoothed_data[idx][0:1].reshape(1, 1)
-        # scale = 1.2 * np.ones((1, 1)).reshape(1, 1).astype(np.float32)
-        t = smoothed_data[idx][1:4].reshape(1, 3).astype(np.float32)
-        pitch = smoothed_data[idx][4:5].reshape(1, 1).astype(np.float32)
-        yaw = smoothed_data[idx][5:6].reshape(1, 1).astype(np.float32)
-        roll = smoothed_data[idx][6:7].reshape(1, 1).astype(np.float32)
-        R = get_rotation_matrix(torch.FloatTensor(pitch), torch.FloatTensor(yaw), torch.FloatTensor(roll))
-        R = R.reshape(1, 3, 3).cpu().numpy().astype(np.float32)
-
-        motion_list.append({"exp": exp, "scale": scale, "t": t, "pitch": pitch, "yaw": yaw, "roll": roll, "R": R})
-    # print(f"exp: {exp.shape}, scale: {scale.shape}, t: {t.shape}, pitch: {pitch.shape}, yaw: {yaw.shape}, roll: {roll.shape}, R: {R.shape}")
-    tgt_motion = {'n_frames': smoothed_data.shape[0], 'output_fps': 25, 'motion': motion_list}
-    return tgt_motion
+        filter_fn, kwargs = ema_filter, {'alpha': 0.01}
+    elif method == "kalman":
+        # already uses the whole sequence in both directions
+        filter_fn, kwargs = kalman_smooth, {'observation_variance': observation_variance, 'process_variance': process_variance}
+        flag_zero_phase = False
+    else:
+        filter_fn, kwargs = moving_average_filter, {'window_size': 10}
+    if flag_zero_phase:
+        smoothed_data = zero_phase(filter_fn, data_array, **kwargs)
+    else:
+        smoothed_data = filter_fn(data_array, **kwargs)
+    smoothed_data = smoothed_data.astype(np.float32)
+
+    return MotionSequence(exp=motion_seq.exp, scale=smoothed_data[:, 0:1], t=smoothed_data[:, 1:4], angles=smoothed_data[:, 4:7],
+                          output_fps=motion_seq.output_fps)
+
+
+class OnlineMotionSmoother:
+    """causal smoothing of a MotionSequence given chunk by chunk, e.g. one window of the motion generator at a time. The
+    filter state is carried across chunks, so for "ema", "median" and "mean" the chunks come out the same as `smooth_`
+    of the whole sequence; "kalman" is a causal constant velocity Kalman filter"""
+    def __init__(self, method="median", observation_variance=3e-7, process_variance=1e-5):
+        if method == "median":
+            self.filter = MedianFilter(3)
+        elif method == "ema":
+            self.filter = ExponentialMovingAverageFilter(alpha=0.01)
+        elif method == "kalman":
+            self.filter = ConstantVelocityKalmanFilter(observation_variance, process_variance)
+        else:
+            self.filter = MovingAverageFilter(10)
+
+    def update(self, motion_seq):
+        data_array = np.concatenate((motion_seq.scale, motion_seq.t, motion_seq.angles), axis=1)
+        smoothed_data = self.filter.update_chunk(data_array).astype(np.float32)
+        return MotionSequence(exp=motion_seq.exp, scale=smoothed_data[:, 0:1], t=smoothed_data[:, 1:4], angles=smoothed_data[:, 4:7],
+                              output_fps=motion_seq.output_fps)
@@ -6,8 +6,10 @@ utility functions and classes to handle feature extraction and model loading
 
 import os
 import os.path as osp
+import time
 import torch
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from scipy.spatial import ConvexHull # pylint: disable=E0401,E0611
 from typing import Union
@@ -20,6 +22,7 @@ from ..modules.appearance_feature_extractor import AppearanceFeatureExtractor
 from ..modules.stitching_retargeting_network import StitchingRetargetingNetwork
 
 from ..modules.dit_talking_head import DitTalkingHead 
+from .rprint import rlog as log
 
 class NullableArgs:
     def __init__(self, namespace):
@@ -128,6 +131,11 @@ def dct2device(dct: dict, device):
     return dct
 
 
+def stack_motion(motion_lst: list) -> dict:
+    """stack a list of per-frame motion dicts (1xK arrays) into a dict of TxK arrays"""
+    return {key: np.concatenate([motion[key] for motion in motion_lst], axis=0) for key in motion_lst[0]}
+
+
 def concat_feat(kp_source: torch.Tensor, kp_driving: torch.Tensor) -> torch.Tensor:
     """
     kp_source: (bs, k, 3)
@@ -150,6 +158,55 @@ def remove_ddp_dumplicate_key(state_dict):
 
 
 
+def load_checkpoint(ckpt_path, map_location='cpu'):
+    """load a checkpoint, memory-mapped when possible so that the weights are paged in by load_state_dict instead of
+    being read and copied up front; .safetensors files are read with safetensors"""
+    if ckpt_path.endswith('.safetensors'):
+        from safetensors.torch import load_file
+        return load_file(ckpt_path, device=str(map_location))
+    try:
+        return torch.load(ckpt_path, map_location=map_location, mmap=True)
+    except RuntimeError:
+        # checkpoints saved in the legacy (non zip) format can not be memory-mapped
+        return torch.load(ckpt_path, map_location=map_location)
+
+
+class ParallelLoader(object):
+    """run the loading of independent components in a thread pool and record the load time of each one"""
+
+    def __init__(self, num_workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=num_workers) if num_workers > 1 else None
+        self.futures = OrderedDict()
+        self.load_time = OrderedDict()
+
+    def _timed(self, name, fn, *args, **kwargs):
+        start_time = time.time()
+        out = fn(*args, **kwargs)
+        self.load_time[name] = time.time() - start_time
+        return out
+
+    def submit(self, name, fn, *args, **kwargs):
+        if self.executor is None:
+            self.futures[name] = self._timed(name, fn, *args, **kwargs)
+        else:
+            self.futures[name] = self.executor.submit(self._timed, name, fn, *args, **kwargs)
+
+    def result(self, name):
+        if self.executor is None:
+            return self.futures[name]
+        return self.futures[name].result()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def report(self, title, total_time=None):
+        for name, elapse in self.load_time.items():
+            log(f'{title} load time of {name}: {elapse:.3f}s')
+        if total_time is not None:
+            log(f'{title} load time in total: {total_time:.3f}s')
+
+
 def load_model(ckpt_path, model_config, device, model_type):
     model_params = model_config['model_params'][f'{model_type}_params']
 
@@ -158,7 +215,7 @@ def load_model(ckpt_path, model_config, device, model_type):
     elif model_type == 'motion_extractor':
         model = MotionExtractor(**model_params).to(device)
     elif model_type == 'motion_generator':
-        model_data = torch.load(ckpt_path, map_location=device)
+        model_data = load_checkpoint(ckpt_path, map_location='cpu')
         model_args = NullableArgs(model_data['args'])
         model = DitTalkingHead(motion_feat_dim=model_args.motion_feat_dim, 
                                n_motions=model_args.n_motions, 
@@ -178,7 +235,7 @@ def load_model(ckpt_path, model_config, device, model_type):
     elif model_type == 'stitching_retargeting_module':
         # Special handling for stitching and retargeting module
         config = model_config['model_params']['stitching_retargeting_module_params']
-        checkpoint = torch.load(ckpt_path, map_location=lambda storage, loc: storage)
+        checkpoint = load_checkpoint(ckpt_path)
 
         stitcher = StitchingRetargetingNetwork(**config.get('stitching'))
         stitcher.load_state_dict(remove_ddp_dumplicate_key(checkpoint['retarget_shoulder']))
@@ -203,7 +260,7 @@ def load_model(ckpt_path, model_config, device, model_type):
     else:
         raise ValueError(f"Unknown model type: {model_type}")
 
-    model.load_state_dict(torch.load(ckpt_path, map_location=lambda storage, loc: storage))
+    model.load_state_dict(load_checkpoint(ckpt_path))
     model.eval()
     return model
 
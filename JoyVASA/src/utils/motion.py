@@ -0,0 +1,134 @@
+# coding: utf-8
+
+"""
+motion sequence generated from an audio, stored as contiguous arrays of all the frames instead of a list of per-frame dicts
+"""
+
+import numpy as np
+import torch
+
+from .camera import get_rotation_matrix
+from .io import load
+
+MOTION_KEYS = ('exp', 'scale', 't', 'angles', 'R')
+# layout of the 70 motion coefficients of the motion generator: exp, scale, t, pitch, yaw, roll
+COEF_SLICES = (('exp', 63), ('scale', 1), ('t', 3), ('pitch', 1), ('yaw', 1), ('roll', 1))
+
+
+def denormalize_params(templete_dict):
+    """(mul, add) of the 70 coefficients such that coef * mul + add is the motion, from the statistics of the motion template,
+    exp is standardized by its mean and std, the others are min-max normalized"""
+    mul, add = [], []
+    for name, dim in COEF_SLICES:
+        if name == 'exp':
+            std, low = templete_dict['std_exp'], templete_dict['mean_exp']
+        else:
+            std = np.asarray(templete_dict[f'max_{name}'], dtype=np.float32) - np.asarray(templete_dict[f'min_{name}'], dtype=np.float32)
+            low = templete_dict[f'min_{name}']
+        mul.append(np.broadcast_to(np.asarray(std, dtype=np.float32).reshape(-1), (dim,)))
+        add.append(np.broadcast_to(np.asarray(low, dtype=np.float32).reshape(-1), (dim,)))
+    return np.concatenate(mul), np.concatenate(add)
+
+
+class MotionSequence(object):
+    """motion of T frames: exp Tx21x3, scale Tx1, t Tx3, angles Tx3 (pitch, yaw, roll in degree) and R Tx3x3, all float32
+
+    `seq[i]` is the motion of frame i in the legacy per-frame dict format (1x... arrays), made of views of the arrays,
+    `stacked()` is the dict of Tx... arrays consumed by the pipelines.
+    """
+
+    def __init__(self, exp, scale, t, angles, R=None, output_fps=25):
+        self.exp = np.ascontiguousarray(exp, dtype=np.float32).reshape(-1, 21, 3)
+        self.scale = np.ascontiguousarray(scale, dtype=np.float32).reshape(-1, 1)
+        self.t = np.ascontiguousarray(t, dtype=np.float32).reshape(-1, 3)
+        self.angles = np.ascontiguousarray(angles, dtype=np.float32).reshape(-1, 3)
+        if R is None:
+            R = self.rotation_matrix(self.angles)
+        self.R = np.ascontiguousarray(R, dtype=np.float32).reshape(-1, 3, 3)
+        self.output_fps = output_fps
+
+    @staticmethod
+    def rotation_matrix(angles):
+        """R of all the frames in one batched call"""
+        angles = torch.from_numpy(np.ascontiguousarray(angles, dtype=np.float32))
+        return get_rotation_matrix(angles[:, 0], angles[:, 1], angles[:, 2]).numpy()
+
+    @classmethod
+    def from_coef(cls, motion_coef: torch.Tensor, templete_dict, output_fps=25):
+        """denormalize the Tx70 coefficients of the motion generator with the motion template in one step, R is computed
+        on the device of the coefficients and everything is copied to cpu once"""
+        mul, add = denormalize_params(templete_dict)
+        motion = motion_coef.float() * torch.from_numpy(mul).to(motion_coef.device) + torch.from_numpy(add).to(motion_coef.device)
+        R = get_rotation_matrix(motion[:, 67], motion[:, 68], motion[:, 69])
+        motion, R = motion.cpu().numpy(), R.cpu().numpy()
+        return cls(exp=motion[:, :63], scale=motion[:, 63:64], t=motion[:, 64:67], angles=motion[:, 67:70], R=R, output_fps=output_fps)
+
+    @classmethod
+    def from_template(cls, template_dct):
+        """from the legacy template, a dict with a list of per-frame dicts under 'motion'"""
+        motion = template_dct['motion']
+        stack = lambda key: np.concatenate([np.asarray(m[key], dtype=np.float32).reshape(1, -1) for m in motion], axis=0)
+        angles = np.concatenate([stack('pitch'), stack('yaw'), stack('roll')], axis=1)
+        return cls(exp=stack('exp'), scale=stack('scale'), t=stack('t'), angles=angles, R=stack('R'),
+                   output_fps=template_dct.get('output_fps', 25))
+
+    @classmethod
+    def concatenate(cls, motion_seqs):
+        """one sequence of the frames of several sequences, e.g. the chunks of a streamed motion"""
+        return cls(**{key: np.concatenate([getattr(seq, key) for seq in motion_seqs], axis=0) for key in MOTION_KEYS},
+                   output_fps=motion_seqs[0].output_fps)
+
+    @property
+    def n_frames(self):
+        return self.exp.shape[0]
+
+    def __len__(self):
+        return self.n_frames
+
+    def __getitem__(self, idx):
+        if not -self.n_frames <= idx < self.n_frames:
+            raise IndexError(f'frame {idx} out of range for a motion sequence of {self.n_frames} frames')
+        if idx < 0:
+            idx += self.n_frames
+        s = slice(idx, idx + 1)
+        return {'exp': self.exp[s], 'scale': self.scale[s], 'R': self.R[s], 't': self.t[s],
+                'pitch': self.angles[s, 0:1], 'yaw': self.angles[s, 1:2], 'roll': self.angles[s, 2:3]}
+
+    def __iter__(self):
+        return (self[i] for i in range(self.n_frames))
+
+    def slice(self, start, stop):
+        """frames [start, stop), the arrays are views"""
+        seq = MotionSequence.__new__(MotionSequence)
+        for key in MOTION_KEYS:
+            setattr(seq, key, getattr(self, key)[start:stop])
+        seq.output_fps = self.output_fps
+        return seq
+
+    def stacked(self):
+        """dict of Tx... arrays with the keys of the legacy template, the arrays are views"""
+        return {'exp': self.exp, 'scale': self.scale, 'R': self.R, 't': self.t,
+                'pitch': self.angles[:, 0:1], 'yaw': self.angles[:, 1:2], 'roll': self.angles[:, 2:3]}
+
+    def to_template(self):
+        """legacy template with a list of per-frame dicts"""
+        return {'n_frames': self.n_frames, 'output_fps': self.output_fps, 'motion': [self[i] for i in range(self.n_frames)]}
+
+    def save(self, wfp):
+        """save to a .npz file, one array per key"""
+        np.savez(wfp, output_fps=self.output_fps, **{key: getattr(self, key) for key in MOTION_KEYS})
+
+    @classmethod
+    def load(cls, fp):
+        """load a .npz file saved by `save`, or a legacy .pkl template"""
+        if fp.endswith('.pkl'):
+            return cls.from_template(load(fp))
+        with np.load(fp) as data:
+            return cls(**{key: data[key] for key in MOTION_KEYS}, output_fps=int(data['output_fps']))
+
+
+def record_chunks(motion_chunks, recorded):
+    """pass the chunks of an iterable through, appending each one to the list `recorded`"""
+    for motion_chunk in motion_chunks:
+        recorded.append(motion_chunk)
+        yield motion_chunk
@@ -0,0 +1,77 @@
+# coding: utf-8
+
+"""
+onnxruntime backend: run exported ONNX graphs in place of the torch modules
+"""
+
+import os.path as osp
+import torch
+import torch.nn as nn
+import onnxruntime
+
+from .rprint import rlog as log
+
+
+def make_session(onnx_path, device='cpu', num_threads=4):
+    """onnxruntime session with all graph optimizations, on the cuda execution provider or the tuned cpu one"""
+    opts = onnxruntime.SessionOptions()
+    opts.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if device.startswith('cuda'):
+        device_id = int(device.split(':')[1]) if ':' in device else 0
+        providers = [('CUDAExecutionProvider', {'device_id': device_id}), 'CPUExecutionProvider']
+    else:
+        # one graph at a time, all threads inside the ops
+        opts.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        opts.intra_op_num_threads = num_threads
+        opts.inter_op_num_threads = 1
+        providers = ['CPUExecutionProvider']
+    return onnxruntime.InferenceSession(onnx_path, sess_options=opts, providers=providers)
+
+
+def to_numpy(x):
+    if isinstance(x, torch.Tensor):
+        if x.is_floating_point():
+            x = x.float()  # graphs are exported in fp32
+        return x.detach().cpu().numpy()
+    return x
+
+
+class OnnxModule(nn.Module):
+    """
+    drop-in replacement of an exported torch module, it takes and returns torch tensors on `device`.
+    Inputs are matched to the graph inputs by position or by name, graphs with a single output return a tensor and
+    graphs with several outputs a dict keyed by the output names.
+    """
+
+    def __init__(self, onnx_path, device='cpu', num_threads=4):
+        super().__init__()
+        self.onnx_path = onnx_path
+        self.device = device
+        self.session = make_session(onnx_path, device, num_threads)
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        self.output_names = [node.name for node in self.session.get_outputs()]
+
+    def forward(self, *args, **kwargs):
+        inputs = dict(zip(self.input_names, args))
+        inputs.update({k: v for k, v in kwargs.items() if k in self.input_names})
+        feed = {k: to_numpy(v) for k, v in inputs.items() if v is not None}
+        outputs = self.session.run(self.output_names, feed)
+        outputs = [torch.from_numpy(out).to(self.device) for out in outputs]
+        if len(outputs) == 1:
+            return outputs[0]
+        return dict(zip(self.output_names, outputs))
+
+
+def load_onnx_module(onnx_dir, name, device='cpu', num_threads=4):
+    """OnnxModule of `<onnx_dir>/<name>.onnx`, None if the graph was not exported or can not be loaded"""
+    onnx_path = osp.join(onnx_dir, f'{name}.onnx')
+    if not osp.exists(onnx_path):
+        log(f'{onnx_path} not found, run scripts/export_onnx.py first. Use torch for {name}.')
+        return None
+    try:
+        module = OnnxModule(onnx_path, device, num_threads)
+    except Exception as e:
+        log(f'Failed to load {onnx_path}: {e}. Use torch for {name}.')
+        return None
+    log(f'Load {name} from {osp.realpath(onnx_path)} with onnxruntime done.')
+    return module
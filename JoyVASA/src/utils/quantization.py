@@ -0,0 +1,78 @@
+# coding: utf-8
+
+"""
+int8 quantization for cpu inference: dynamic quantization of the Linear layers and static quantization of the
+convs of G (SPADEDecoder) with the observers calibrated by scripts/calibrate_quantization.py
+"""
+
+import copy
+import os.path as osp
+import torch
+import torch.nn as nn
+from torch.ao import quantization as tq
+
+from .rprint import rlog as log
+
+
+def quantize_dynamic_linear(model):
+    """copy of `model` with every nn.Linear quantized to int8 weights, activations are quantized on the fly
+
+    The fused projections of nn.MultiheadAttention are parameters, not nn.Linear, and stay in fp32.
+    """
+    return tq.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+class StaticQuantConv(nn.Module):
+    """conv running in int8 between fp32 neighbours: quantize the input, int8 conv, dequantize the output"""
+
+    def __init__(self, conv):
+        super().__init__()
+        self.quant = tq.QuantStub()
+        self.conv = conv
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def _wrap_convs(module):
+    for name, child in module.named_children():
+        if isinstance(child, nn.Conv2d):
+            setattr(module, name, StaticQuantConv(child))
+        else:
+            _wrap_convs(child)
+
+
+def prepare_static_spade(model):
+    """G with spectral norm baked into the weights and observers on every conv, ready for calibration"""
+    for module in model.modules():
+        if hasattr(module, 'weight_orig'):
+            # the eval-mode weight of spectral norm, without a power iteration
+            nn.utils.remove_spectral_norm(module)
+    _wrap_convs(model)
+    qconfig = tq.get_default_qconfig(torch.backends.quantized.engine)
+    for module in model.modules():
+        if isinstance(module, StaticQuantConv):
+            module.qconfig = qconfig
+    model.eval()
+    return tq.prepare(model, inplace=True)
+
+
+def convert_static_spade(model):
+    """int8 G from a calibrated `prepare_static_spade` model"""
+    return tq.convert(model.eval(), inplace=True)
+
+
+def load_static_spade(model, calib_path):
+    """int8 copy of G with the scales and zero points of `calib_path`, None if the calibration is missing or does not match"""
+    if not osp.exists(calib_path):
+        log(f'{calib_path} not found, run scripts/calibrate_quantization.py first. Keep G in fp32.')
+        return None
+    try:
+        model = convert_static_spade(prepare_static_spade(copy.deepcopy(model)))
+        model.load_state_dict(torch.load(calib_path, map_location='cpu'))
+    except Exception as e:
+        log(f'Failed to load {calib_path}: {e}. Keep G in fp32.')
+        return None
+    log(f'Load int8 spade_generator from {osp.realpath(calib_path)} done.')
+    return model
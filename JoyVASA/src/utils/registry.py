@@ -0,0 +1,50 @@
+# coding: utf-8
+
+"""
+registry of the models shared by several pipelines in one process, e.g. the human and animal pipelines of the gradio
+demo share the motion generator, S and the face detectors
+"""
+
+import threading
+
+from .rprint import rlog as log
+
+
+class ModelRegistry(object):
+    """models keyed by what they are loaded from (checkpoint, device, backend...), each one is loaded once on the
+    first request and returned as is to the next ones. Loads of different keys can run in parallel threads."""
+
+    def __init__(self):
+        self.models = {}
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    def get(self, key, load_fn, *args, **kwargs):
+        with self.lock:
+            if key in self.models:
+                log(f'Share {key[0]} from the model registry.')
+                return self.models[key]
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        # a concurrent request of the same key waits for the first one instead of loading a second copy
+        with key_lock:
+            with self.lock:
+                if key in self.models:
+                    log(f'Share {key[0]} from the model registry.')
+                    return self.models[key]
+            model = load_fn(*args, **kwargs)
+            with self.lock:
+                self.models[key] = model
+        return model
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+            self.key_locks.clear()
+
+
+def load_shared(registry, key, load_fn, *args, **kwargs):
+    """`load_fn(*args, **kwargs)` through `registry` if there is one, key is a tuple starting with the model name"""
+    if registry is None:
+        return load_fn(*args, **kwargs)
+    return registry.get(key, load_fn, *args, **kwargs)
@@ -5,6 +5,7 @@ tools to measure elapsed time
 """
 
 import time
+import torch
 
 class Timer(object):
     """A simple timer."""
@@ -27,3 +28,31 @@ class Timer(object):
     def clear(self):
         self.start_time = 0.
         self.diff = 0.
+
+
+class ModuleTimer(object):
+    """callable proxy of a module that accumulates its wall time and number of calls"""
+
+    def __init__(self, module, device='cpu'):
+        self.module = module
+        self.flag_sync = str(device).startswith('cuda')  # wait for the kernels so that the time is real
+        self.total_time = 0.
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        if self.flag_sync:
+            torch.cuda.synchronize()
+        start_time = time.perf_counter()
+        out = self.module(*args, **kwargs)
+        if self.flag_sync:
+            torch.cuda.synchronize()
+        self.total_time += time.perf_counter() - start_time
+        self.calls += 1
+        return out
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+    def clear(self):
+        self.total_time = 0.
+        self.calls = 0
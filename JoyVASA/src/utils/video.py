@@ -9,6 +9,10 @@ import os
 import os.path as osp
 import numpy as np
 import subprocess
+import tempfile
+import threading
+import wave
+import queue
 import imageio
 import cv2
 from rich.progress import track
@@ -112,11 +116,13 @@ class VideoWriter:
         self.pixelformat = kwargs.get('pixelformat', 'yuv420p')
         self.image_mode = kwargs.get('image_mode', 'rgb')
         self.ffmpeg_params = kwargs.get('ffmpeg_params')
+        self.macro_block_size = kwargs.get('macro_block_size', 2)
 
         self.writer = imageio.get_writer(
             self.wfp, fps=self.fps, format=self.video_format,
             codec=self.codec, quality=self.quality,
-            ffmpeg_params=self.ffmpeg_params, pixelformat=self.pixelformat
+            ffmpeg_params=self.ffmpeg_params, pixelformat=self.pixelformat,
+            macro_block_size=self.macro_block_size
         )
 
     def write(self, image):
@@ -130,6 +136,134 @@ class VideoWriter:
             self.writer.close()
 
 
+class FFmpegPipeWriter:
+    """Pipe raw RGB frames into a single ffmpeg process
+
+    When `audio_fp` is given, the audio is muxed in the same pass, so the final video comes out of one encode
+    without a temporary silent video.
+    """
+
+    def __init__(self, **kwargs):
+        self.fps = kwargs.get('fps', 25)
+        self.wfp = kwargs.get('wfp', 'video.mp4')
+        self.audio_fp = kwargs.get('audio_fp')
+        self.codec = kwargs.get('codec', 'libx264')
+        self.crf = kwargs.get('crf', 18)
+        self.pixelformat = kwargs.get('pixelformat', 'yuv420p')
+        self.image_mode = kwargs.get('image_mode', 'rgb')
+        self.ffmpeg_params = kwargs.get('ffmpeg_params') or []
+        self.process = None
+
+    def _open(self, h, w):
+        cmd = [
+            'ffmpeg',
+            '-y',
+            '-loglevel', 'error',
+            '-f', 'rawvideo',
+            '-pix_fmt', 'rgb24',
+            '-s', f'{w}x{h}',
+            '-r', str(self.fps),
+            '-i', '-',
+        ]
+        if self.audio_fp is not None:
+            cmd += ['-i', self.audio_fp, '-map', '0:v', '-map', '1:a', '-c:a', 'aac']
+        cmd += ['-c:v', self.codec, '-crf', str(self.crf), '-pix_fmt', self.pixelformat]
+        cmd += list(self.ffmpeg_params) + [self.wfp]
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def write(self, image):
+        if self.process is None:
+            self._open(*image.shape[:2])
+        if self.image_mode.lower() == 'bgr':
+            image = image[..., ::-1]
+        try:
+            self.process.stdin.write(np.ascontiguousarray(image, dtype=np.uint8).tobytes())
+        except BrokenPipeError:
+            _, stderr = self.process.communicate()
+            raise RuntimeError(f"ffmpeg exited while writing {self.wfp}: {stderr.decode(errors='ignore')}")
+
+    def close(self):
+        if self.process is None:
+            return
+        _, stderr = self.process.communicate()
+        if self.process.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed to write {self.wfp}: {stderr.decode(errors='ignore')}")
+        log(f"Video with audio generated successfully: {self.wfp}")
+
+
+class AsyncVideoWriter:
+    """Encode frames on a background thread
+
+    Frames are handed over through a bounded queue, so the producer blocks instead of buffering the whole clip
+    when the encoder falls behind, and encoding overlaps with inference.
+    """
+
+    def __init__(self, writer, queue_size=16):
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            image = self.queue.get()
+            if image is None:
+                break
+            if self.error is not None:
+                continue  # keep draining so that the producer never blocks on a dead encoder
+            try:
+                self.writer.write(image)
+            except Exception as e:
+                self.error = e
+
+    def write(self, image):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(image)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+        if self.error is not None:
+            raise self.error
+
+
+def encode_fmp4_segment(images, fps=25, audio=None, sample_rate=16000, time_offset=0., **kwargs):
+    """
+    Encode a list of RGB frames, and optionally the mono float PCM audio they go with, into a self-contained
+    fragmented MP4 segment (bytes) that a player can start before the next segment exists.
+    time_offset: the start time of the segment in the stream, in seconds
+    """
+    codec = kwargs.get('codec', 'libx264')
+    crf = kwargs.get('crf', 18)
+    pixelformat = kwargs.get('pixelformat', 'yuv420p')
+    h, w = images[0].shape[:2]
+    cmd = ['ffmpeg', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{w}x{h}', '-r', str(fps), '-i', '-']
+    audio_fp = None
+    if audio is not None:
+        # 16-bit wav of the segment audio, ffmpeg reads the frames from stdin
+        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as f:
+            audio_fp = f.name
+        with wave.open(audio_fp, 'wb') as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(sample_rate)
+            wav.writeframes((np.clip(audio, -1., 1.) * 32767).astype('<i2').tobytes())
+        cmd += ['-i', audio_fp, '-map', '0:v', '-map', '1:a', '-c:a', 'aac']
+    cmd += ['-c:v', codec, '-crf', str(crf), '-pix_fmt', pixelformat,
+            '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-output_ts_offset', f'{time_offset:.3f}', '-f', 'mp4', 'pipe:1']
+    try:
+        process = subprocess.run(cmd, input=np.ascontiguousarray(np.stack(images), dtype=np.uint8).tobytes(), capture_output=True)
+    finally:
+        if audio_fp is not None:
+            os.remove(audio_fp)
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to encode a segment: {process.stderr.decode(errors='ignore')}")
+    return process.stdout
+
+
 def change_video_fps(input_file, output_file, fps=20, codec='libx264', crf=12):
     cmd = f'ffmpeg -i "{input_file}" -c:v {codec} -crf {crf} -r {fps} "{output_file}" -y'
     exec_cmd(cmd)
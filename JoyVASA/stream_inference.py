@@ -0,0 +1,96 @@
+# coding: utf-8
+
+"""
+Streaming inference: animate a reference image from live audio and write the frames as they are rendered.
+
+The audio comes from a TCP client sending 16 kHz mono s16le PCM, or from an audio file fed at real time speed to
+simulate a live source. The frames go to one video, or to one fragmented MP4 segment per window with
+--flag_fmp4_segments. The latency from the first audio sample to the first frame and the steady-state real-time
+factor are logged at the end.
+
+python stream_inference.py -r assets/examples/imgs/joyvasa_003.png -a assets/examples/audios/joyvasa_003.wav --stream_window_frames 25
+python stream_inference.py -r assets/examples/imgs/joyvasa_003.png --socket_port 9000 --flag_fmp4_segments
+"""
+
+import os
+import os.path as osp
+from dataclasses import dataclass
+from typing import Optional
+
+import tyro
+
+from inference import partial_fields, fast_check_ffmpeg
+from src.config.argument_config import ArgumentConfig
+from src.config.inference_config import InferenceConfig
+from src.config.crop_config import CropConfig
+from src.streaming import StreamingTalkingHead, iter_audio_file, iter_socket_audio
+from src.utils.helper import mkdir, basename
+from src.utils.video import FFmpegPipeWriter
+from src.utils.rprint import rlog as log
+
+
+@dataclass(repr=False)
+class StreamArgumentConfig(ArgumentConfig):
+    socket_port: Optional[int] = None  # receive 16 kHz mono s16le PCM from a TCP client on this port instead of reading --audio
+    socket_host: str = '127.0.0.1'  # address the PCM server listens on
+    audio_chunk_ms: int = 200  # size of the chunks --audio is fed in
+    flag_realtime_audio: bool = True  # feed --audio at real time speed like a live source, False feeds it as fast as it is consumed
+    flag_fmp4_segments: bool = False  # write one fragmented MP4 segment per window instead of one video
+
+
+def main():
+    tyro.extras.set_accent_color("bright_cyan")
+    args = tyro.cli(StreamArgumentConfig)
+
+    ffmpeg_dir = os.path.join(os.getcwd(), "ffmpeg")
+    if osp.exists(ffmpeg_dir):
+        os.environ["PATH"] += (os.pathsep + ffmpeg_dir)
+    if not fast_check_ffmpeg():
+        raise ImportError(
+            "FFmpeg is not installed. Please install FFmpeg (including ffmpeg and ffprobe) before running this script. https://ffmpeg.org/download.html"
+        )
+    if not osp.exists(args.reference):
+        raise FileNotFoundError(f"reference info not found: {args.reference}")
+
+    inference_cfg = partial_fields(InferenceConfig, args.__dict__)
+    crop_cfg = partial_fields(CropConfig, args.__dict__)
+    if args.animation_mode == "animal":
+        from src.live_portrait_wmg_pipeline_animal import LivePortraitPipelineAnimal
+        pipeline = LivePortraitPipelineAnimal(inference_cfg=inference_cfg, crop_cfg=crop_cfg)
+    elif args.animation_mode == "human":
+        from src.live_portrait_wmg_pipeline import LivePortraitPipeline
+        pipeline = LivePortraitPipeline(inference_cfg=inference_cfg, crop_cfg=crop_cfg)
+    else:
+        raise RuntimeError(f"error args.animation_mode: {args.animation_mode}")
+
+    streamer = StreamingTalkingHead(pipeline, args)
+    streamer.set_reference(args.reference)
+
+    if args.socket_port is not None:
+        audio_chunks = iter_socket_audio(args.socket_host, args.socket_port)
+        audio_fp = None
+    else:
+        if not osp.exists(args.audio):
+            raise FileNotFoundError(f"audio info not found: {args.audio}")
+        audio_chunks = iter_audio_file(args.audio, chunk_ms=args.audio_chunk_ms, flag_realtime=args.flag_realtime_audio)
+        audio_fp = args.audio
+
+    mkdir(args.output_dir)
+    name = f'{basename(args.reference)}_stream'
+    if args.flag_fmp4_segments:
+        n_segments = 0
+        for segment in streamer.stream_segments(audio_chunks):
+            with open(osp.join(args.output_dir, f'{name}_{n_segments:05d}.mp4'), 'wb') as f:
+                f.write(segment)
+            n_segments += 1
+        log(f'Write {n_segments} segments to {args.output_dir}')
+    else:
+        writer = FFmpegPipeWriter(wfp=osp.join(args.output_dir, f'{name}.mp4'), fps=inference_cfg.output_fps, audio_fp=audio_fp, crf=18)
+        for frames in streamer.stream(audio_chunks):
+            for frame in frames:
+                writer.write(frame)
+        writer.close()
+
+
+if __name__ == "__main__":
+    main()